@@ -0,0 +1,130 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Measures the throughput of #movcopy.copy_mdat() between a simulated source
+and destination device with limited bandwidth (like a card reader and a
+network mount), with the data read in the writing thread and read ahead
+on the #movcopy.ReadAhead thread. Fails if the copied data differs, or if
+reading ahead does not reach most of the bandwidth of the slower device.
+
+    $ python benchmarks/copy.py [--size MIB] [--read-mbps N] [--write-mbps N]
+"""
+
+import argparse
+import io
+import os
+import struct
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import movcopy
+from movio import MovAtomR, MovAtomW
+
+
+class ThrottledReader(io.BytesIO):
+  # Reads take as long as they would on a device with *rate* bytes/s.
+  def __init__(self, data, rate):
+    super(ThrottledReader, self).__init__(data)
+    self.rate = rate
+
+  def read(self, size=-1):
+    data = super(ThrottledReader, self).read(size)
+    time.sleep(len(data) / self.rate)
+    return data
+
+  def readinto(self, buffer):
+    count = super(ThrottledReader, self).readinto(buffer)
+    time.sleep(count / self.rate)
+    return count
+
+
+class ThrottledWriter(object):
+  # Writes take as long as they would on a device with *rate* bytes/s. The
+  # data is written into a preallocated buffer of *size* bytes.
+  def __init__(self, size, rate):
+    self.buffer = bytearray(size)
+    self.position = 0
+    self.rate = rate
+
+  def write(self, data):
+    time.sleep(len(data) / self.rate)
+    self.buffer[self.position:self.position + len(data)] = data
+    self.position += len(data)
+    return len(data)
+
+  def getvalue(self):
+    return bytes(self.buffer[:self.position])
+
+
+def copy(data, read_rate, write_rate, buffer_size, depth):
+  """
+  Copies the `mdat` atom *data* and returns the elapsed time and the
+  written data.
+  """
+
+  source = ThrottledReader(data, read_rate)
+  mdat = MovAtomR(source)
+  mdat.read_header()
+  output = ThrottledWriter(len(data), write_rate)
+  start = time.time()
+  with MovAtomW(output, mdat.size, b'mdat') as writer:
+    movcopy.copy_mdat(mdat, writer, buffer_size, depth=depth)
+  return time.time() - start, output.getvalue()
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--size', type=int, default=64, help='MiB')
+  parser.add_argument('--read-mbps', type=float, default=200.0)
+  parser.add_argument('--write-mbps', type=float, default=150.0)
+  parser.add_argument('--buffer-size', type=int, default=movcopy.COPY_CHUNKSIZE)
+  parser.add_argument('--depth', type=int, default=movcopy.BUFFER_DEPTH)
+  parser.add_argument('--min-ratio', type=float, default=0.8)
+  args = parser.parse_args()
+
+  payload = os.urandom(1024 * 1024) * args.size
+  data = struct.pack('>I', len(payload) + 8) + b'mdat' + payload
+  read_rate, write_rate = args.read_mbps * 1024 * 1024, args.write_mbps * 1024 * 1024
+  limit = min(args.read_mbps, args.write_mbps)
+
+  errors = []
+  ratio = None
+  for depth in (0, args.depth):
+    elapsed, output = copy(data, read_rate, write_rate, args.buffer_size, depth)
+    if output != data:
+      errors.append('depth {}: copied data differs'.format(depth))
+    mbps = args.size / elapsed
+    ratio = mbps / limit
+    print('depth {:>2}: {:7.1f} MiB/s ({:.0%} of the slower device)'.format(depth, mbps, ratio))
+
+  if ratio < args.min_ratio:
+    errors.append('reading ahead reaches less than {:.0%} of {} MiB/s'.format(args.min_ratio, limit))
+  for error in errors:
+    print('error:', error)
+  return 1 if errors else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
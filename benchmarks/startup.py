@@ -0,0 +1,103 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Measures the time it takes to list the atoms of a file with `movrepair.py`
+and fails if modules that are not needed for it are imported, or if the
+import time of `movrepair` exceeds a threshold.
+
+    $ python benchmarks/startup.py [--runs N] [--max-import-ms MS]
+"""
+
+import argparse
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: Modules that must not be imported when listing the atoms of a file.
+FORBIDDEN_MODULES = ['argparse', 'movatoms', 'movutils', 'movcopy', 'json', 'hashlib']
+
+CHECK_SCRIPT = '''
+import sys
+sys.path.insert(0, {root!r})
+import movrepair
+movrepair.main([{filename!r}])
+loaded = [x for x in {forbidden!r} if x in sys.modules]
+if loaded:
+  sys.exit('modules loaded for listing: ' + ', '.join(loaded))
+'''
+
+
+def import_time_us(module):
+  """
+  Returns the cumulative import time of *module* in microseconds, as
+  reported by `python -X importtime`.
+  """
+
+  output = subprocess.check_output([sys.executable, '-X', 'importtime', '-c',
+    'import ' + module], cwd=ROOT, stderr=subprocess.STDOUT).decode()
+  for line in output.splitlines():
+    parts = [x.strip() for x in line.split('|')]
+    if len(parts) == 3 and parts[2] == module:
+      return int(parts[1])
+  raise RuntimeError('import time of {} not found'.format(module))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--runs', type=int, default=20)
+  parser.add_argument('--max-import-ms', type=float, default=25.0)
+  args = parser.parse_args()
+
+  with tempfile.NamedTemporaryFile(suffix='.mov', delete=False) as fp:
+    fp.write(struct.pack('>I', 16) + b'ftypqt  ' + b'\0' * 4)
+    fp.write(struct.pack('>I', 16) + b'mdat' + b'\0' * 8)
+  try:
+    subprocess.check_call([sys.executable, '-c', CHECK_SCRIPT.format(
+      root=ROOT, filename=fp.name, forbidden=FORBIDDEN_MODULES)],
+      stdout=subprocess.DEVNULL)
+
+    # Warm up (eg. to write the bytecode cache), then measure.
+    command = [sys.executable, os.path.join(ROOT, 'movrepair.py'), fp.name]
+    subprocess.check_call(command, stdout=subprocess.DEVNULL)
+    start = time.perf_counter()
+    for i in range(args.runs):
+      subprocess.check_call(command, stdout=subprocess.DEVNULL)
+    listing_ms = (time.perf_counter() - start) / args.runs * 1000
+  finally:
+    os.remove(fp.name)
+
+  import_ms = min(import_time_us('movrepair') for i in range(5)) / 1000.0
+  print('movrepair.py FILE: {:.1f}ms per run'.format(listing_ms))
+  print('import movrepair: {:.1f}ms'.format(import_ms))
+  if import_ms > args.max_import_ms:
+    print('error: import time exceeds {}ms'.format(args.max_import_ms))
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
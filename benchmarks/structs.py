@@ -0,0 +1,137 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Compares the generated unpack and pack functions of the structs in
+`movatoms` with the generic implementation in #movutils.Struct, and fails if
+they do not produce the same results. Structs that are not compiled (see
+#movutils.StructCompiler.supports()) are marked with a `*`.
+
+    $ python benchmarks/structs.py [--number N]
+"""
+
+import argparse
+import io
+import os
+import struct
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import movatoms
+import movutils
+
+
+class FakeAtom(object):
+  # Provides the size of the atom to the `hdlr` struct.
+  def __init__(self, data):
+    self.size = len(data) + 8
+
+
+def atom(tag, data):
+  return struct.pack('>I', len(data) + 8) + tag + data
+
+
+def sample_description(data_format, data):
+  return struct.pack('>I', len(data) + 16) + data_format + b'\0' * 6 + struct.pack('>H', 1) + data
+
+
+def data_reference(tag, data):
+  return struct.pack('>I', len(data) + 12) + tag + b'\0' * 4 + data
+
+
+def make_samples():
+  """
+  Returns a list of `(name, struct_type, data, make_ctx)` tuples.
+  """
+
+  hdlr = b'\0' * 4 + b'mhlrvide' + b'\0' * 12 + b'\x0cVideoHandler'
+  stsd = b'\0' * 4 + struct.pack('>I', 2) + sample_description(b'avc1', b'\1' * 70) + \
+    sample_description(b'mp4a', b'\2' * 20)
+  dref = b'\0' * 4 + struct.pack('>I', 2) + data_reference(b'alis', b'') + \
+    data_reference(b'url ', b'file:///tmp/x.mov')
+  stts = b'\0' * 4 + struct.pack('>I', 3) + struct.pack('>6I', 10, 20, 1, 40, 5, 20)
+  stsc = b'\0' * 4 + struct.pack('>I', 2) + struct.pack('>6I', 1, 4, 1, 100, 3, 1)
+  sbgp = b'\x01\0\0\0roll' + struct.pack('>I', 7) + struct.pack('>I', 1) + struct.pack('>2I', 30, 1)
+  moov = atom(b'mvhd', b'\0' * 100) + atom(b'trak', atom(b'tkhd', b'\0' * 84) +
+    atom(b'mdia', atom(b'mdhd', b'\0' * 24) + atom(b'hdlr', hdlr) +
+      atom(b'minf', atom(b'stbl', atom(b'stsd', stsd) + atom(b'stts', stts) +
+        atom(b'stsc', stsc)))))
+  return [
+    ('hdlr', movatoms.hdlr, hdlr, lambda: movatoms.SubAtomsUnpackContext(FakeAtom(hdlr), movatoms.hdlr)),
+    ('tkhd', movatoms.tkhd, b'\0' * 84, None),
+    ('mvhd', movatoms.mvhd, b'\0' * 100, None),
+    ('sample_description', movatoms.sample_description, sample_description(b'avc1', b'\1' * 70), None),
+    ('stsd', movatoms.stsd, stsd, None),
+    ('data_reference', movatoms.data_reference, data_reference(b'url ', b'file:///tmp/x.mov'), None),
+    ('dref', movatoms.dref, dref, None),
+    ('stts', movatoms.stts, stts, None),
+    ('sbgp', movatoms.sbgp, sbgp, None),
+    ('moov', movatoms.moov, moov, None),
+  ]
+
+
+def generic_pack(obj):
+  fp = io.BytesIO()
+  obj._pack_fields_(fp)
+  return fp.getvalue()
+
+
+def best(func, number):
+  return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--number', type=int, default=2000)
+  args = parser.parse_args()
+
+  errors = []
+  print('{:<20}{:>14}{:>14}{:>9}{:>14}{:>14}{:>9}'.format('struct', 'unpack (us)',
+    'generated', 'speedup', 'pack (us)', 'generated', 'speedup'))
+  for name, struct_type, data, make_ctx in make_samples():
+    make_ctx = make_ctx or (lambda: None)
+    generic = struct_type._unpack_fields_(io.BytesIO(data), make_ctx())
+    generated = struct_type.unpack(data, make_ctx())
+    if repr(generic) != repr(generated):
+      errors.append('{}: unpacked structs differ'.format(name))
+    if generic_pack(generic) != generated.pack():
+      errors.append('{}: packed data differs'.format(name))
+
+    unpack_generic = best(lambda: struct_type._unpack_fields_(io.BytesIO(data), make_ctx()), args.number)
+    unpack_generated = best(lambda: struct_type.unpack(data, make_ctx()), args.number)
+    pack_generic = best(lambda: generic_pack(generated), args.number)
+    pack_generated = best(generated.pack, args.number)
+    if not movutils.StructCompiler.supports(struct_type):
+      name += ' *'
+    print('{:<20}{:>14.2f}{:>14.2f}{:>8.1f}x{:>14.2f}{:>14.2f}{:>8.1f}x'.format(name,
+      unpack_generic, unpack_generated, unpack_generic / unpack_generated,
+      pack_generic, pack_generated, pack_generic / pack_generated))
+
+  for error in errors:
+    print('error:', error)
+  return 1 if errors else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -55,8 +55,8 @@ class SubAtomsField(Field):
     for atom in MovAtomR.make_root(fp).iter_atoms():
       struct_type = self.supported_atoms.get(atom.tag)
       if struct_type:
-        ctx = SubAtomsUnpackContext(atom, struct_type, ctx)
-        atom_obj = struct_type.unpack(atom.read_data(), ctx)
+        atom_ctx = SubAtomsUnpackContext(atom, struct_type, ctx)
+        atom_obj = struct_type.unpack(atom.read_data(), atom_ctx)
         if type(atom_obj) not in self.reverse_supported_atoms:
           raise RuntimeError('unpacked atom is not in reverse table')
         result.append(atom_obj)
@@ -72,8 +72,8 @@ class SubAtomsField(Field):
         raise ValueError('{} is not in reverse_supported_atoms'.format(
             type(atom).__name__))
       data = atom.pack()
-      with MovAtomW(fp, len(data), tag) as writer:
-        writer.write_data(data)
+      with MovAtomW(fp, len(data) + 8, tag) as writer:
+        writer.write(data)
 
 
 class hdlr(Struct):  # Handle Reference Atom (requires SubAtomsUnpackContext)
@@ -148,7 +148,28 @@ class stts(Struct):  # Time-to-Sample Atom
     Field('v', '>B'),
     Field('flags', '>3B'),
     Field('nitems?', '>I', lambda s: len(s.table)),
-    ListField('table', '>II', times='nitems')
+    ListField('table', '>II', times='nitems', lazy=True)
+  ]
+
+
+class ctts(Struct):  # Composition Offset Atom
+  _fields_ = [
+    Field('v', '>B'),
+    Field('flags', '>3B'),
+    Field('nitems?', '>I', lambda s: len(s.table)),
+    ListField('table', '>II', times='nitems', lazy=True)
+  ]
+
+
+class cslg(Struct):  # Composition Shift Least Greatest Atom
+  _fields_ = [
+    Field('v', '>B'),
+    Field('flags', '>3B'),
+    Field('composition_offset_to_display_offset_shift', '>i'),
+    Field('least_display_offset', '>i'),
+    Field('greatest_display_offset', '>i'),
+    Field('display_start_time', '>i'),
+    Field('display_end_time', '>i')
   ]
 
 
@@ -176,7 +197,16 @@ class stss(Struct):  # Sync Sample Atom
     Field('v', '>B'),
     Field('flags', '>3B'),
     Field('nitems?', '>I', lambda s: len(s.table)),
-    ListField('table', '>I', times='nitems')
+    ListField('table', '>I', times='nitems', lazy=True)
+  ]
+
+
+class stps(Struct):  # Partial Sync Sample Atom
+  _fields_ = [
+    Field('v', '>B'),
+    Field('flags', '>3B'),
+    Field('nitems?', '>I', lambda s: len(s.table)),
+    ListField('table', '>I', times='nitems', lazy=True)
   ]
 
 
@@ -186,7 +216,7 @@ class stsz(Struct):  # Sample Size Atom
     Field('flags', '>3B'),
     Field('size', '>I'),
     Field('nitems?', '>I', lambda s: len(s.table) if s.size == 0 else 0),
-    ListField('table', '>I', times=lambda ctx: ctx['nitems'] if ctx['size'] == 0 else 0)
+    ListField('table', '>I', times=lambda ctx: ctx['nitems'] if ctx['size'] == 0 else 0, lazy=True)
   ]
 
 
@@ -195,7 +225,7 @@ class stsc(Struct):  # Sample-to-Chunk Atom
     Field('v', '>B'),
     Field('flags', '>3B'),
     Field('nitems?', '>I', lambda s: len(s.table)),
-    ListField('table', '>III', times='nitems')
+    ListField('table', '>III', times='nitems', lazy=True)
   ]
 
 
@@ -204,14 +234,64 @@ class stco(Struct):  # Chunk Offset Atom
     Field('v', '>B'),
     Field('flags', '>3B'),
     Field('nitems?', '>I', lambda s: len(s.table)),
-    ListField('table', '>I', times='nitems')
+    ListField('table', '>I', times='nitems', lazy=True)
+  ]
+
+
+class co64(Struct):  # 64-bit Chunk Offset Atom
+  _fields_ = [
+    Field('v', '>B'),
+    Field('flags', '>3B'),
+    Field('nitems?', '>I', lambda s: len(s.table)),
+    ListField('table', '>Q', times='nitems', lazy=True)
+  ]
+
+
+class stsh(Struct):  # Shadow Sync Atom
+  _fields_ = [
+    Field('v', '>B'),
+    Field('flags', '>3B'),
+    Field('nitems?', '>I', lambda s: len(s.table)),
+    ListField('table', '>II', times='nitems', lazy=True)
+  ]
+
+
+class sdtp(Struct):  # Sample Dependency Flags Atom
+  # One byte for every sample, the number of samples is taken from the stsz.
+  _fields_ = [
+    Field('v', '>B'),
+    Field('flags', '>3B'),
+    ListField('table', '>B', times=None, lazy=True)
+  ]
+
+
+class sbgp(Struct):  # Sample-to-Group Atom
+  _fields_ = [
+    Field('v', '>B'),
+    Field('flags', '>3B'),
+    StringField('grouping_type', length=4),
+    StringField('grouping_type_parameter', length=lambda ctx: 4 if ctx['v'] == 1 else 0),
+    Field('nitems?', '>I', lambda s: len(s.table)),
+    ListField('table', '>II', times='nitems', lazy=True)
+  ]
+
+
+class sgpd(Struct):  # Sample Group Description Atom
+  # The layout of the group descriptions depends on the grouping type, they
+  # are kept as raw data.
+  _fields_ = [
+    Field('v', '>B'),
+    Field('flags', '>3B'),
+    StringField('grouping_type', length=4),
+    StringField('data', length=None)
   ]
 
 
 class stbl(Struct):  # Sample Table Atom
-  # stsd stts ctts cslg stss stps stsc stsz stco stsh sgpd sbgp sdtp
+  # stsd stts ctts cslg stss stps stsc stsz stco co64 stsh sgpd sbgp sdtp
   _fields_ = [
-    SubAtomsField('atoms', [stts, stsd, stss, stsz, stsc, stco])
+    SubAtomsField('atoms', [stsd, stts, ctts, cslg, stss, stps, stsc, stsz,
+      stco, co64, stsh, sgpd, sbgp, sdtp])
   ]
 
 
@@ -0,0 +1,595 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Copying the `mdat` data of a broken file into the repaired output file.
+"""
+
+from movio import get_atom_header_size, get_fileno, is_seekable
+import errno
+import io
+import json
+import os
+import queue
+import threading
+import zlib
+
+#: The number of bytes read from the broken file at once.
+COPY_CHUNKSIZE = 1024 * 1024
+
+#: The number of buffers of #COPY_CHUNKSIZE bytes that the #ReadAhead thread
+#: reads ahead of the data that is written.
+BUFFER_DEPTH = 4
+
+#: The granularity in which runs of zeros are detected when copying sparse.
+SPARSE_BLOCKSIZE = 64 * 1024
+
+ZERO_BLOCK = bytes(SPARSE_BLOCKSIZE)
+
+
+class CheckpointError(Exception):
+  pass
+
+
+class Checkpoint(object):
+  """
+  Records the progress of copying the `mdat` data into the output file in a
+  small sidecar file, allowing to resume an interrupted repair. The sidecar
+  contains the output #layout (a list of `(tag, size)` pairs for every atom
+  in the output file, to be filled in before the copy starts) and the number
+  of `mdat` data bytes that have been #committed (ie. synced to disk) which
+  happens every *interval* bytes. If *use_crc* is #True, a CRC32 of the
+  committed bytes is stored as well and verified when resuming.
+
+  The `moov` atom is always written after the `mdat`, so an output file that
+  is interrupted during the copy never appears to be complete.
+  """
+
+  def __init__(self, filename, interval, use_crc=False):
+    self.filename = filename
+    self.file = None
+    self.layout = []
+    self.interval = interval
+    self.committed = 0
+    self.crc = 0 if use_crc else None
+    self.pending = 0
+
+  @property
+  def mdat_offset(self):
+    """
+    The offset of the `mdat` atom's data in the output file.
+    """
+
+    offset = 0
+    for tag, size in self.layout:
+      if tag == b'mdat':
+        return offset + get_atom_header_size(size)
+      offset += size
+    raise CheckpointError('no mdat atom in output layout')
+
+  def advance(self, data):
+    """
+    Called for every block of *data* written to the output file.
+    """
+
+    self.pending += len(data)
+    if self.crc is not None:
+      self.crc = zlib.crc32(data, self.crc)
+
+  def commit(self):
+    """
+    Syncs the output #file to disk and records the bytes written since the
+    last commit in the sidecar file.
+    """
+
+    self.file.flush()
+    os.fsync(get_fileno(self.file))
+    self.committed += self.pending
+    self.pending = 0
+    self.save()
+
+  def save(self):
+    data = {
+      'layout': [[tag.decode('latin1'), size] for tag, size in self.layout],
+      'committed': self.committed,
+      'crc32': self.crc,
+    }
+    temp = self.filename + '.tmp'
+    with open(temp, 'w') as fp:
+      json.dump(data, fp)
+      fp.flush()
+      os.fsync(fp.fileno())
+    os.replace(temp, self.filename)
+
+  def load(self):
+    """
+    Loads the state from the sidecar file and verifies that it matches the
+    output #file and the expected #layout. Positions the output file after
+    the last committed byte and truncates anything after it.
+    """
+
+    fp = self.file
+    with open(self.filename) as sidecar:
+      data = json.load(sidecar)
+    layout = [(tag.encode('latin1'), size) for tag, size in data['layout']]
+    if layout != self.layout:
+      raise CheckpointError('output layout does not match the checkpoint')
+    self.committed = data['committed']
+    end = self.mdat_offset + self.committed
+    fp.seek(0, os.SEEK_END)
+    if fp.tell() < end:
+      raise CheckpointError('output file is smaller than the checkpoint')
+    if data['crc32'] is not None:
+      fp.seek(self.mdat_offset)
+      crc, remaining = 0, self.committed
+      while remaining > 0:
+        block = fp.read(min(remaining, COPY_CHUNKSIZE))
+        if not block:
+          break
+        crc = zlib.crc32(block, crc)
+        remaining -= len(block)
+      if crc != data['crc32']:
+        raise CheckpointError('output file does not match the checkpoint CRC32')
+      self.crc = crc
+    elif self.crc is not None:
+      raise CheckpointError('checkpoint has no CRC32 to continue from')
+    fp.seek(end)
+    fp.truncate()
+
+  def remove(self):
+    if os.path.exists(self.filename):
+      os.remove(self.filename)
+
+
+class Digests(object):
+  """
+  A set of hash objects that are updated with the same data. Supports all
+  algorithms available in #hashlib, plus the fast `crc32` and `adler32`
+  checksums from #zlib.
+  """
+
+  def __init__(self, algorithms):
+    self.hashes = [(name, new_hash(name)) for name in algorithms]
+
+  def update(self, data):
+    for name, hash_obj in self.hashes:
+      hash_obj.update(data)
+
+  def hexdigests(self):
+    return {name: hash_obj.hexdigest() for name, hash_obj in self.hashes}
+
+
+class ZlibChecksum(object):
+  """
+  Wraps a #zlib checksum function in the #hashlib interface.
+  """
+
+  def __init__(self, name, func, value):
+    self.name = name
+    self.func = func
+    self.value = value
+
+  def update(self, data):
+    self.value = self.func(data, self.value)
+
+  def hexdigest(self):
+    return '{:08x}'.format(self.value & 0xffffffff)
+
+
+def new_hash(name):
+  """
+  Creates a new hash object for the algorithm *name*. Raises a #ValueError
+  if the algorithm is not supported.
+  """
+
+  if name == 'crc32':
+    return ZlibChecksum(name, zlib.crc32, 0)
+  if name == 'adler32':
+    return ZlibChecksum(name, zlib.adler32, 1)
+  import hashlib
+  return hashlib.new(name)
+
+
+class HashingThread(object):
+  """
+  Updates #Digests on a background thread, so that hashing the data does not
+  slow down the copy (#hashlib releases the GIL for large buffers). The data
+  passed to #submit() must not be modified afterwards. If the thread falls
+  behind by more than *maxsize* buffers, #submit() blocks.
+  """
+
+  def __init__(self, maxsize=64):
+    self.queue = queue.Queue(maxsize)
+    self.error = None
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      if self.error is None:
+        digests, data = item
+        try:
+          digests.update(data)
+        except Exception as exc:
+          self.error = exc
+
+  def submit(self, digests, data):
+    self.queue.put((digests, data))
+
+  def close(self):
+    """
+    Waits until all submitted data has been hashed. Re-raises an exception
+    that occurred in the background thread.
+    """
+
+    self.queue.put(None)
+    self.thread.join()
+    if self.error is not None:
+      raise self.error
+
+
+class HashingWriter(object):
+  """
+  Wraps a writable file-like object and submits all data written to it to a
+  #HashingThread for the specified #Digests. The wrapper has no file
+  descriptor, so that all data is guaranteed to pass through #write().
+  """
+
+  def __init__(self, fp, hasher, digests):
+    self.file = fp
+    self.hasher = hasher
+    self.digests = digests
+
+  def write(self, data):
+    self.hasher.submit(self.digests, bytes(data))
+    return self.file.write(data)
+
+  def write_hole(self, nbytes):
+    for block in iter_zeros(nbytes):
+      self.hasher.submit(self.digests, block)
+    self.file.seek(nbytes, os.SEEK_CUR)
+
+  def fileno(self):
+    raise io.UnsupportedOperation('fileno')
+
+  def __getattr__(self, name):
+    return getattr(self.file, name)
+
+
+class ReadAhead(object):
+  """
+  Reads the remaining data of the #MovAtomR *mdat* on a background thread,
+  so that reading the broken file overlaps with writing the output file.
+  Unlike #copy_range(), the data passes through the process, so that it can
+  be checkpointed and hashed. It is read with #MovAtomR.readinto() into a
+  ring of *depth* reusable buffers of *buffer_size* bytes. Iterating yields
+  `(data, length)` tuples, where *data* is a #memoryview of a buffer that
+  is only valid until the next tuple is requested.
+
+  If *sparse* is #True, the tuples of #iter_sparse_data() are read ahead
+  instead (up to *depth* of them).
+
+  The kernel is advised that the file is read sequentially and that the
+  data that was read is not needed in the page cache anymore, if it
+  supports `posix_fadvise()` for the file.
+  """
+
+  def __init__(self, mdat, buffer_size=COPY_CHUNKSIZE, depth=BUFFER_DEPTH, sparse=False):
+    self.mdat = mdat
+    self.buffer_size = buffer_size
+    self.sparse = sparse
+    self.free = queue.Queue()
+    self.filled = queue.Queue(depth)
+    if not sparse:
+      for _ in range(depth):
+        self.free.put(bytearray(buffer_size))
+    self.fileno = get_fileno(mdat.file) if hasattr(os, 'posix_fadvise') else None
+    self.error = None
+    self.stopped = False
+    self.done = False
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _advise(self, offset, length, advice):
+    if self.fileno is not None and length > 0:
+      try:
+        os.posix_fadvise(self.fileno, offset, length, getattr(os, advice))
+      except OSError:
+        # Eg. ESPIPE if the file is a pipe.
+        self.fileno = None
+
+  def _run(self):
+    mdat = self.mdat
+    try:
+      offset = mdat.atom_begin + mdat.bytes_read
+      self._advise(offset, mdat.size - mdat.bytes_read, 'POSIX_FADV_SEQUENTIAL')
+      if self.sparse:
+        blocks = ((None, data, length) for data, length in iter_sparse_data(mdat, self.buffer_size))
+      else:
+        blocks = self._read_buffers()
+      for item in blocks:
+        if self.stopped:
+          break
+        # The data has been copied out of the page cache.
+        end = mdat.atom_begin + mdat.bytes_read
+        self._advise(offset, end - offset, 'POSIX_FADV_DONTNEED')
+        offset = end
+        self.filled.put(item)
+    except Exception as exc:
+      self.error = exc
+    finally:
+      self.filled.put(None)
+
+  def _read_buffers(self):
+    while True:
+      buffer = self.free.get()
+      if self.stopped:
+        break
+      nbytes = self.mdat.readinto(buffer)
+      if not nbytes:
+        break
+      yield buffer, memoryview(buffer)[:nbytes], nbytes
+
+  def __iter__(self):
+    while True:
+      item = self.filled.get()
+      if item is None:
+        break
+      buffer, data, length = item
+      yield data, length
+      if buffer is not None:
+        self.free.put(buffer)
+    self.done = True
+    self.thread.join()
+    if self.error is not None:
+      raise self.error
+
+  def close(self):
+    """
+    Stops the background thread if the data has not been read completely,
+    eg. because writing it failed.
+    """
+
+    if not self.done:
+      self.stopped = True
+      self.free.put(bytearray())
+      while self.filled.get() is not None:
+        pass
+      self.done = True
+    self.thread.join()
+
+
+def copy_mdat(mdat, writer, chunksize=COPY_CHUNKSIZE, checkpoint=None,
+    hasher=None, digests=None, sparse=False, depth=BUFFER_DEPTH):
+  """
+  Copies the remaining data of the #MovAtomR *mdat* into the #MovAtomW
+  *writer*. If a #Checkpoint is specified, it is committed every time its
+  interval of bytes has been written, and once more at the end. If a
+  #HashingThread is specified, the copied data is also submitted to it
+  for the #Digests *digests*.
+
+  The data is read in blocks of *chunksize* bytes by a #ReadAhead thread
+  that stays up to *depth* blocks ahead of the writes, or in the calling
+  thread if *depth* is 0.
+
+  If *sparse* is #True, runs of zeros are not written but skipped over,
+  leaving holes in the output file (see #iter_sparse_data()). This requires
+  the output file to be seekable. Returns the number of bytes skipped.
+  """
+
+  reader = None
+  if depth > 0:
+    reader = ReadAhead(mdat, chunksize, depth, sparse)
+    blocks = iter(reader)
+  elif sparse:
+    blocks = iter_sparse_data(mdat, chunksize)
+  else:
+    blocks = ((data, len(data)) for data in mdat.iter_data(chunksize))
+
+  skipped = 0
+  try:
+    for data, length in blocks:
+      if data is None:
+        writer.write_hole(length)
+        skipped += length
+        zeros = iter_zeros(length)
+      else:
+        writer.write(data)
+        zeros = (data,)
+      for block in zeros:
+        if hasher:
+          # The buffers of the ReadAhead thread are reused.
+          hasher.submit(digests, bytes(block))
+        if checkpoint:
+          checkpoint.advance(block)
+      if checkpoint and checkpoint.pending >= checkpoint.interval:
+        checkpoint.commit()
+  finally:
+    if reader:
+      reader.close()
+
+  # A hole at the end of the file must be materialized by its size.
+  if skipped:
+    writer.file.truncate()
+  if checkpoint:
+    checkpoint.commit()
+  return skipped
+
+
+def copy_range(src, dst, offset, length, chunksize=COPY_CHUNKSIZE):
+  """
+  Copies *length* bytes from the offset *offset* in the file *src* to the
+  current position of the file *dst*, which is advanced past the data.
+
+  If both files have a file descriptor, the data is copied in the kernel
+  with `copy_file_range()` (which can share the data blocks between the
+  files on file systems that support it) or `sendfile()`, without passing
+  through user space. Otherwise, or if neither works for the files, the
+  data is read and written in blocks of *chunksize* bytes. Returns the
+  number of bytes copied, which is less than *length* only if the end of
+  *src* was reached.
+  """
+
+  src_fd, dst_fd = get_fileno(src), get_fileno(dst)
+  copied = 0
+  if src_fd is not None and dst_fd is not None:
+    dst.flush()
+    dst_offset = dst.tell()
+    copied = _copy_range_fd(src_fd, dst_fd, offset, dst_offset, length)
+    # Re-synchronize the file object with the file descriptor.
+    dst.seek(dst_offset + copied)
+    if copied == length:
+      return copied
+
+  src.seek(offset + copied)
+  while copied < length:
+    data = src.read(min(length - copied, chunksize))
+    if not data:
+      break
+    dst.write(data)
+    copied += len(data)
+  return copied
+
+
+def _copy_range_fd(src_fd, dst_fd, src_offset, dst_offset, length):
+  # Copies with copy_file_range() or sendfile() and returns the number of
+  # bytes copied before the end of the source file was reached or both
+  # failed (with an error that tells that they are not supported for the
+  # files).
+  unsupported = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+    errno.ENOTSUP, errno.EBADF)
+  copied = 0
+  if hasattr(os, 'copy_file_range'):
+    try:
+      while copied < length:
+        count = os.copy_file_range(src_fd, dst_fd, min(length - copied, 1 << 30),
+          src_offset + copied, dst_offset + copied)
+        if count == 0:
+          return copied
+        copied += count
+      return copied
+    except OSError as exc:
+      if exc.errno not in unsupported:
+        raise
+  if hasattr(os, 'sendfile'):
+    # sendfile() writes to the current position of the destination.
+    os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+    try:
+      while copied < length:
+        count = os.sendfile(dst_fd, src_fd, src_offset + copied, min(length - copied, 1 << 30))
+        if count == 0:
+          break
+        copied += count
+    except OSError as exc:
+      if exc.errno not in unsupported:
+        raise
+  return copied
+
+
+def iter_sparse_data(mdat, chunksize=COPY_CHUNKSIZE, blocksize=SPARSE_BLOCKSIZE):
+  """
+  Iterates over the remaining data of the #MovAtomR *mdat* like
+  #MovAtomR.iter_data(), but yields `(data, length)` tuples where *data* is
+  #None for runs of zeros. Blocks of *blocksize* bytes that contain only
+  zeros are detected in the data that is read. If the source file is sparse
+  itself, its holes are found with `SEEK_DATA` and `SEEK_HOLE` and skipped
+  without reading them.
+  """
+
+  fileno = None
+  if is_seekable(mdat.file) and hasattr(os, 'SEEK_DATA'):
+    fileno = get_fileno(mdat.file)
+  data_begin = mdat.atom_begin + mdat.header_size
+  end = mdat.atom_begin + mdat.size
+  zero_chunk = bytes(chunksize)
+  zero_block = zero_chunk[:blocksize]
+
+  while mdat.bytes_read < mdat.size:
+    offset = mdat.atom_begin + mdat.bytes_read
+    length = min(chunksize, end - offset)
+
+    if fileno is not None:
+      try:
+        data_offset = os.lseek(fileno, offset, os.SEEK_DATA)
+        hole_offset = os.lseek(fileno, data_offset, os.SEEK_HOLE)
+      except OSError as exc:
+        if exc.errno == errno.ENXIO:
+          # There is no more data after the offset.
+          data_offset = hole_offset = end
+        else:
+          fileno = None
+      # Re-synchronize the file object with the file descriptor.
+      mdat.seek_data(offset - data_begin)
+      if fileno is not None:
+        if data_offset > offset:
+          length = min(data_offset, end) - offset
+          mdat.seek_data(offset - data_begin + length)
+          yield None, length
+          continue
+        length = min(length, hole_offset - offset)
+
+    data = mdat.read_data(length)
+    if data == zero_chunk[:len(data)]:
+      yield None, len(data)
+      continue
+
+    # Find the runs of zero and non-zero blocks in the data.
+    start = 0
+    start_zero = data.startswith(zero_block)
+    for index in range(blocksize, len(data), blocksize):
+      zero = data.startswith(zero_block[:len(data) - index], index)
+      if zero != start_zero:
+        yield (None if start_zero else data[start:index]), index - start
+        start, start_zero = index, zero
+    yield (None if start_zero else data[start:]), len(data) - start
+
+
+def iter_zeros(length):
+  """
+  Yields blocks of zeros that add up to *length* bytes.
+  """
+
+  while length > 0:
+    block = ZERO_BLOCK[:min(length, len(ZERO_BLOCK))]
+    yield block
+    length -= len(block)
+
+
+def hash_file_range(fp, start, end, hasher, *digests):
+  """
+  Submits the data between the offsets *start* and *end* in the file *fp*
+  to the #HashingThread *hasher* for all *digests*.
+  """
+
+  fp.seek(start)
+  remaining = end - start
+  while remaining > 0:
+    data = fp.read(min(remaining, COPY_CHUNKSIZE))
+    if not data:
+      break
+    for digest in digests:
+      hasher.submit(digest, data)
+    remaining -= len(data)
@@ -0,0 +1,374 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+A long-running daemon that repairs the files dropped into a spool directory.
+
+The reference file is parsed once per worker process. New files are detected
+with inotify (on Linux) or by polling the directory, and repaired on an
+asyncio event loop: planning the repair runs in a process pool, copying the
+`mdat` data in a thread pool. The number of concurrent copies is limited per
+disk, and the daemon stops picking up new files while too many are pending.
+The status of the daemon can be queried over a Unix socket.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import asyncio
+import contextlib
+import ctypes
+import ctypes.util
+import fnmatch
+import functools
+import io
+import json
+import logging
+import os
+import struct
+import sys
+import time
+
+import movrepair
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+#: The reference template of a worker process, see #_init_worker().
+_worker_template = None
+
+
+def _init_worker(reference_filename):
+  global _worker_template
+  with open(reference_filename, 'rb') as fp:
+    _worker_template = movrepair.ReferenceTemplate.load(fp)
+
+
+def _plan_job(filename):
+  """
+  Plans the repair of *filename* in a worker process. Returns the plan in its
+  JSON representation (or #None) and the output of the planning.
+  """
+
+  log = io.StringIO()
+  with open(filename, 'rb') as broken:
+    plan = movrepair.plan_repair(_worker_template, broken,
+      log=functools.partial(print, file=log))
+  return (plan.to_json() if plan else None), log.getvalue()
+
+
+def _execute_job(data, filename, output_filename):
+  """
+  Executes a planned repair in a thread. The output is written to a
+  temporary file first and renamed when the repair is complete, it is
+  removed if the repair fails.
+
+  The output of the repair is collected per file and not printed, as the
+  threads share #sys.stdout.
+  """
+
+  plan = movrepair.RepairPlan.from_json(data)
+  temp_filename = output_filename + '.part'
+  log = io.StringIO()
+  result = 1
+  try:
+    with open(filename, 'rb') as broken, open(temp_filename, 'wb') as output:
+      result = movrepair.execute_plan(plan, broken, output,
+        log=functools.partial(print, file=log))
+    if result == 0:
+      os.rename(temp_filename, output_filename)
+  finally:
+    if result != 0 and os.path.exists(temp_filename):
+      os.remove(temp_filename)
+  return result, log.getvalue()
+
+
+class Inotify(object):
+  """
+  A minimal wrapper for the Linux inotify API via #ctypes. Raises an
+  #OSError if inotify is not available.
+  """
+
+  def __init__(self, path, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+      raise OSError('libc not found')
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+      raise OSError('inotify is not supported')
+    self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+    if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+      os.close(self.fd)
+      raise OSError(ctypes.get_errno(), 'inotify_add_watch() failed')
+
+  def read_names(self):
+    """
+    Reads the pending events and returns the names of the files.
+    """
+
+    try:
+      data = os.read(self.fd, 64 * 1024)
+    except BlockingIOError:
+      return []
+    names = []
+    offset = 0
+    while offset + 16 <= len(data):
+      wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+      name = data[offset+16:offset+16+length].rstrip(b'\0')
+      names.append(os.fsdecode(name))
+      offset += 16 + length
+    return names
+
+  def close(self):
+    os.close(self.fd)
+
+
+class RepairDaemon(object):
+  """
+  Watches the *spool_dir* for files matching *pattern* and repairs them
+  using the *reference* file. Repaired files are written to *output_dir*,
+  the input files are moved to the `done/` or `failed/` subdirectory of the
+  spool directory afterwards.
+  """
+
+  def __init__(self, reference, spool_dir, output_dir, pattern='*.MOV',
+      workers=None, copy_threads=4, jobs_per_disk=1, max_pending=16,
+      poll_interval=2.0, socket_path=None, use_inotify=True):
+    self.reference = reference
+    self.spool_dir = spool_dir
+    self.output_dir = output_dir
+    self.pattern = pattern
+    self.workers = workers
+    self.copy_threads = copy_threads
+    self.jobs_per_disk = jobs_per_disk
+    self.max_pending = max_pending
+    self.poll_interval = poll_interval
+    self.socket_path = socket_path
+    self.use_inotify = use_inotify
+    self.done_dir = os.path.join(spool_dir, 'done')
+    self.failed_dir = os.path.join(spool_dir, 'failed')
+    self.queue = None
+    self.known = set()
+    self.running = {}
+    self.disk_semaphores = {}
+    self.counters = {'completed': 0, 'failed': 0}
+    self.recent = []
+    self.started = time.time()
+
+  def matches(self, name):
+    return fnmatch.fnmatch(name, self.pattern) and not name.startswith('.')
+
+  def get_disk_semaphore(self, path):
+    dev = os.stat(path).st_dev
+    if dev not in self.disk_semaphores:
+      self.disk_semaphores[dev] = asyncio.Semaphore(self.jobs_per_disk)
+    return dev, self.disk_semaphores[dev]
+
+  async def enqueue(self, name):
+    """
+    Adds a file to the queue, unless it is already known. Blocks while the
+    queue is full, applying backpressure to the watcher.
+    """
+
+    if not self.matches(name) or name in self.known:
+      return
+    self.known.add(name)
+    await self.queue.put(name)
+
+  async def watch_inotify(self, inotify):
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+    loop.add_reader(inotify.fd, event.set)
+    try:
+      while True:
+        await event.wait()
+        event.clear()
+        for name in inotify.read_names():
+          await self.enqueue(name)
+    finally:
+      loop.remove_reader(inotify.fd)
+
+  async def watch_polling(self):
+    # Only pick up a file when its size did not change since the last poll.
+    sizes = {}
+    while True:
+      for entry in os.scandir(self.spool_dir):
+        if not entry.is_file() or not self.matches(entry.name) or entry.name in self.known:
+          continue
+        size = entry.stat().st_size
+        if sizes.get(entry.name) == size:
+          del sizes[entry.name]
+          await self.enqueue(entry.name)
+        else:
+          sizes[entry.name] = size
+      await asyncio.sleep(self.poll_interval)
+
+  async def worker(self, process_pool, thread_pool):
+    loop = asyncio.get_running_loop()
+    while True:
+      name = await self.queue.get()
+      filename = os.path.join(self.spool_dir, name)
+      output_filename = os.path.join(self.output_dir, name)
+      self.running[name] = {'state': 'planning', 'started': time.time()}
+      result = 1
+      try:
+        data, log = await loop.run_in_executor(process_pool, _plan_job, filename)
+        if data is not None:
+          # Limit the number of concurrent copies per disk (reading from the
+          # spool directory and writing to the output directory).
+          semaphores = sorted(dict([self.get_disk_semaphore(self.spool_dir),
+            self.get_disk_semaphore(self.output_dir)]).items())
+          self.running[name]['state'] = 'waiting'
+          async with contextlib.AsyncExitStack() as stack:
+            for dev, semaphore in semaphores:
+              await stack.enter_async_context(semaphore)
+            self.running[name]['state'] = 'copying'
+            result, copy_log = await loop.run_in_executor(thread_pool,
+              _execute_job, data, filename, output_filename)
+          log += copy_log
+        logger.info('%s: %s', name, log.strip().replace('\n', '; '))
+      except Exception:
+        logger.exception('%s: repair failed', name)
+      finally:
+        del self.running[name]
+        self.queue.task_done()
+      self.finish(name, result == 0)
+
+  def finish(self, name, success):
+    target_dir = self.done_dir if success else self.failed_dir
+    try:
+      os.rename(os.path.join(self.spool_dir, name), os.path.join(target_dir, name))
+    except OSError as exc:
+      logger.warning('%s: could not be moved to %s: %s', name, target_dir, exc)
+    self.known.discard(name)
+    self.counters['completed' if success else 'failed'] += 1
+    self.recent = (self.recent + [{'name': name, 'success': success,
+      'time': time.time()}])[-20:]
+    logger.info('%s: %s', name, 'repaired' if success else 'failed')
+
+  def status(self):
+    return {
+      'uptime': time.time() - self.started,
+      'queued': self.queue.qsize(),
+      'running': self.running,
+      'counters': self.counters,
+      'recent': self.recent,
+    }
+
+  async def handle_status(self, reader, writer):
+    writer.write(json.dumps(self.status()).encode('utf8') + b'\n')
+    await writer.drain()
+    writer.close()
+
+  async def run(self):
+    for path in (self.output_dir, self.done_dir, self.failed_dir):
+      if not os.path.isdir(path):
+        os.makedirs(path)
+    self.queue = asyncio.Queue(self.max_pending)
+
+    inotify = None
+    if self.use_inotify:
+      try:
+        inotify = Inotify(self.spool_dir)
+      except OSError as exc:
+        logger.info('inotify not available (%s), falling back to polling', exc)
+
+    server = None
+    if self.socket_path:
+      if os.path.exists(self.socket_path):
+        os.remove(self.socket_path)
+      server = await asyncio.start_unix_server(self.handle_status, self.socket_path)
+
+    num_workers = self.workers or os.cpu_count() or 1
+    process_pool = ProcessPoolExecutor(num_workers, initializer=_init_worker,
+      initargs=(self.reference,))
+    thread_pool = ThreadPoolExecutor(self.copy_threads)
+    workers = [asyncio.ensure_future(self.worker(process_pool, thread_pool))
+      for i in range(num_workers + self.copy_threads)]
+    try:
+      if inotify:
+        # Pick up the files that are already in the spool directory.
+        watcher = asyncio.ensure_future(self.watch_inotify(inotify))
+        for name in sorted(os.listdir(self.spool_dir)):
+          if os.path.isfile(os.path.join(self.spool_dir, name)):
+            await self.enqueue(name)
+        await watcher
+      else:
+        await self.watch_polling()
+    finally:
+      for task in workers:
+        task.cancel()
+      if server:
+        server.close()
+        os.remove(self.socket_path)
+      if inotify:
+        inotify.close()
+      process_pool.shutdown()
+      thread_pool.shutdown()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='movrepair.py daemon',
+    description='Repair the files dropped into a spool directory.')
+  parser.add_argument('reference', help='A working video file.')
+  parser.add_argument('spool_dir', help='The directory to watch.')
+  parser.add_argument('-o', '--output-dir',
+    help='The directory to write the repaired files to. Default: SPOOL_DIR/repaired')
+  parser.add_argument('--pattern', default='*.MOV',
+    help='The pattern of file names to repair. Default: *.MOV')
+  parser.add_argument('--workers', type=int,
+    help='The number of processes to plan repairs in. Default: CPU count')
+  parser.add_argument('--copy-threads', type=int, default=4,
+    help='The number of threads to copy mdat data in. Default: 4')
+  parser.add_argument('--jobs-per-disk', type=int, default=1,
+    help='The number of concurrent copies per disk. Default: 1')
+  parser.add_argument('--max-pending', type=int, default=16,
+    help='The number of queued files after which no new files are picked '
+      'up. Default: 16')
+  parser.add_argument('--poll', action='store_true',
+    help='Poll the spool directory instead of using inotify.')
+  parser.add_argument('--poll-interval', type=float, default=2.0,
+    help='The poll interval in seconds. Default: 2')
+  parser.add_argument('--socket',
+    help='The path of a Unix socket to serve the daemon status on as JSON.')
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+  daemon = RepairDaemon(args.reference, args.spool_dir,
+    args.output_dir or os.path.join(args.spool_dir, 'repaired'),
+    pattern=args.pattern, workers=args.workers, copy_threads=args.copy_threads,
+    jobs_per_disk=args.jobs_per_disk, max_pending=args.max_pending,
+    poll_interval=args.poll_interval, socket_path=args.socket,
+    use_inotify=not args.poll)
+  try:
+    asyncio.run(daemon.run())
+  except KeyboardInterrupt:
+    pass
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,575 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Detecting the interleaving of PCM audio and video chunks in the `mdat` of a
+broken file. The repair normally assumes that the chunks of the broken file
+repeat the pattern of the reference file (see #movtables.extend_sequence()),
+which does not hold if the camera buffered differently while recording it.
+
+PCM audio is recognized by the most significant bytes of consecutive samples
+of the same channel, which rarely differ by much, while compressed
+video data looks random. The `mdat` is probed at regular intervals, the
+boundaries between audio and video are located by bisection and then
+refined to the exact sample frame. Only small probes of the data are read
+(through mmap, if possible), so that the scan is limited by the number of
+boundaries rather than the size of the `mdat`.
+
+The audio is split into chunks of the reference file's chunk size. Video
+frames are found by the signature of their codec where possible, otherwise
+the sizes of the frames are estimated from the reference file.
+"""
+
+from movio import MovAtomR, get_file_size_via_seek
+from movverify import FileView
+import argparse
+import array
+import collections
+import math
+import operator
+import struct
+import sys
+import time
+
+import movtables
+
+#: The PCM sample formats that can be detected, mapped to the size of a
+#: sample of one channel and the offset of its most significant byte.
+PCM_FORMATS = {
+  b'in24': (3, 0),
+  b'in32': (4, 0),
+  b'twos': (2, 0),
+  b'sowt': (2, 1),
+}
+
+#: The bytes that every frame of a video codec starts with, mapped to their
+#: offset in the frame, by the data format of the sample description.
+FRAME_MARKERS = {
+  b'AVdn': (b'\x00\x00\x02\x80', 0),
+  b'AVdh': (b'\x00\x00\x02\x80', 0),
+  b'apch': (b'icpf', 4),
+  b'apcn': (b'icpf', 4),
+  b'apcs': (b'icpf', 4),
+  b'apco': (b'icpf', 4),
+  b'ap4h': (b'icpf', 4),
+  b'ap4x': (b'icpf', 4),
+}
+
+#: Translation tables that quantize bytes into buckets of 16 values, the
+#: second one offset by half a bucket (and wrapping around at zero). Two
+#: bytes that differ by less than 8 fall into the same bucket of at least
+#: one of them, which random bytes do with a probability of about 1/8.
+QUANTIZERS = [bytes(x >> 4 for x in range(256)),
+  bytes(((x + 8) & 0xff) >> 4 for x in range(256))]
+
+#: A translation table that maps zero bytes to 1 and all others to 0.
+IS_ZERO = bytes([1] + [0] * 255)
+
+#: The default distance between the probes of the initial scan. It is
+#: reduced for files with small chunks.
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+#: The number of sample frames in a probe of the initial scan and of the
+#: bisection of a boundary.
+PROBE_FRAMES = 48
+BISECT_FRAMES = 24
+
+#: The number of sample frames on either side of a boundary that are
+#: compared to find its exact position.
+EDGE_FRAMES = 8
+
+#: The fraction of smooth samples above which a probe is considered audio.
+AUDIO_THRESHOLD = 0.5
+
+
+class DetectError(Exception):
+  pass
+
+
+class DetectedTrack(object):
+  """
+  The chunks of a track that were detected in the `mdat`: their *offsets*
+  in the broken file, the number of samples in every chunk (*counts*) and
+  the *sample_sizes* (or a constant *sample_size*).
+  """
+
+  def __init__(self, index, data_format, offsets, counts, sample_sizes=None, sample_size=0):
+    self.index = index
+    self.data_format = data_format
+    self.offsets = array.array('q', offsets)
+    self.counts = array.array('q', counts)
+    self.sample_sizes = None if sample_sizes is None else array.array('q', sample_sizes)
+    self.sample_size = sample_size
+
+  def __repr__(self):
+    return 'DetectedTrack({}, {!r}, {} chunks, {} samples)'.format(self.index,
+      self.data_format, len(self.offsets), sum(self.counts))
+
+  def to_layout(self, shift=0):
+    """
+    Returns the layout of the track as a tuple of *offsets* (moved by
+    *shift*), *counts*, *sample_sizes* and *sample_size*, as accepted by
+    #movrepair.fix_sample_tables().
+    """
+
+    offsets = array.array('q', (x + shift for x in self.offsets)) if shift else self.offsets
+    return offsets, self.counts, self.sample_sizes, self.sample_size
+
+
+def most_common(values):
+  return collections.Counter(values).most_common(1)[0][0]
+
+
+def find_tracks(moov):
+  """
+  Returns the audio and the video track of the `moov` #MovAtomD of the
+  reference file, as `(index, data_format, model)` tuples, where *model* is
+  the #movtables.ChunkModel of the track. Raises a #DetectError unless there
+  is exactly one PCM audio track and one other track (timecode tracks are
+  ignored).
+  """
+
+  audio, video = [], []
+  for index, trak in enumerate(moov.find_atoms(b'trak')):
+    tables = movtables.TrackTables(trak)
+    if tables.data_format == b'tmcd':
+      continue
+    model = movtables.ChunkModel.from_tables(tables)
+    if tables.data_format in PCM_FORMATS and model.sample_size:
+      audio.append((index, tables.data_format, model))
+    else:
+      video.append((index, tables.data_format, model))
+  if len(audio) != 1 or len(video) != 1:
+    raise DetectError('need exactly one PCM audio and one video track, found {} and {}'
+      .format(len(audio), len(video)))
+  return audio[0], video[0]
+
+
+def median(values):
+  values = sorted(values)
+  return values[len(values) // 2]
+
+
+def smooth_flags(data, frame_size):
+  """
+  Returns a byte string that is 1 at every offset of *data* whose byte is
+  close to the byte one frame later (see #QUANTIZERS), and 0 elsewhere. The
+  bytes are compared as big integers, so that no Python loop over them is
+  needed.
+  """
+
+  length = len(data) - frame_size
+  result = 0
+  for table in QUANTIZERS:
+    data_q = data.translate(table)
+    diff = int.from_bytes(data_q[frame_size:], 'big') ^ int.from_bytes(data_q[:length], 'big')
+    result |= int.from_bytes(diff.to_bytes(length, 'big').translate(IS_ZERO), 'big')
+  return result.to_bytes(length, 'big')
+
+
+def smoothness(data, frame_size):
+  """
+  Returns the fraction of smooth samples in *data* for the phase of the
+  frame that is smoothest, which is close to one for PCM audio (where it is
+  the phase of the most significant byte of a channel).
+  """
+
+  npairs = len(data) // frame_size - 1
+  if npairs < 1:
+    return 0.0
+  flags = smooth_flags(data, frame_size)
+  return max(flags[phase::frame_size].count(1) for phase in range(frame_size)) / npairs
+
+
+class InterleaveDetector(object):
+  """
+  Classifies the data between *begin* and *end* of the #FileView *view* as
+  PCM audio with the *data_format* and *frame_size* (the size of a sample of
+  all channels) or video, see #scan(). If the video frames start with a
+  marker, *video_marker* is a `(marker, offset)` tuple (see
+  #FRAME_MARKERS).
+  """
+
+  def __init__(self, view, begin, end, data_format, frame_size, block_size=DEFAULT_BLOCK_SIZE,
+               video_marker=None):
+    self.view = view
+    self.begin = begin
+    self.end = end
+    self.frame_size = frame_size
+    self.width, msb = PCM_FORMATS[data_format]
+    if frame_size % self.width:
+      raise DetectError('{!r} frame size {} is not a multiple of {}'.format(
+        data_format, frame_size, self.width))
+    self.byteorder = 'big' if msb == 0 else 'little'
+    self.channel_offsets = range(0, frame_size, self.width)
+    self.block_size = max(block_size, PROBE_FRAMES * frame_size)
+    self.video_marker = video_marker
+    self.probes = 0
+
+  def is_audio(self, offset, nframes=PROBE_FRAMES):
+    self.probes += 1
+    data = self.view.read(offset, min(nframes * self.frame_size, self.end - offset))
+    return smoothness(data, self.frame_size) >= AUDIO_THRESHOLD
+
+  def bisect(self, lo, hi, label):
+    """
+    Narrows down the boundary between the probes at *lo* (which has the
+    *label*) and at *hi* (which has not). Returns the approximate offset of
+    the boundary.
+    """
+
+    while hi - lo > self.frame_size:
+      mid = (lo + hi) // 2
+      if self.is_audio(mid, BISECT_FRAMES) == label:
+        lo = mid
+      else:
+        hi = mid
+    # The probes in which the boundary lies in the middle are ambiguous.
+    return min(lo + BISECT_FRAMES * self.frame_size // 2, self.end)
+
+  def refine(self, approx, starts_audio):
+    """
+    Returns the exact offset of the boundary near *approx* at which the
+    audio starts (if *starts_audio* is #True) or ends. Audio is predictable
+    from the previous samples, so the second differences of the samples of
+    every channel are small, while those of video data are uniformly
+    distributed. Every candidate offset is scored by the log-likelihood
+    ratio of these two models for the samples it assigns to the audio.
+
+    Returns the offset and a dictionary of the scores of all candidates.
+    """
+
+    frame_size = self.frame_size
+    span = EDGE_FRAMES * frame_size
+    radius = 2 * BISECT_FRAMES * frame_size
+    lo = max(self.begin, approx - radius)
+    hi = min(self.end, approx + radius)
+    base = max(self.begin, lo - span - 3 * frame_size)
+    data = self.view.read(base, min(self.end, hi + span + 3 * frame_size) - base)
+    values = [int.from_bytes(data[i:i + self.width], self.byteorder, signed=True)
+      for i in range(len(data) - self.width + 1)]
+    # residuals[i] is the second difference of the samples at i.
+    residuals = [abs(a - 2 * b + c) for a, b, c in
+      zip(values, values[frame_size:], values[2 * frame_size:])]
+    if not residuals:
+      return approx, {approx: 0}
+
+    # The scale of the residuals of the audio, estimated from the phases of
+    # the frame that are the smoothest on the audio side of the window.
+    if starts_audio:
+      region = residuals[hi - base:hi - base + span]
+    else:
+      region = residuals[max(0, lo - base - span - 2 * frame_size):max(0, lo - base - 2 * frame_size)]
+    medians = sorted(median(region[phase::frame_size] or [0]) for phase in range(frame_size))
+    scale = max(1.0, medians[len(self.channel_offsets) - 1])
+    offset_llr = 8 * self.width * math.log(2) - math.log(2 * scale)
+    llr = [offset_llr - x / scale for x in residuals]
+
+    # The sums of the ratios of every channel from (or up to) every offset,
+    # padded with zeros for the channels that lie outside of the window.
+    totals = list(llr)
+    if starts_audio:
+      for index in range(len(totals) - frame_size - 1, -1, -1):
+        totals[index] += totals[index + frame_size]
+      # The residuals that start at the candidate or after it.
+      pad = 0
+    else:
+      for index in range(frame_size, len(totals)):
+        totals[index] += totals[index - frame_size]
+      # The residuals that only include samples before the end.
+      pad = 3 * frame_size
+    totals = [0.0] * pad + totals + [0.0] * (3 * frame_size + self.width)
+
+    first = lo - base - (0 if starts_audio else 3 * frame_size) + pad
+    count = hi - lo + 1
+    columns = [totals[first + x:first + x + count] for x in self.channel_offsets]
+    candidates = list(map(sum, zip(*columns)))
+    best_score = max(candidates)
+    if starts_audio:
+      best = lo + candidates.index(best_score)
+    else:
+      best = hi - candidates[::-1].index(best_score)
+    return best, dict(zip(range(lo, hi + 1), candidates))
+
+  def snap(self, runs):
+    """
+    Moves the starts of the video *runs* to the #video_marker if it is
+    found within a frame of audio samples, as the marker may also look like
+    the continuation of quiet audio. Returns the set of the offsets at which
+    the marker was found.
+    """
+
+    found_at = set()
+    if self.video_marker is None:
+      return found_at
+    marker, marker_offset = self.video_marker
+    for index in range(1, len(runs)):
+      is_audio, begin, end = runs[index]
+      if is_audio:
+        continue
+      lo = max(runs[index - 1][1], begin - self.frame_size)
+      data = self.view.read(lo + marker_offset, begin + self.frame_size - lo + len(marker))
+      found = data.find(marker)
+      if found >= 0:
+        found_at.add(lo + found)
+        runs[index] = (is_audio, lo + found, end)
+        runs[index - 1] = runs[index - 1][:2] + (lo + found,)
+    return found_at
+
+  def align(self, runs, scores, fixed=()):
+    """
+    Moves the boundaries of the audio *runs* whose length is not a multiple
+    of the frame size, which happens if a sample of video data fits the
+    audio by chance. Of the boundaries of the run that are not *fixed*, the
+    one whose score (in the dictionary *scores* by offset, see #refine())
+    drops the least is moved.
+    """
+
+    frame_size = self.frame_size
+    for index, (is_audio, begin, end) in enumerate(runs):
+      rest = (end - begin) % frame_size
+      if not is_audio or not rest or end == self.end:
+        continue
+      options = []
+      for new_begin, new_end in ((begin + rest, end), (begin - frame_size + rest, end),
+                                 (begin, end - rest), (begin, end + frame_size - rest)):
+        loss = 0
+        for old, new in ((begin, new_begin), (end, new_end)):
+          if old != new:
+            if old in fixed or new not in scores.get(old, ()):
+              break
+            loss += scores[old][old] - scores[old][new]
+        else:
+          options.append((loss, new_begin, new_end))
+      if not options:
+        continue
+      loss, begin, end = min(options)
+      runs[index] = (is_audio, begin, end)
+      if index > 0:
+        runs[index - 1] = runs[index - 1][:2] + (begin,)
+      if index + 1 < len(runs):
+        runs[index + 1] = (runs[index + 1][0], end, runs[index + 1][2])
+
+  def scan(self):
+    """
+    Returns a list of `(is_audio, begin, end)` tuples for the runs of audio
+    and video data between #begin and #end.
+    """
+
+    offsets = list(range(self.begin, self.end, self.block_size))
+    labels = [self.is_audio(x) for x in offsets]
+    runs = []
+    scores = {}
+    start = self.begin
+    for index in range(1, len(offsets)):
+      label = labels[index - 1]
+      if labels[index] == label:
+        continue
+      approx = self.bisect(offsets[index - 1], offsets[index], label)
+      boundary, scores[boundary] = self.refine(approx, starts_audio=not label)
+      if start < boundary < self.end:
+        runs.append((label, start, boundary))
+        start = boundary
+    if offsets and start < self.end:
+      runs.append((labels[-1], start, self.end))
+
+    # Merge the runs that a misplaced boundary left with the same label.
+    merged = []
+    for label, begin, end in runs:
+      if merged and merged[-1][0] == label:
+        merged[-1] = (label, merged[-1][1], end)
+      else:
+        merged.append((label, begin, end))
+    self.align(merged, scores, self.snap(merged))
+    return merged
+
+
+def split_audio(runs, frame_size, chunk_size):
+  """
+  Splits the audio *runs* into chunks of *chunk_size* bytes. Returns the
+  offsets of the chunks and their sample counts.
+  """
+
+  offsets, counts = array.array('q'), array.array('q')
+  for is_audio, begin, end in runs:
+    if not is_audio:
+      continue
+    end = begin + (end - begin) // frame_size * frame_size
+    for offset in range(begin, end, chunk_size):
+      offsets.append(offset)
+      counts.append((min(chunk_size, end - offset)) // frame_size)
+  return offsets, counts
+
+
+def find_frames(view, begin, end, marker, marker_offset, expected_size):
+  """
+  Returns the offsets of the frames between *begin* and *end* of the
+  #FileView *view* that start with the *marker* (at *marker_offset*). The
+  next frame is looked for after the size of the previous frame and after
+  *expected_size* bytes first, then the data is searched.
+  """
+
+  frames = [begin]
+  pos, size = begin, expected_size
+  while True:
+    guesses = [size, expected_size]
+    if marker_offset >= 4:
+      # ProRes frames start with their size.
+      guesses.insert(0, struct.unpack('>I', view.read(pos, 4).rjust(4, b'\0'))[0])
+    for guess in guesses:
+      if 0 < guess and pos + guess < end and \
+          view.read(pos + guess + marker_offset, len(marker)) == marker:
+        break
+    else:
+      found = view.find(marker, pos + 1 + marker_offset, end + marker_offset)
+      if found < 0 or found - marker_offset >= end:
+        return frames
+      guess = found - marker_offset - pos
+    pos, size = pos + guess, guess
+    frames.append(pos)
+
+
+def split_video(view, runs, data_format, model):
+  """
+  Splits the video *runs* into one chunk each. The frames in the chunks are
+  found by the #FRAME_MARKERS of the *data_format*. Otherwise their number
+  is estimated from the mean sample size of the reference #ChunkModel
+  *model* and the chunk is divided evenly, which keeps the chunk offsets
+  exact but not the sample sizes.
+
+  Returns the offsets of the chunks, their sample counts and the sizes of
+  the samples.
+  """
+
+  offsets, counts, sizes = array.array('q'), array.array('q'), array.array('q')
+  if model.sample_sizes is not None:
+    expected_size = most_common(model.sample_sizes[:model.sample_count])
+    mean_size = sum(model.sample_sizes[:model.sample_count]) / max(1, model.sample_count)
+  else:
+    expected_size = mean_size = model.sample_size
+  for is_audio, begin, end in runs:
+    if is_audio:
+      continue
+    if data_format in FRAME_MARKERS:
+      marker, marker_offset = FRAME_MARKERS[data_format]
+      frames = find_frames(view, begin, end, marker, marker_offset, expected_size)
+      frames.append(end)
+      frame_sizes = map(operator.sub, frames[1:], frames[:-1])
+    else:
+      count = max(1, int(round((end - begin) / max(1, mean_size))))
+      size = (end - begin) // count
+      frame_sizes = [size] * (count - 1) + [end - begin - size * (count - 1)]
+    offsets.append(begin)
+    before = len(sizes)
+    sizes.extend(frame_sizes)
+    counts.append(len(sizes) - before)
+  return offsets, counts, sizes
+
+
+def detect_layout(fp, mdat_begin, mdat_end, moov, block_size=None):
+  """
+  Detects the chunks of the audio and video track of the `moov` #MovAtomD
+  of the reference file in the data of the broken file *fp* between
+  *mdat_begin* and *mdat_end*. Returns a list of #DetectedTrack#s and the
+  list of runs returned by #InterleaveDetector.scan(). Raises a
+  #DetectError if the tracks are not supported (see #find_tracks()).
+  """
+
+  (audio_index, audio_format, audio_model), (video_index, video_format, video_model) = find_tracks(moov)
+  frame_size = audio_model.sample_size
+  chunk_size = most_common(audio_model.counts) * frame_size
+  if block_size is None:
+    # Every run should contain a probe, so that it is not missed.
+    video_chunks = video_model.counts
+    if video_model.sample_sizes is not None:
+      bounds = movtables.cumsum(video_model.counts)
+      video_sizes = movtables.cumsum(video_model.sample_sizes)
+      video_chunks = map(operator.sub, map(video_sizes.__getitem__, bounds[1:]),
+        map(video_sizes.__getitem__, bounds[:-1]))
+    else:
+      video_chunks = (count * video_model.sample_size for count in video_chunks)
+    smallest = min(min(audio_model.counts) * frame_size, min(video_chunks))
+    block_size = min(DEFAULT_BLOCK_SIZE, smallest // 2)
+
+  view = FileView(fp)
+  try:
+    detector = InterleaveDetector(view, mdat_begin, mdat_end, audio_format, frame_size,
+      block_size, FRAME_MARKERS.get(video_format))
+    runs = detector.scan()
+    offsets, counts = split_audio(runs, frame_size, chunk_size)
+    audio = DetectedTrack(audio_index, audio_format, offsets, counts, sample_size=frame_size)
+    offsets, counts, sizes = split_video(view, runs, video_format, video_model)
+    video = DetectedTrack(video_index, video_format, offsets, counts, sizes)
+  finally:
+    view.close()
+  return sorted([audio, video], key=lambda x: x.index), runs
+
+
+def main(argv=None):
+  import movrepair
+
+  parser = argparse.ArgumentParser(prog='movrepair.py detect',
+    description='Detect the interleaving of the PCM audio and video chunks in '
+      'the mdat of a broken file, using a working reference file for the '
+      'track formats.')
+  parser.add_argument('reference', help='A working video file.')
+  parser.add_argument('broken', help='The broken file.')
+  parser.add_argument('--block-size', type=movrepair.parse_size, metavar='SIZE',
+    help='The distance between the probes of the initial scan. Default: half '
+      'of the smallest chunk of the reference file, at most 64K')
+  parser.add_argument('-v', '--verbose', action='store_true',
+    help='Print every detected run of audio and video data.')
+  args = parser.parse_args(argv)
+
+  with open(args.reference, 'rb') as fp:
+    template = movrepair.ReferenceTemplate.load(fp)
+  moov = template.instantiate()[b'moov']
+  with open(args.broken, 'rb') as fp:
+    for atom in MovAtomR.make_root(fp).iter_atoms():
+      if atom.tag == b'mdat':
+        break
+    else:
+      print('error: could not find mdat atom in broken file')
+      return 1
+    mdat_begin = atom.atom_begin + atom.header_size
+    mdat_end = get_file_size_via_seek(fp)
+    tstart = time.time()
+    try:
+      tracks, runs = detect_layout(fp, mdat_begin, mdat_end, moov, args.block_size)
+    except DetectError as exc:
+      print('error:', exc)
+      return 1
+    elapsed = time.time() - tstart
+
+  if args.verbose:
+    for is_audio, begin, end in runs:
+      print('{} {:>12} {:>10}'.format('audio' if is_audio else 'video', begin, end - begin))
+  for track in tracks:
+    print('Track {} ({}): {} chunks, {} samples'.format(track.index,
+      track.data_format.decode('latin1'), len(track.offsets), sum(track.counts)))
+  print('Detected {} runs in {} of mdat in {:.2f}s ({}/s)'.format(len(runs),
+    movrepair.sizeof_fmt(mdat_end - mdat_begin), elapsed,
+    movrepair.sizeof_fmt((mdat_end - mdat_begin) / max(elapsed, 1e-6))))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,181 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Comparing the `moov` atoms of two files by their structure. Every atom is
+summarized by its #MovAtomD.fingerprint(), which is computed bottom-up from
+the fingerprints of its sub-atoms, so the subtrees that are equal in both
+files are skipped after comparing a single digest and only the atoms that
+differ are visited.
+
+The fingerprints ignore the entries of the sample tables and the times and
+durations in the header atoms (see #movio.FINGERPRINT_TABLES and
+#movio.FINGERPRINT_VOLATILE). Two files with the same fingerprint were
+recorded with the same settings, and one can be used as the reference file
+to repair the other.
+"""
+
+from movio import FINGERPRINT_TABLES, MovAtomR
+import argparse
+import binascii
+import collections
+import sys
+
+
+class DiffError(Exception):
+  pass
+
+
+def load_moov(fp):
+  """
+  Reads the `moov` atom of the file *fp* into a #MovAtomD. Raises a
+  #DiffError if the file has no `moov` atom.
+  """
+
+  for atom in MovAtomR.make_root(fp).iter_atoms():
+    if atom.tag == b'moov':
+      return atom.to_atomd()
+  raise DiffError('no moov atom found')
+
+
+def hex_fingerprint(atom):
+  return binascii.hexlify(atom.fingerprint()).decode('ascii')
+
+
+def group_atoms(atom):
+  """
+  Returns an ordered dictionary that maps the tags of the sub-atoms of the
+  #MovAtomD *atom* to lists of the sub-atoms with that tag.
+  """
+
+  groups = collections.OrderedDict()
+  for sub_atom in atom.iter_atoms():
+    groups.setdefault(sub_atom.tag, []).append(sub_atom)
+  return groups
+
+
+def diff(a, b, path=None):
+  """
+  Compares the #MovAtomD#s *a* and *b* and yields a `(status, path, a, b)`
+  tuple for every atom that differs: `'-'` for atoms that only exist in *a*,
+  `'+'` for atoms that only exist in *b* and `'~'` for atoms that exist in
+  both but differ in their data (the missing atom is #None). The sub-atoms
+  with the same tag are matched in their order, their paths include the
+  index (eg. `moov/trak[1]/tkhd`) if there are more than one of them in
+  either file.
+  """
+
+  if path is None:
+    path = a.tag.decode('latin1')
+  if a.fingerprint() == b.fingerprint():
+    return
+  if a.is_leaf() or b.is_leaf():
+    yield '~', path, a, b
+    return
+
+  groups_a, groups_b = group_atoms(a), group_atoms(b)
+  tags = list(groups_a) + [tag for tag in groups_b if tag not in groups_a]
+  for tag in tags:
+    atoms_a, atoms_b = groups_a.get(tag, []), groups_b.get(tag, [])
+    for index in range(max(len(atoms_a), len(atoms_b))):
+      sub_path = path + '/' + tag.decode('latin1')
+      if max(len(atoms_a), len(atoms_b)) > 1:
+        sub_path += '[{}]'.format(index)
+      if index >= len(atoms_b):
+        yield '-', sub_path, atoms_a[index], None
+      elif index >= len(atoms_a):
+        yield '+', sub_path, None, atoms_b[index]
+      else:
+        for item in diff(atoms_a[index], atoms_b[index], sub_path):
+          yield item
+
+
+def diff_fields(a, b):
+  """
+  Unpacks the leaf #MovAtomD#s *a* and *b* with their struct from #movatoms
+  and yields a `(name, value_a, value_b)` tuple for every field that
+  differs. Yields nothing if there is no struct for the atoms. The entries
+  of the sample tables are not compared.
+  """
+
+  import movatoms
+  import movquery
+
+  struct_type = movquery.get_struct_type(a.tag)
+  if struct_type is None:
+    return
+  values = []
+  for atom in (a, b):
+    # The struct of some atoms depends on the size in the atom header.
+    reader = MovAtomR(bytes(atom.data))
+    reader.size = atom.calculate_size()
+    ctx = movatoms.SubAtomsUnpackContext(reader, struct_type)
+    values.append(struct_type.unpack(bytes(atom.data), ctx))
+  for field in struct_type._visible_fields_:
+    if a.tag in FINGERPRINT_TABLES and field.name == 'table':
+      continue
+    value_a = movquery.to_plain(getattr(values[0], field.name))
+    value_b = movquery.to_plain(getattr(values[1], field.name))
+    if value_a != value_b:
+      yield field.name, value_a, value_b
+
+
+def main(argv=None):
+  import movrepair
+
+  parser = argparse.ArgumentParser(prog='movrepair.py diff',
+    description='Compare the structure of the moov atoms of two files and '
+      'list the atoms that differ. Sample tables are compared by their shape '
+      'only, times and durations are ignored.')
+  parser.add_argument('a', help='The first file.')
+  parser.add_argument('b', help='The second file.')
+  parser.add_argument('-f', '--fields', action='store_true',
+    help='Also print the fields of the changed atoms that differ.')
+  parser.add_argument('--fingerprint', action='store_true',
+    help='Print the fingerprints of the moov atoms of both files.')
+  args = parser.parse_args(argv)
+  if args.a == '-' and args.b == '-':
+    parser.error('only one file can be read from stdin')
+
+  moovs = []
+  for filename in (args.a, args.b):
+    with movrepair.open_file(filename, 'rb') as fp:
+      try:
+        moovs.append(load_moov(fp))
+      except DiffError as exc:
+        print('error: {}: {}'.format(filename, exc), file=sys.stderr)
+        return 2
+
+  if args.fingerprint:
+    for filename, moov in zip((args.a, args.b), moovs):
+      print('{}  {}'.format(hex_fingerprint(moov), filename))
+  status = 0
+  for status_char, path, atom_a, atom_b in diff(*moovs):
+    status = 1
+    print(status_char, path)
+    if args.fields and status_char == '~':
+      for name, value_a, value_b in diff_fields(atom_a, atom_b):
+        print('    {}: {!r} != {!r}'.format(name, value_a, value_b))
+  return status
+
+
+if __name__ == '__main__':
+  sys.exit(main())
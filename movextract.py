@@ -0,0 +1,268 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Extracting a time range of a file into a new file without re-muxing it. The
+range is aligned to the sync sample (keyframe) of the video track at or
+before its start. Only the samples of the range are read from the sample
+tables (via slices of the lazy #movutils.TableView#s) and only their bytes
+are copied, so the cost of an extraction depends on the length of the range
+rather than the length of the file.
+"""
+
+from movio import MovAtomR, MovAtomW, get_header_size, preallocate
+import array
+import bisect
+import itertools
+import math
+import operator
+import struct
+
+import movatoms
+import movcopy
+import movtables
+
+
+class TrackSegment(object):
+  """
+  The samples *first* to *stop* (exclusive) of a track, described by its
+  #movtables.TrackTables *tables*. The samples are located in the chunks of
+  the track; every chunk that contains samples of the segment becomes one
+  #pieces (a `(offset, length)` tuple of the bytes to copy from the file).
+  """
+
+  def __init__(self, tables, first, stop):
+    self.tables = tables
+    self.first = first
+    self.stop = stop
+    self.pieces = []
+    self.counts = self.descriptions = None
+    self.sample_sizes = array.array('q') if tables.stsz.size == 0 else None
+    if stop <= first:
+      return
+
+    stsc = tables.stsc.table
+    chunk, chunk_first = movtables.locate_sample(stsc, first)
+    last_chunk = movtables.locate_sample(stsc, stop - 1)[0]
+    table = stsc.toarray()
+    self.counts = movtables.expand_runs(table[0::3], table[1::3], last_chunk + 1, chunk)
+    self.descriptions = movtables.expand_runs(table[0::3], table[2::3], last_chunk + 1, chunk)
+
+    # The byte offsets of the samples relative to the first sample of the
+    # first chunk, up to the end of the last chunk.
+    end = chunk_first + sum(self.counts)
+    if tables.stsz.size != 0:
+      size = tables.stsz.size
+      bounds = array.array('q', range(0, (end - chunk_first + 1) * size, size))
+    else:
+      sizes = tables.stsz.table[chunk_first:end].toarray()
+      bounds = movtables.cumsum(sizes)
+      self.sample_sizes = sizes[first - chunk_first:stop - chunk_first]
+
+    # The samples of the chunks, with the first and last chunk cut at the
+    # bounds of the segment.
+    firsts = movtables.cumsum(self.counts)
+    ends = firsts[1:]
+    firsts = firsts[:-1]
+    firsts[0] = first - chunk_first
+    ends[-1] = stop - chunk_first
+    self.counts = array.array('q', map(operator.sub, ends, firsts))
+    offsets = tables.stco.table[chunk:last_chunk + 1].toarray()
+    starts = array.array('q', map(bounds.__getitem__, firsts))
+    self.pieces = list(zip(
+      itertools.chain((offsets[0] + starts[0],), offsets[1:]),
+      map(operator.sub, map(bounds.__getitem__, ends), starts)))
+
+  @property
+  def sample_count(self):
+    return max(0, self.stop - self.first)
+
+  def update(self, chunk_offsets):
+    """
+    Replaces the sample tables of the track with the ones of the segment,
+    whose chunks are at the *chunk_offsets* in the new file. Returns the new
+    duration of the track in its media time scale.
+    """
+
+    tables = self.tables
+    stbl = tables.stbl
+    first, stop = self.first, self.stop
+
+    def update(tag, data):
+      stbl.find_atoms(tag)[0].data = data
+
+    model = movtables.ChunkModel(chunk_offsets, self.counts or (), self.descriptions or (),
+      self.sample_sizes, tables.stsz.size)
+    for tag, data in model.pack(tables.stsc, tables.stco, tables.stsz):
+      if tag in (b'stco', b'co64'):
+        # The chunk offsets may have moved to a co64 atom.
+        tables.stco_atom.tag, tables.stco_atom.data = tag, data
+      else:
+        update(tag, data)
+
+    tables.stts.table = movtables.slice_runs(tables.stts.table, first, stop)
+    update(b'stts', tables.stts.pack())
+
+    for atom in stbl.find_atoms(b'ctts') + stbl.find_atoms(b'sbgp'):
+      struct_type = getattr(movatoms, atom.tag.decode('ascii'))
+      obj = struct_type.unpack(atom.data)
+      obj.table = movtables.slice_runs(obj.table, first, stop)
+      atom.data = obj.pack()
+    for atom in stbl.find_atoms(b'stss') + stbl.find_atoms(b'stps'):
+      struct_type = getattr(movatoms, atom.tag.decode('ascii'))
+      obj = struct_type.unpack(atom.data)
+      view = obj.table
+      numbers = view[bisect.bisect_left(view, first + 1):bisect.bisect_left(view, stop + 1)]
+      obj.table = movtables.TableView.fromarray(view.fmt,
+        map(operator.sub, numbers.toarray(), itertools.repeat(first)))
+      atom.data = obj.pack()
+    for atom in stbl.find_atoms(b'sdtp'):
+      obj = movatoms.sdtp.unpack(atom.data)
+      obj.table = obj.table[first:stop]
+      atom.data = obj.pack()
+    # These describe the samples of the whole track.
+    for atom in stbl.find_atoms(b'cslg') + stbl.find_atoms(b'stsh'):
+      stbl.atoms.remove(atom)
+    stbl.invalidate()
+
+    duration = sum(itertools.starmap(operator.mul, tables.stts.table))
+    tables.trak.find_atoms(b'mdia', b'mdhd')[0].edit()[16:20] = struct.pack('>I', duration)
+    return duration
+
+
+def find_segments(moov, start, end):
+  """
+  Finds the samples of every track in the `moov` #MovAtomD between the times
+  *start* and *end* (in seconds, *end* may be #None for the end of the
+  file). The start is moved to the last sync sample at or before it in the
+  first track that has an `stss` atom. Returns the aligned start time and
+  a list of #TrackSegment#s.
+
+  Raises a #ValueError if *start* is not before the end of the file or
+  *end* is not after *start*.
+  """
+
+  time_scale, duration = struct.unpack('>II', moov.find_atoms(b'mvhd')[0].data[12:20])
+  if start >= duration / time_scale:
+    raise ValueError('the start time {}s is at or past the end of the file ({}s)'.format(
+      start, duration / time_scale))
+  if end is not None and end <= start:
+    raise ValueError('the end time {}s is not after the start time {}s'.format(end, start))
+
+  tracks = [movtables.TrackTables(trak) for trak in moov.find_atoms(b'trak')]
+  sync = next((x for x in tracks if x.stss is not None), None)
+  if sync is not None:
+    sample = movtables.sample_at_time(sync.stts.table, int(start * sync.time_scale))[0]
+    view = sync.stss.table
+    index = bisect.bisect_right(view, sample + 1) - 1
+    keyframe = view[index] - 1 if index >= 0 else 0
+    start = movtables.sample_time(sync.stts.table, keyframe) / sync.time_scale
+
+  segments = []
+  for tables in tracks:
+    count = tables.sample_count
+    if count is None:
+      count = sum(x[0] for x in tables.stts.table)
+    first = movtables.sample_at_time(tables.stts.table, int(start * tables.time_scale))[0]
+    stop = count
+    if end is not None:
+      time = int(math.ceil(end * tables.time_scale))
+      sample, sample_start = movtables.sample_at_time(tables.stts.table, time)
+      stop = min(count, sample + 1 if sample_start < time else sample)
+    segments.append(TrackSegment(tables, min(first, count), stop))
+  return start, segments
+
+
+def extract_segment(fp, output, start, end=None):
+  """
+  Writes the time range *start* to *end* (in seconds) of the file *fp* to
+  the file *output*, see #find_segments(). The atoms before the `mdat` atom
+  are copied, the `moov` atom is written after the `mdat`. Returns the
+  aligned start time and the duration of the extracted range.
+  """
+
+  leading = []
+  moov = None
+  for atom in MovAtomR.make_root(fp).iter_atoms():
+    if atom.tag == b'moov':
+      moov = atom.to_atomd()
+    elif atom.tag not in (b'mdat', b'free', b'skip'):
+      leading.append(atom.to_atomd())
+  if moov is None:
+    raise ValueError('the file has no moov atom')
+
+  start, segments = find_segments(moov, start, end)
+
+  # Copy the pieces of all tracks in the order of the file, so that the
+  # tracks stay interleaved and the file is read sequentially. Adjacent
+  # pieces are copied at once.
+  pieces = sorted((offset, length, index, chunk)
+    for index, segment in enumerate(segments)
+    for chunk, (offset, length) in enumerate(segment.pieces))
+  data_size = sum(x[1] for x in pieces)
+  header_size = get_header_size(data_size)
+  data_begin = sum(atom.calculate_size() for atom in leading) + header_size
+  chunk_offsets = [array.array('q', bytes(8 * len(x.pieces))) for x in segments]
+  ranges = []
+  position = data_begin
+  for offset, length, index, chunk in pieces:
+    chunk_offsets[index][chunk] = position
+    if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+      ranges[-1][1] += length
+    else:
+      ranges.append([offset, length])
+    position += length
+
+  durations = [segment.update(offsets) for segment, offsets in zip(segments, chunk_offsets)]
+  update_durations(moov, durations)
+
+  preallocate(output, data_begin + data_size + moov.calculate_size())
+  for atom in leading:
+    atom.write(output)
+  writer = MovAtomW(output, header_size + data_size, b'mdat')
+  for offset, length in ranges:
+    writer.bytes_written += movcopy.copy_range(fp, output, offset, length)
+  writer.finalize()
+  moov.write(output)
+
+  time_scale, duration = struct.unpack('>II', moov.find_atoms(b'mvhd')[0].data[12:20])
+  return start, duration / time_scale
+
+
+def update_durations(moov, durations):
+  """
+  Sets the durations of the `tkhd` atoms and edit lists of the tracks in
+  the `moov` #MovAtomD from their new media *durations* and the duration
+  of the `mvhd` atom to the longest track.
+  """
+
+  mvhd = moov.find_atoms(b'mvhd')[0]
+  movie_scale = struct.unpack('>I', mvhd.data[12:16])[0]
+  longest = 0
+  for trak, media_duration in zip(moov.find_atoms(b'trak'), durations):
+    time_scale = struct.unpack('>I', trak.find_atoms(b'mdia', b'mdhd')[0].data[12:16])[0]
+    duration = (media_duration * movie_scale + time_scale - 1) // time_scale
+    trak.find_atoms(b'tkhd')[0].edit()[20:24] = struct.pack('>I', duration)
+    # Like #movrepair.fix_metadata(), assume one entry in the edit list.
+    for elst in trak.find_atoms(b'edts', b'elst'):
+      elst.edit()[8:12] = struct.pack('>I', duration)
+    longest = max(longest, duration)
+  mvhd.edit()[16:20] = struct.pack('>I', longest)
@@ -0,0 +1,264 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Repairing a broken file that is still being written to (eg. by a recovery
+process after a crash). The file is repaired once, then the data that is
+appended to the broken file's `mdat` is copied to the end of the output
+file's `mdat` and the `moov` after it is rewritten. The sample tables of the
+tracks are extended from where they were the last time, instead of from the
+reference file.
+
+The `mdat` atom is preceded by an empty `wide` atom (like in the files that
+QuickTime writes), which its header grows into when the size of the `mdat`
+exceeds 32 bits.
+"""
+
+from movio import get_file_size_via_seek, get_header_size
+import collections
+import struct
+import time
+
+import movatoms
+import movcopy
+import movrepair
+import movtables
+
+#: The tags of the empty atoms before the `mdat` atom that its header can
+#: grow into, in the order of preference.
+PADDING_TAGS = (b'wide', b'free', b'skip')
+
+
+class TrackState(object):
+  """
+  The unpacked sample tables and #movtables.ChunkModel of a track in the
+  output file's `moov` atom. *reference_chunks* is the number of chunks of
+  the track in the reference file.
+  """
+
+  def __init__(self, trak, reference_chunks):
+    self.trak = trak
+    self.reference_chunks = reference_chunks
+    self.mdhd = trak.find_atoms(b'mdia', b'mdhd')[0]
+    stbl = trak.find_atoms(b'mdia', b'minf', b'stbl')[0]
+    self.table_atoms = {atom.tag: atom for atom in stbl.iter_atoms()
+      if atom.tag in movrepair.SAMPLE_TABLE_TAGS}
+    self.atoms = {tag: getattr(movatoms, tag.decode('ascii')).unpack(atom.data)
+      for tag, atom in self.table_atoms.items()}
+    self.stco_tag = b'co64' if b'co64' in self.atoms else b'stco'
+    self.model = movtables.ChunkModel.from_atoms(self.atoms[b'stsc'],
+      self.atoms[self.stco_tag], self.atoms[b'stsz'])
+
+  def update(self, scale_factor):
+    """
+    Extends the tables of the track to the chunks of the reference file,
+    scaled by *scale_factor*. Returns #True if the tables were extended.
+    """
+
+    nchunks = int(self.reference_chunks * scale_factor)
+    if nchunks <= len(self.model):
+      return False
+    updated = movtables.extend_tables(self.model, self.atoms, nchunks)
+    if b'stco' in updated:
+      # The chunk offsets move to a co64 atom once they exceed 32 bits.
+      for tag, data in self.model.pack(self.atoms[b'stsc'], self.atoms[self.stco_tag],
+          self.atoms[b'stsz']):
+        atom = self.table_atoms[self.stco_tag if tag in (b'stco', b'co64') else tag]
+        atom.tag, atom.data = tag, data
+    for tag in updated:
+      if tag not in (b'stsc', b'stco', b'stsz'):
+        self.table_atoms[tag].data = self.atoms[tag].pack()
+    duration = sum(count * delta for count, delta in self.atoms[b'stts'].table)
+    self.mdhd.edit()[16:20] = struct.pack('>I', duration)
+    return True
+
+
+class FollowRepair(object):
+  """
+  Keeps the *output* file, which was repaired from the *broken* file with
+  the #movrepair.RepairPlan *plan*, up to date with the data that is
+  appended to the broken file. *template* is the #movrepair.ReferenceTemplate
+  that the plan was created from.
+  """
+
+  def __init__(self, template, plan, broken, output):
+    self.plan = plan
+    self.broken = broken
+    self.output = output
+    self.data_size = plan.mdat_data_size
+    self.data_offset = plan.output_data_offset
+    self.reference_mdat_size = template.mdat_size
+
+    tags = [atom.tag for atom in plan.atoms]
+    index = tags.index(b'mdat')
+    self.trailing_atoms = plan.atoms[index + 1:]
+    self.moov = plan.atoms[tags.index(b'moov')]
+
+    # The number of chunks of every track in the reference file, by track ID.
+    reference_moov = template.instantiate()[b'moov']
+    self.reference_duration = struct.unpack('>I',
+      reference_moov.find_atoms(b'mvhd')[0].data[16:20])[0]
+    reference_chunks = {}
+    for trak in reference_moov.find_atoms(b'trak'):
+      stbl = trak.find_atoms(b'mdia', b'minf', b'stbl')[0]
+      stco = (stbl.find_atoms(b'stco') or stbl.find_atoms(b'co64'))[0]
+      reference_chunks[get_track_id(trak)] = struct.unpack('>I', stco.data[4:8])[0]
+    self.tracks = [TrackState(trak, reference_chunks[get_track_id(trak)])
+      for trak in self.moov.find_atoms(b'trak')]
+
+  @property
+  def mdat_size(self):
+    return self.data_size + get_header_size(self.data_size)
+
+  @property
+  def duration(self):
+    time_scale, duration = struct.unpack('>II', self.moov.find_atoms(b'mvhd')[0].data[12:20])
+    return duration / float(time_scale)
+
+  def poll(self):
+    """
+    Appends the data that was written to the broken file since the last call
+    to the output file and rewrites the atoms after the `mdat`. Returns the
+    number of appended bytes.
+    """
+
+    plan = self.plan
+    data_size = get_file_size_via_seek(self.broken) - plan.mdat_offset - plan.mdat_header_size
+    if data_size <= self.data_size:
+      return 0
+
+    # The new data overwrites the atoms after the mdat, which are written
+    # again afterwards.
+    self.broken.seek(plan.mdat_offset + plan.mdat_header_size + self.data_size)
+    self.output.seek(self.data_offset + self.data_size)
+    remaining = data_size - self.data_size
+    while remaining > 0:
+      data = self.broken.read(min(remaining, movcopy.COPY_CHUNKSIZE))
+      if not data:
+        break
+      self.output.write(data)
+      remaining -= len(data)
+    nbytes = data_size - self.data_size - remaining
+    self.data_size += nbytes
+
+    self.update_moov()
+    for atom in self.trailing_atoms:
+      atom.write(self.output)
+    self.output.truncate()
+    self.write_mdat_header()
+    self.output.flush()
+    return nbytes
+
+  def write_mdat_header(self):
+    """
+    Updates the size in the header of the `mdat` atom. Once the size needs
+    64 bits, the header takes the place of the `wide` atom before it (see
+    #reserve_header()), so the data of the `mdat` stays in place.
+    """
+
+    header_size = get_header_size(self.data_size)
+    self.output.seek(self.data_offset - header_size)
+    if header_size == 16:
+      self.output.write(struct.pack('>I4sQ', 1, b'mdat', self.mdat_size))
+    else:
+      self.output.write(struct.pack('>I4s', self.mdat_size, b'mdat'))
+
+  def update_moov(self):
+    """
+    Extends the sample tables and durations in the `moov` atom for the
+    current size of the `mdat`.
+    """
+
+    scale_factor = self.mdat_size / float(self.reference_mdat_size)
+    if not any([track.update(scale_factor) for track in self.tracks]):
+      return
+    duration = struct.pack('>I', int(scale_factor * self.reference_duration))
+    self.moov.find_atoms(b'mvhd')[0].edit()[16:20] = duration
+    for tkhd in self.moov.find_atoms(b'trak', b'tkhd'):
+      tkhd.edit()[20:24] = duration
+    # fix_metadata() leaves a single entry in the edit lists.
+    for elst in self.moov.find_atoms(b'trak', b'edts', b'elst'):
+      elst.edit()[8:12] = duration
+
+  def run(self, interval=2.0, idle_timeout=60.0):
+    """
+    Calls #poll() every *interval* seconds until the broken file did not
+    grow for *idle_timeout* seconds or the process is interrupted.
+    """
+
+    last_change = time.time()
+    try:
+      while time.time() - last_change < idle_timeout:
+        time.sleep(interval)
+        nbytes = self.poll()
+        if nbytes:
+          last_change = time.time()
+          print('Appended {}, mdat size: {}, duration: {}s'.format(
+            movrepair.sizeof_fmt(nbytes), movrepair.sizeof_fmt(self.mdat_size),
+            self.duration))
+    except KeyboardInterrupt:
+      print('Stopped following')
+      return
+    print('Stopped following, the broken file did not grow for {}s'.format(idle_timeout))
+
+
+def reserve_header(template):
+  """
+  Inserts an empty `wide` atom (or another one of the #PADDING_TAGS) before
+  the `mdat` atom of the #movrepair.ReferenceTemplate *template*, unless it
+  already has one there. The chunk offsets are moved accordingly when the
+  repair is planned.
+  """
+
+  tags = list(template.atoms)
+  index = tags.index(b'mdat')
+  if index > 0 and tags[index - 1] in PADDING_TAGS and not template.atoms[tags[index - 1]]:
+    return
+  tag = next(x for x in PADDING_TAGS if x not in template.atoms)
+  tags.insert(index, tag)
+  template.atoms = collections.OrderedDict((x, template.atoms.get(x, b'')) for x in tags)
+
+
+def get_track_id(trak):
+  return struct.unpack('>I', trak.find_atoms(b'tkhd')[0].data[12:16])[0]
+
+
+def follow_file(reference, broken, output, interval=2.0, idle_timeout=60.0,
+                jobs=1, **kwargs):
+  """
+  Repairs the *broken* file using the *reference* file (all filenames) and
+  keeps following it with #FollowRepair. Additional keyword arguments are
+  passed to #movrepair.execute_plan().
+  """
+
+  with open(reference, 'rb') as fp:
+    template = movrepair.ReferenceTemplate.load(fp)
+  reserve_header(template)
+  with open(broken, 'rb') as broken_fp, open(output, 'w+b') as output_fp:
+    plan = movrepair.plan_repair(template, broken_fp, jobs=jobs)
+    if plan is None:
+      return 1
+    result = movrepair.execute_plan(plan, broken_fp, output_fp, **kwargs)
+    if result != 0:
+      return result
+    print('Following {} (press Ctrl+C to stop)'.format(broken))
+    FollowRepair(template, plan, broken_fp, output_fp).run(interval, idle_timeout)
+  return 0
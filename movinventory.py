@@ -0,0 +1,248 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Scanning directory trees of files and writing an inventory of their atoms
+and the most important facts of their `moov` atom (duration, tracks and
+codecs) as JSON Lines or CSV. Only the atom headers and the small atoms of
+the `moov` are read; the sample tables and the `mdat` data are skipped
+(unless the fingerprint of the `moov` is requested, which reads all of it).
+Files are scanned in a bounded thread pool, so that the latency of the
+reads of many files on network storage overlaps.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from movio import MovAtomR, MovFileError, get_file_size_via_seek
+from movutils import UnpackError
+import argparse
+import binascii
+import collections
+import csv
+import fnmatch
+import json
+import os
+import struct
+import sys
+import time
+
+import movatoms
+
+#: The default file name patterns of #find_files().
+DEFAULT_PATTERNS = ['*.mov', '*.mp4', '*.m4v']
+
+#: The container atoms of the `moov` that #scan_moov() descends into.
+CONTAINER_TAGS = frozenset([b'trak', b'mdia', b'minf', b'stbl'])
+
+#: The columns of the CSV output, see #to_csv_row().
+CSV_COLUMNS = ['path', 'size', 'atoms', 'moov_missing', 'mdat_truncated',
+  'duration', 'tracks', 'codecs', 'fingerprint', 'error']
+
+
+def find_files(paths, patterns=DEFAULT_PATTERNS):
+  """
+  Yields the names of the files in the directory trees *paths* whose names
+  match one of the *patterns* (case-insensitive). Paths of files are yielded
+  as they are.
+  """
+
+  patterns = [x.lower() for x in patterns]
+  for path in paths:
+    if not os.path.isdir(path):
+      yield path
+      continue
+    for root, dirs, files in os.walk(path):
+      dirs.sort()
+      for name in sorted(files):
+        if any(fnmatch.fnmatch(name.lower(), x) for x in patterns):
+          yield os.path.join(root, name)
+
+
+def scan_track(trak):
+  """
+  Reads the facts of the #MovAtomR *trak* atom into a dictionary.
+  """
+
+  track = collections.OrderedDict([('id', None), ('type', None),
+    ('codecs', []), ('time_scale', None), ('duration', None), ('samples', None)])
+  stack = [trak.iter_atoms()]
+  while stack:
+    for atom in stack[-1]:
+      if atom.tag in CONTAINER_TAGS:
+        stack.append(atom.iter_atoms())
+        break
+      elif atom.tag == b'tkhd':
+        track['id'] = struct.unpack('>I', atom.read_data(16)[12:16])[0]
+      elif atom.tag == b'mdhd':
+        time_scale, duration = struct.unpack('>II', atom.read_data(20)[12:20])
+        track['time_scale'] = time_scale
+        track['duration'] = duration / float(time_scale) if time_scale else None
+      elif atom.tag == b'hdlr' and track['type'] is None:
+        track['type'] = atom.read_data(12)[8:12].decode('latin1')
+      elif atom.tag == b'stsd':
+        stsd = movatoms.stsd.unpack(atom.read_data())
+        track['codecs'] = [x.data_format.decode('latin1') for x in stsd.descriptions]
+      elif atom.tag == b'stsz':
+        track['samples'] = struct.unpack('>I', atom.read_data(12)[8:12])[0]
+    else:
+      stack.pop()
+  return track
+
+
+def scan_moov(moov):
+  """
+  Reads the facts of the #MovAtomR *moov* atom into a dictionary.
+  """
+
+  result = collections.OrderedDict([('duration', None), ('tracks', [])])
+  for atom in moov.iter_atoms():
+    if atom.tag == b'mvhd':
+      time_scale, duration = struct.unpack('>II', atom.read_data(20)[12:20])
+      result['duration'] = duration / float(time_scale) if time_scale else None
+    elif atom.tag == b'trak':
+      result['tracks'].append(scan_track(atom))
+  return result
+
+
+def scan_file(filename, fingerprint=False):
+  """
+  Scans the file *filename* and returns a dictionary with its size, the
+  top-level atoms (with their offsets and sizes), whether the `moov` atom is
+  missing or the `mdat` atom exceeds the file and the facts of the `moov`.
+  If *fingerprint* is #True, the hex digest of the `moov` atom's
+  #movio.MovAtomD.fingerprint() is included. Errors are reported in the
+  `error` key instead of being raised.
+  """
+
+  record = collections.OrderedDict([('path', filename), ('size', None),
+    ('atoms', []), ('moov_missing', True), ('mdat_truncated', False),
+    ('duration', None), ('tracks', []), ('fingerprint', None), ('error', None)])
+  try:
+    with open(filename, 'rb') as fp:
+      record['size'] = file_size = get_file_size_via_seek(fp)
+      for atom in MovAtomR.make_root(fp).iter_atoms():
+        record['atoms'].append(collections.OrderedDict([
+          ('tag', atom.tag.decode('latin1')), ('offset', atom.atom_begin),
+          ('size', atom.size)]))
+        if atom.atom_begin + atom.size > file_size:
+          if atom.tag == b'mdat':
+            record['mdat_truncated'] = True
+          break
+        if atom.tag == b'moov':
+          record['moov_missing'] = False
+          record.update(scan_moov(atom))
+          if fingerprint:
+            atom.seek_data(0)
+            record['fingerprint'] = binascii.hexlify(
+              atom.to_atomd().fingerprint()).decode('ascii')
+  except (EnvironmentError, MovFileError, UnpackError, ValueError, struct.error) as exc:
+    record['error'] = str(exc) or type(exc).__name__
+  return record
+
+
+def scan_files(filenames, threads=8, fingerprint=False):
+  """
+  Scans the *filenames* with #scan_file() in *threads* threads and yields
+  the records in the order of the *filenames*. At most a few files per
+  thread are scanned ahead, so that *filenames* can be a lazy iterable.
+  """
+
+  pending = collections.deque()
+  with ThreadPoolExecutor(threads) as executor:
+    for filename in filenames:
+      pending.append(executor.submit(scan_file, filename, fingerprint))
+      if len(pending) >= threads * 4:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+
+def to_csv_row(record):
+  """
+  Flattens a *record* of #scan_file() into a row of #CSV_COLUMNS.
+  """
+
+  return [
+    record['path'],
+    record['size'],
+    ' '.join('{}:{}'.format(x['tag'], x['size']) for x in record['atoms']),
+    int(record['moov_missing']),
+    int(record['mdat_truncated']),
+    record['duration'],
+    len(record['tracks']),
+    ','.join(codec for track in record['tracks'] for codec in track['codecs']),
+    record['fingerprint'],
+    record['error'],
+  ]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='movrepair.py inventory',
+    description='Write an inventory of the files in the specified directory '
+      'trees, including their atoms, duration, tracks and codecs and whether '
+      'their moov atom is missing or their mdat atom is truncated.')
+  parser.add_argument('paths', nargs='+', help='The files and directories to scan.')
+  parser.add_argument('-o', '--output', help='The output filename. Default: stdout')
+  parser.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl',
+    help='The output format. Default: jsonl')
+  parser.add_argument('--pattern', action='append', dest='patterns',
+    help='The pattern of file names to scan in directories (case-insensitive, '
+      'can be specified multiple times). Default: ' + ', '.join(DEFAULT_PATTERNS))
+  parser.add_argument('--threads', type=int, default=8,
+    help='The number of files to scan concurrently. Default: 8')
+  parser.add_argument('--fingerprint', action='store_true',
+    help='Include the structural fingerprint of the moov atom, which is the '
+      'same for files recorded with the same settings (see the diff '
+      'command). This reads the whole moov atom.')
+  args = parser.parse_args(argv)
+
+  if args.threads < 1:
+    parser.error('--threads must be at least 1')
+
+  out = open(args.output, 'w') if args.output else sys.stdout
+  try:
+    if args.format == 'csv':
+      writer = csv.writer(out)
+      writer.writerow(CSV_COLUMNS)
+    tstart = time.time()
+    counts = collections.Counter()
+    filenames = find_files(args.paths, args.patterns or DEFAULT_PATTERNS)
+    for record in scan_files(filenames, args.threads, args.fingerprint):
+      counts['files'] += 1
+      counts['moov_missing'] += record['moov_missing'] and not record['error']
+      counts['mdat_truncated'] += record['mdat_truncated']
+      counts['errors'] += bool(record['error'])
+      if args.format == 'csv':
+        writer.writerow(to_csv_row(record))
+      else:
+        out.write(json.dumps(record) + '\n')
+  finally:
+    if out is not sys.stdout:
+      out.close()
+
+  print('Scanned {} files in {:.1f}s: {} without moov, {} with truncated mdat, '
+    '{} errors'.format(counts['files'], time.time() - tstart,
+      counts['moov_missing'], counts['mdat_truncated'], counts['errors']),
+    file=sys.stderr)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
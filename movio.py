@@ -28,9 +28,50 @@ References:
 
 import io
 import os
+import stat
 import struct
 
 
+#: The block size used to read and discard atom data when skipping over atoms
+#: in a file-like object that does not support seeking.
+SKIP_BLOCKSIZE = 1024 * 1024
+
+#: The largest atom size that fits into the 32-bit size field of an atom
+#: header. Larger atoms use a 64-bit "largesize" field after the tag.
+MAX_ATOM_SIZE_32 = 0xffffffff
+
+#: The maximum number of buffers passed to a single `writev()` call.
+try:
+  IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+  IOV_MAX = 1024
+
+
+#: The tags of the atoms that are split into their sub-atoms to compute
+#: their #MovAtomD.fingerprint(), regardless of whether they were split
+#: before.
+FINGERPRINT_CONTAINERS = frozenset([b'moov', b'trak', b'edts', b'mdia', b'minf',
+  b'dinf', b'stbl'])
+
+#: The tables (by atom tag) of which only the number of leading bytes given
+#: here (the version, flags and the fields before the number of entries)
+#: contribute to the #MovAtomD.fingerprint(), as their entries depend on the
+#: duration of the recording.
+FINGERPRINT_TABLES = {
+  b'elst': 4, b'stts': 4, b'ctts': 4, b'stss': 4, b'stps': 4, b'stsc': 4,
+  b'stsz': 8, b'stco': 4, b'co64': 4, b'stsh': 4, b'sdtp': 4, b'sbgp': 8,
+}
+
+#: The byte ranges of the creation and modification times and the durations
+#: in the header atoms (by tag and version), which are zeroed before the data
+#: of the atoms contributes to the #MovAtomD.fingerprint().
+FINGERPRINT_VOLATILE = {
+  (b'mvhd', 0): [(4, 12), (16, 20)], (b'mvhd', 1): [(4, 20), (24, 32)],
+  (b'tkhd', 0): [(4, 12), (20, 24)], (b'tkhd', 1): [(4, 20), (28, 36)],
+  (b'mdhd', 0): [(4, 12), (16, 20)], (b'mdhd', 1): [(4, 20), (24, 32)],
+}
+
+
 class MovFileError(Exception):
   pass
 
@@ -39,26 +80,39 @@ class MovAtomR(object):
   """
   Represents a section in a readable file-like object that can be interpreted
   as a .MOV atom. To use this object, #read_header() should be called first
-  to fill the #size and #tag members.
+  to fill the #size and #tag members. Atoms with a 64-bit size have a
+  #header_size of 16 bytes instead of 8.
+
+  The file-like object does not need to be seekable. In that case, the size
+  of a root atom is unknown (#None) unless specified explicitly, and atoms are
+  iterated until the end of the stream is reached. Skipping over atom data
+  reads and discards it in blocks of #SKIP_BLOCKSIZE bytes.
   """
 
   @classmethod
-  def make_root(cls, fp):
-    ar = cls(fp, is_root_atom=True)
+  def make_root(cls, fp, size=None):
+    ar = cls(fp, is_root_atom=True, size=size)
     ar.is_root_atom = True
     return ar
 
-  def __init__(self, fp, is_root_atom=False):
+  def __init__(self, fp, is_root_atom=False, size=None):
     if isinstance(fp, bytes):
       fp = io.BytesIO(fp)
     self.file = fp
     self.size = 0
     self.tag = None
+    self.header_size = 8
     self.bytes_read = 0
     self.atom_begin = None
     self.is_root_atom = is_root_atom
     if self.is_root_atom:
-      self.size = get_file_size_via_seek(fp)
+      if is_seekable(fp):
+        self.atom_begin = fp.tell()
+        if size is None:
+          size = get_file_size_via_seek(fp) - self.atom_begin
+      else:
+        self.atom_begin = 0
+      self.size = size
 
   def __repr__(self):
     if self.is_root_atom:
@@ -66,23 +120,51 @@ class MovAtomR(object):
     else:
       return '<MovAtomR size={!r} tag={!r}>'.format(self.size, self.tag)
 
-  def read_header(self):
+  def read_header(self, allow_eof=False):
     """
     Extracts the .MOV header of this atom from the current file position.
     Raises a #RuntimeError if the header for this atom has already been read.
+
+    If *allow_eof* is #True and the end of the file is reached before any
+    byte of the header could be read, #False is returned instead of raising
+    a #MovFileError.
+
+    An atom with a size of 0 extends to the end of the file, which requires
+    the file to be seekable.
     """
 
     if self.is_root_atom:
       raise RuntimeError('can not read header of root MovAtomR')
     if self.bytes_read != 0:
       raise RuntimeError('atom header already read')
-    self.atom_begin = self.file.tell()
+    if self.atom_begin is None:
+      self.atom_begin = self.file.tell()
     header = self.file.read(8)
+    if not header and allow_eof:
+      return False
     if len(header) != 8:
       raise MovFileError('reached EOF while reading atom header')
     self.size = struct.unpack('>I', header[:4])[0]
     self.tag = header[4:]
     self.bytes_read = 8
+    if self.size == 1:
+      largesize = self.file.read(8)
+      if len(largesize) != 8:
+        raise MovFileError('reached EOF while reading atom header')
+      self.size = struct.unpack('>Q', largesize)[0]
+      self.header_size = self.bytes_read = 16
+    elif self.size == 0 and is_seekable(self.file):
+      self.size = get_file_size_via_seek(self.file) - self.atom_begin
+    return True
+
+  def _remaining(self):
+    # The number of bytes of the atom that have not been read yet. A size
+    # smaller than the header is reported instead of reading backwards.
+    nbytes = self.size - self.bytes_read
+    if nbytes < 0:
+      raise MovFileError('invalid atom size {} (atom: "{}")'.format(
+        self.size, self.tag.decode('ascii', 'ignore')))
+    return nbytes
 
   def read_data(self, length=None, allow_incomplete=False):
     """
@@ -99,8 +181,7 @@ class MovAtomR(object):
       raise RuntimeError('can not read data from root MovAtomR')
     if self.bytes_read == 0:
       self.read_header()
-    nbytes = self.size - self.bytes_read
-    assert nbytes >= 0
+    nbytes = self._remaining()
     if length is not None:
       nbytes = min(nbytes, length)
     data = self.file.read(nbytes)
@@ -110,6 +191,42 @@ class MovAtomR(object):
         self.tag.decode('ascii', 'ignore')))
     return data
 
+  def readinto(self, buffer, allow_incomplete=False):
+    """
+    Reads the next data of this atom into the writable *buffer* (eg. a
+    #bytearray that is reused for many reads) like #read_data(), and returns
+    the number of bytes read. This is 0 at the end of the atom, and less
+    than the size of the *buffer* only for the last data of the atom.
+    """
+
+    if self.is_root_atom:
+      raise RuntimeError('can not read data from root MovAtomR')
+    if self.bytes_read == 0:
+      self.read_header()
+    view = memoryview(buffer)[:self._remaining()]
+    nbytes = 0
+    while nbytes < len(view):
+      count = self.file.readinto(view[nbytes:])
+      if not count:
+        break
+      nbytes += count
+    self.bytes_read += nbytes
+    if nbytes != len(view) and not allow_incomplete:
+      raise MovFileError('reached EOF while reading "{}" atom data'.format(
+        self.tag.decode('ascii', 'ignore')))
+    return nbytes
+
+  def seek_data(self, offset):
+    """
+    Seeks to *offset* bytes into the data of this atom, so that the next call
+    to #read_data() continues reading from there. Requires a seekable file.
+    """
+
+    if self.bytes_read == 0:
+      self.read_header()
+    self.file.seek(self.atom_begin + self.header_size + offset)
+    self.bytes_read = self.header_size + offset
+
   def iter_data(self, chunksize, allow_incomplete=False):
     while True:
       data = self.read_data(chunksize, allow_incomplete)
@@ -125,23 +242,25 @@ class MovAtomR(object):
 
     if self.bytes_read == 0:
       self.read_header()
-    nbytes = self.size - self.bytes_read
-    assert nbytes >= 0
+    nbytes = self._remaining()
     if nbytes > 0:
-      self.file.seek(nbytes, os.SEEK_CUR)
+      skip_bytes(self.file, nbytes)
       self.bytes_read += nbytes
 
   def iter_atoms(self):
     """
     Creates a new #MovAtomR for every sub-atom. The header of this atom will
-    already be read.
+    already be read. If the size of this atom is unknown (only possible for a
+    root atom), iteration stops at the end of the file.
     """
 
     if not self.is_root_atom and self.bytes_read == 0:
       self.read_header()
-    while self.bytes_read < self.size:
+    while self.size is None or self.bytes_read < self.size:
       atom = type(self)(self.file)
-      atom.read_header()
+      atom.atom_begin = self.atom_begin + self.bytes_read
+      if not atom.read_header(allow_eof=self.size is None):
+        break
       yield atom
       atom.skip()
       self.bytes_read += atom.bytes_read
@@ -159,7 +278,7 @@ class MovAtomR(object):
       raise ValueError('can not convert root MovAtomR to MovAtomD')
     if self.bytes_read == 0:
       self.read_header()
-    if self.bytes_read != 8:
+    if self.bytes_read != self.header_size:
       raise RuntimeError('MovAtomR data has already been read past '
           'header, can not convert to MovAtomD')
     return MovAtomD(self.tag, self.read_data(), parent=parent)
@@ -175,15 +294,30 @@ class MovAtomD(object):
   it will most likely be in leaf-node form. However, if the atom type is known
   to contain sub-atoms, it can be split into sub-atoms using #subatomize()
   function or #iter_atoms() method.
+
+  The #fingerprint() of an atom is cached. Assigning to #data or calling
+  #edit() discards the cached fingerprints of the atom and its parents,
+  other changes (eg. to the list of #atoms) require a call to
+  #invalidate().
   """
 
   def __init__(self, tag, data=None, atoms=None, parent=None):
     assert isinstance(tag, bytes), type(tag)
     assert len(tag) == 4, len(tag)
     self.tag = tag
+    self.parent = parent
+    self._fingerprint = None
     self.data = data
     self.atoms = atoms
-    self.parent = parent
+
+  @property
+  def data(self):
+    return self._data
+
+  @data.setter
+  def data(self, data):
+    self._data = data
+    self.invalidate()
 
   def __repr__(self):
     if self.is_leaf():
@@ -204,8 +338,53 @@ class MovAtomD(object):
       raise RuntimeError('can not use MovAtomD.edit() on non-leaf atom')
     if not isinstance(self.data, bytearray):
       self.data = bytearray(self.data)
+    else:
+      self.invalidate()
     return self.data
 
+  def invalidate(self):
+    """
+    Discards the cached #fingerprint() of this atom and its parents. Must be
+    called after the list of #atoms was changed.
+    """
+
+    atom = self
+    # The parents of an atom without a fingerprint have none either.
+    while atom is not None and atom._fingerprint is not None:
+      atom._fingerprint = None
+      atom = atom.parent
+
+  def fingerprint(self):
+    """
+    Returns a digest of the structure of this atom, computed bottom-up from
+    the fingerprints of its sub-atoms and cached until the atom is changed.
+    Atoms with the same fingerprint are compatible with each other, but
+    their data may differ where it depends on the recording rather than on
+    the configuration of the camera: the entries of the #FINGERPRINT_TABLES
+    and the #FINGERPRINT_VOLATILE fields are ignored.
+    """
+
+    if self._fingerprint is None:
+      import hashlib
+      if self.is_leaf() and self.tag in FINGERPRINT_CONTAINERS:
+        self.split()
+      if self.is_leaf():
+        data = self.data
+        if self.tag in FINGERPRINT_TABLES:
+          data = data[:FINGERPRINT_TABLES[self.tag]]
+        else:
+          version = bytearray(data[:1])
+          ranges = FINGERPRINT_VOLATILE.get((self.tag, version[0] if version else None))
+          if ranges:
+            data = bytearray(data)
+            for begin, end in ranges:
+              data[begin:end] = b'\0' * len(data[begin:end])
+        parts = [self.tag, b'L', bytes(data)]
+      else:
+        parts = [self.tag, b'C'] + [x.fingerprint() for x in self.atoms]
+      self._fingerprint = hashlib.sha1(b''.join(parts)).digest()
+    return self._fingerprint
+
   def split(self):
     """
     Given this is a leaf-atom, splits the #data of the atom assuming that it
@@ -252,13 +431,26 @@ class MovAtomD(object):
 
   def calculate_size(self):
     if self.is_leaf():
-      return len(self.data) + 8
+      data_size = len(self.data)
     else:
-      return sum(x.calculate_size() for x in self.atoms) + 8
+      data_size = sum(x.calculate_size() for x in self.atoms)
+    return data_size + get_header_size(data_size)
 
   def write(self, fp):
     """
-    Write this atom to a file.
+    Write this atom to a file. The headers and data of the whole atom tree
+    are collected first and then written with as few system calls as
+    possible (see #write_segments()).
+    """
+
+    buffer = SegmentWriter()
+    self.write_unbuffered(buffer)
+    write_segments(fp, buffer.segments)
+
+  def write_unbuffered(self, fp):
+    """
+    Write this atom to a file, issuing one write for every atom header and
+    leaf atom's data.
     """
 
     size = self.calculate_size()
@@ -267,18 +459,35 @@ class MovAtomD(object):
         writer.write(self.data)
       else:
         for atom in self.atoms:
-          atom.write(writer)
+          atom.write_unbuffered(writer)
 
 
 class MovAtomW(object):
   """
-  A write-only .MOV atom.
+  A write-only .MOV atom. Atoms larger than #MAX_ATOM_SIZE_32 bytes are
+  written with a 64-bit size (see #get_header_size()).
   """
 
   @classmethod
   def make_root(cls, fp):
     return cls(fp, None, None)
 
+  @classmethod
+  def resume(cls, fp, size, tag, bytes_written):
+    """
+    Creates a #MovAtomW for an atom of which the header (see
+    #get_atom_header_size()) and *bytes_written* bytes of data have already
+    been written to *fp* previously. The file must be positioned after the
+    written data.
+    """
+
+    writer = cls(None, None, None)
+    writer.file = fp
+    writer.size = size
+    writer.tag = tag
+    writer.bytes_written = get_atom_header_size(size) + bytes_written
+    return writer
+
   def __init__(self, fp, size, tag):
     if tag is not None:
       assert isinstance(tag, bytes), type(tag)
@@ -286,9 +495,12 @@ class MovAtomW(object):
       if size < 8:
         raise MovFileError('atom size must be >= 8 (atom: "{}")'.format(
             tag.decode('ascii', 'ignore')))
-      fp.write(struct.pack('>I', size))
-      fp.write(tag)
-      self.bytes_written = 8
+      if get_atom_header_size(size) == 16:
+        fp.write(struct.pack('>I', 1) + tag + struct.pack('>Q', size))
+        self.bytes_written = 16
+      else:
+        fp.write(struct.pack('>I', size) + tag)
+        self.bytes_written = 8
     else:
       assert size is None
       self.bytes_written = 0
@@ -313,12 +525,148 @@ class MovAtomW(object):
     self.file.write(data)
     self.bytes_written += len(data)
 
+  def write_hole(self, nbytes):
+    """
+    Advances the file by *nbytes* without writing any data, leaving a hole
+    in the file that reads as zeros. Requires a seekable file. If the file
+    object implements a `write_hole()` method itself, it is used instead.
+    """
+
+    if not self.is_root_atom and self.bytes_written + nbytes > self.size:
+      raise MovFileError('atom "{}" data excess'.format(self.tag.decode('ascii', 'ignore')))
+    write_hole = getattr(self.file, 'write_hole', None)
+    if write_hole is not None:
+      write_hole(nbytes)
+    else:
+      self.file.seek(nbytes, os.SEEK_CUR)
+    self.bytes_written += nbytes
+
   def finalize(self):
     if not self.is_root_atom and self.bytes_written != self.size:
       raise MovFileError('atom "{}" data size mismatch (got {}, expected {})'
           .format(self.tag.decode('ascii', 'ignore'), self.bytes_written, self.size))
 
 
+class SegmentWriter(object):
+  """
+  A write-only file-like object that collects the data written to it in the
+  #segments list without copying it. Note that mutable objects (like a
+  #bytearray) must not be modified until the segments have been written.
+  """
+
+  def __init__(self):
+    self.segments = []
+    self.size = 0
+
+  def write(self, data):
+    if len(data):
+      self.segments.append(data)
+      self.size += len(data)
+
+
+def get_header_size(data_size):
+  """
+  Returns the size of the header of an atom with *data_size* bytes of data,
+  which is 16 if the atom needs a 64-bit size and 8 otherwise.
+  """
+
+  return 16 if data_size + 8 > MAX_ATOM_SIZE_32 else 8
+
+
+def get_atom_header_size(size):
+  """
+  Returns the size of the header of an atom of *size* bytes (including the
+  header) as it is written by #MovAtomW.
+  """
+
+  return 16 if size > MAX_ATOM_SIZE_32 else 8
+
+
+def write_segments(fp, segments):
+  """
+  Writes the list of byte-like *segments* to the file-like object *fp*. If
+  the file has a file descriptor, the segments are written with `writev()`
+  in batches of #IOV_MAX buffers, otherwise they are joined into one buffer
+  and written at once.
+  """
+
+  fileno = get_fileno(fp)
+  if fileno is None or not hasattr(os, 'writev'):
+    fp.write(b''.join(segments))
+    return
+
+  fp.flush()
+  views = [memoryview(x).cast('B') for x in segments if len(x)]
+  index = 0
+  while index < len(views):
+    written = os.writev(fileno, views[index:index+IOV_MAX])
+    # Skip the buffers that have been written completely and continue
+    # with the remainder of the buffer that has been written partially.
+    while index < len(views) and written >= len(views[index]):
+      written -= len(views[index])
+      index += 1
+    if written:
+      views[index] = views[index][written:]
+
+
+def preallocate(fp, size):
+  """
+  Reserves *size* bytes of disk space in the file *fp*, starting at its
+  current position, using `posix_fallocate()`. Returns #True on success and
+  #False if the file or platform does not support it.
+  """
+
+  fileno = get_fileno(fp)
+  if fileno is None or not hasattr(os, 'posix_fallocate') or size <= 0:
+    return False
+  if not stat.S_ISREG(os.fstat(fileno).st_mode):
+    return False
+  try:
+    os.posix_fallocate(fileno, fp.tell(), size)
+  except OSError:
+    return False
+  return True
+
+
+def get_fileno(fp):
+  """
+  Returns the file descriptor of the file-like object *fp*, or #None if it
+  does not have one.
+  """
+
+  try:
+    return fp.fileno()
+  except (AttributeError, io.UnsupportedOperation, OSError):
+    return None
+
+
+def skip_bytes(fp, nbytes):
+  """
+  Advances the position of the file-like object *fp* by *nbytes*. If the file
+  is not seekable, the data is read and discarded in blocks of
+  #SKIP_BLOCKSIZE bytes.
+  """
+
+  if is_seekable(fp):
+    fp.seek(nbytes, os.SEEK_CUR)
+  else:
+    while nbytes > 0:
+      data = fp.read(min(nbytes, SKIP_BLOCKSIZE))
+      if not data: break
+      nbytes -= len(data)
+
+
+def is_seekable(fp):
+  """
+  Returns #True if the file-like object *fp* supports random access.
+  """
+
+  seekable = getattr(fp, 'seekable', None)
+  if seekable is not None:
+    return seekable()
+  return hasattr(fp, 'seek') and hasattr(fp, 'tell')
+
+
 def get_file_size_via_seek(fp):
   pos = fp.tell()
   fp.seek(0, os.SEEK_END)
@@ -0,0 +1,438 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Joining the chapter files of a recording that was split by the camera into
+a single file. The `mdat` data of the chapters is copied into one `mdat`
+atom in a single sequential pass (in the kernel, if possible), the sample
+tables of the chapters are concatenated as arrays, with the chunk offsets
+shifted to the new position of the data. Chapters without a `moov` atom (eg.
+the last chapter, if the recording was interrupted) are repaired with a
+reference file first.
+"""
+
+from movio import MovFileError, MovAtomR, MovAtomD, MovAtomW, get_file_size_via_seek, get_header_size, preallocate
+import argparse
+import array
+import collections
+import itertools
+import operator
+import struct
+import sys
+
+import movatoms
+import movcopy
+import movrepair
+import movtables
+
+
+class Chapter(object):
+  """
+  A chapter file to join. *atoms* are the #MovAtomD#s of the chapter, with
+  an empty `mdat` atom in place of the data, which is *data_size* bytes at
+  the offset *data_offset* in the file *fp*. The chunk offsets in the `moov`
+  atom point to the data as if it started at the offset *base* (this differs
+  from *data_offset* for a #repaired chapter, whose `moov` describes the
+  repaired file).
+  """
+
+  def __init__(self, fp, atoms, data_offset, data_size, base, repaired=False):
+    self.fp = fp
+    self.atoms = atoms
+    self.data_offset = data_offset
+    self.data_size = data_size
+    self.base = base
+    self.repaired = repaired
+
+  @property
+  def moov(self):
+    return next(atom for atom in self.atoms if atom.tag == b'moov')
+
+  @classmethod
+  def load(cls, fp, get_template):
+    """
+    Loads the chapter from the file *fp*. If it has no `moov` atom or its
+    `mdat` atom is truncated, the chapter is repaired with the
+    #movrepair.ReferenceTemplate that is returned by *get_template()*.
+    Returns #None if the chapter can not be repaired.
+    """
+
+    file_size = get_file_size_via_seek(fp)
+    atoms = []
+    mdat = moov = None
+    for atom in MovAtomR.make_root(fp).iter_atoms():
+      if atom.tag == b'mdat':
+        mdat = atom
+        atoms.append(MovAtomD(b'mdat', b''))
+      else:
+        atoms.append(atom.to_atomd())
+        if atom.tag == b'moov':
+          moov = atom
+    if mdat is not None and moov is not None and mdat.atom_begin + mdat.size <= file_size:
+      data_offset = mdat.atom_begin + mdat.header_size
+      return cls(fp, atoms, data_offset, mdat.size - mdat.header_size, data_offset)
+
+    fp.seek(0)
+    plan = movrepair.plan_repair(get_template(), fp)
+    if plan is None:
+      return None
+    return cls(fp, plan.atoms, plan.mdat_offset + plan.mdat_header_size, plan.mdat_data_size,
+      plan.output_data_offset, True)
+
+
+def concat_runs(tables):
+  """
+  Concatenates the run-length encoded per-sample *tables* (lists of
+  `(count, value)` tuples, like the `stts` and `ctts` tables), merging the
+  runs of equal values at the boundaries.
+  """
+
+  result = []
+  for table in tables:
+    for count, value in table:
+      if result and result[-1][1] == value:
+        result[-1] = (result[-1][0] + count, value)
+      elif count:
+        result.append((count, value))
+  return result
+
+
+def concat_shifted(arrays, shifts):
+  """
+  Concatenates the *arrays*, adding the corresponding item in *shifts* to
+  every value.
+  """
+
+  result = array.array('q')
+  for items, shift in zip(arrays, shifts):
+    result.extend(array.array('q', map(operator.add, items, itertools.repeat(shift)) if shift else items))
+  return result
+
+
+def join_sample_groups(stbls, sample_counts):
+  """
+  Appends the sample groups of the `stbl` #MovAtomD#s *stbls* to the first
+  of them, for every grouping type of its `sbgp` atoms. The runs of every
+  chapter are cut or padded (with the group description index 0, no group)
+  to its number of samples in *sample_counts*, so that the groups of the
+  later chapters stay on their samples.
+
+  The group description indices refer to the `sgpd` atom of the grouping
+  type, so a grouping type is removed if the `sgpd` atoms of the chapters
+  differ. An `sbgp` atom is removed if a chapter has none of its grouping
+  type, as the missing groups can not be restored.
+  """
+
+  def find(stbl, tag):
+    # Maps the grouping types (with the parameter for `sbgp` atoms) of the
+    # *tag* atoms of the *stbl* to the atoms and their unpacked structs.
+    result = {}
+    for atom in stbl.find_atoms(tag):
+      obj = getattr(movatoms, tag.decode('ascii')).unpack(atom.data)
+      key = obj.grouping_type
+      if tag == b'sbgp':
+        key = (key, obj.grouping_type_parameter)
+      result[key] = (atom, obj)
+    return result
+
+  stbl = stbls[0]
+  descriptions = [find(x, b'sgpd') for x in stbls]
+  groups = [find(x, b'sbgp') for x in stbls]
+
+  differ = set()
+  for grouping_type in set(descriptions[0]) | set(k[0] for k in groups[0]):
+    data = [x[grouping_type][0].data if grouping_type in x else None for x in descriptions]
+    if any(x != data[0] for x in data):
+      differ.add(grouping_type)
+      if grouping_type in descriptions[0]:
+        stbl.atoms.remove(descriptions[0][grouping_type][0])
+
+  for key, (atom, obj) in groups[0].items():
+    if key[0] in differ or any(key not in x for x in groups):
+      stbl.atoms.remove(atom)
+      continue
+    tables = []
+    for x, count in zip(groups, sample_counts):
+      runs = movtables.slice_runs(x[key][1].table, 0, count)
+      tables.append(runs + [(count - sum(c for c, _ in runs), 0)])
+    obj.table = concat_runs(tables)
+    atom.data = obj.pack()
+  stbl.invalidate()
+
+
+def join_tracks(traks, shifts):
+  """
+  Appends the samples of the `trak` #MovAtomD#s *traks* to the first of
+  them, which is modified in place. *shifts* are the numbers of bytes by
+  which the chunk offsets of every track are moved. The `stco` (or `co64`),
+  `stsc`, `stsz` and `stts` tables are concatenated, as well as the
+  optional `ctts`, `stss`, `stps`, `sdtp` and `sbgp` tables. Optional
+  tables that can not be joined are removed. The `mdhd`, `tkhd` and `elst`
+  durations are updated.
+  """
+
+  tables = [movtables.TrackTables(trak) for trak in traks]
+  first = tables[0]
+  stbl = first.stbl
+  if any(x.time_scale != first.time_scale for x in tables):
+    raise ValueError('the chapters have different time scales')
+  stsd = stbl.find_atoms(b'stsd')[0].data
+  if any(x.stbl.find_atoms(b'stsd')[0].data != stsd for x in tables):
+    raise ValueError('the chapters have different sample descriptions')
+
+  counts = [x.chunk_sample_counts() for x in tables]
+  chunk_counts = [len(x) for x in counts]
+  sample_counts = [x.sample_count or sum(c) for x, c in zip(tables, counts)]
+  chunk_bases = movtables.cumsum(chunk_counts)
+  sample_bases = movtables.cumsum(sample_counts)
+  total = sample_bases[-1]
+
+  def unpack(tag):
+    # The unpacked struct of the *tag* atom of every chapter (#None where
+    # the chapter has no such atom).
+    struct_type = getattr(movatoms, tag.decode('ascii'))
+    result = []
+    for x in tables:
+      atoms = x.stbl.find_atoms(tag)
+      result.append(struct_type.unpack(atoms[0].data) if atoms else None)
+    return result
+
+  def update(tag, data):
+    stbl.find_atoms(tag)[0].data = data
+
+  def remove(tag):
+    for atom in stbl.find_atoms(tag):
+      stbl.atoms.remove(atom)
+    stbl.invalidate()
+
+  # Chunk offsets, in a co64 atom if they do not fit into 32 bits.
+  offsets = concat_shifted([x.chunk_offsets()[:n] for x, n in zip(tables, chunk_counts)], shifts)
+  first.stco_atom.tag, first.stco_atom.data = movtables.pack_chunk_offsets(first.stco, offsets)
+
+  # The runs of the sample-to-chunk table continue after the chunks of the
+  # previous chapters.
+  runs = []
+  for x, base in zip(tables, chunk_bases):
+    table = x.stsc.table.toarray()
+    for run in zip(map(operator.add, table[0::3], itertools.repeat(base)), table[1::3], table[2::3]):
+      if not runs or runs[-1][1:] != run[1:]:
+        runs.append(run)
+  first.stsc.table = runs
+  update(b'stsc', first.stsc.pack())
+
+  stsz = first.stsz
+  if any(x.stsz.size != stsz.size for x in tables) or stsz.size == 0:
+    sizes = array.array('q')
+    for x, count in zip(tables, sample_counts):
+      if x.stsz.size == 0:
+        sizes.extend(array.array('q', x.stsz.table.toarray()[:count]))
+      else:
+        sizes.extend(array.array('q', [x.stsz.size]) * count)
+    stsz.size = 0
+    stsz.table = movtables.TableView.fromarray('>I', sizes)
+  update(b'stsz', movtables.pack_stsz(stsz, total))
+
+  first.stts.table = concat_runs(movtables.resize_stts(x.stts.table, count)
+    for x, count in zip(tables, sample_counts))
+  update(b'stts', first.stts.pack())
+
+  # A missing composition offset table means that all offsets are zero.
+  ctts = unpack(b'ctts')
+  if any(x is not None for x in ctts):
+    table = concat_runs([(count, 0)] if x is None else x.table
+      for x, count in zip(ctts, sample_counts))
+    if ctts[0] is None:
+      stbl.atoms.append(MovAtomD(b'ctts', b'', parent=stbl))
+      stbl.invalidate()
+      ctts[0] = movatoms.ctts(v=0, flags=(0, 0, 0), table=table)
+    ctts[0].table = table
+    update(b'ctts', ctts[0].pack())
+
+  join_sample_groups([x.stbl for x in tables], sample_counts)
+
+  for tag in (b'stss', b'stps'):
+    structs = unpack(tag)
+    if all(x is None for x in structs):
+      continue
+    # A missing sync sample table means that every sample is a sync sample,
+    # a missing partial sync sample table that none is.
+    numbers = []
+    for x, count in zip(structs, sample_counts):
+      if x is not None:
+        numbers.append(x.table.toarray())
+      elif tag == b'stss':
+        numbers.append(range(1, count + 1))
+      else:
+        numbers.append(())
+    table = movtables.TableView.fromarray('>I', concat_shifted(numbers, sample_bases))
+    if structs[0] is None:
+      stbl.atoms.append(MovAtomD(tag, b'', parent=stbl))
+      stbl.invalidate()
+      structs[0] = getattr(movatoms, tag.decode('ascii'))(v=0, flags=(0, 0, 0), table=table)
+    structs[0].table = table
+    update(tag, structs[0].pack())
+
+  sdtp = unpack(b'sdtp')
+  if all(x is not None and len(x.table) == count for x, count in zip(sdtp, sample_counts)):
+    sdtp[0].table = movtables.TableView.fromarray('>B',
+      itertools.chain.from_iterable(x.table.toarray() for x in sdtp))
+    update(b'sdtp', sdtp[0].pack())
+  else:
+    remove(b'sdtp')
+
+  # These describe the samples of a single chapter.
+  remove(b'cslg')
+  remove(b'stsh')
+
+  mdhd = traks[0].find_atoms(b'mdia', b'mdhd')[0]
+  mdhd.edit()[16:20] = struct.pack('>I', sum(itertools.starmap(operator.mul, first.stts.table)))
+  duration = sum(struct.unpack('>I', trak.find_atoms(b'tkhd')[0].data[20:24])[0] for trak in traks)
+  traks[0].find_atoms(b'tkhd')[0].edit()[20:24] = struct.pack('>I', duration)
+  # Like #movrepair.fix_metadata(), assume one entry in the edit list.
+  for elst in traks[0].find_atoms(b'edts', b'elst'):
+    elst.edit()[8:12] = struct.pack('>I', duration)
+
+
+def join_movies(moovs, shifts):
+  """
+  Joins the `moov` #MovAtomD#s *moovs* of the chapters into the first of
+  them (see #join_tracks()). Tracks that are not present in all chapters
+  (matched by their track ID) are removed. Returns the IDs of the removed
+  tracks.
+  """
+
+  tracks = [get_track_keys(moov) for moov in moovs]
+  removed = []
+  for key, trak in get_track_keys(moovs[0]).items():
+    if all(key in x for x in tracks):
+      join_tracks([x[key] for x in tracks], shifts)
+    else:
+      moovs[0].atoms.remove(trak)
+      moovs[0].invalidate()
+      removed.append(key[0])
+
+  mvhd = moovs[0].find_atoms(b'mvhd')[0]
+  duration = sum(struct.unpack('>I', moov.find_atoms(b'mvhd')[0].data[16:20])[0] for moov in moovs)
+  mvhd.edit()[16:20] = struct.pack('>I', duration)
+  return removed
+
+
+def get_track_id(trak):
+  return struct.unpack('>I', trak.find_atoms(b'tkhd')[0].data[12:16])[0]
+
+
+def get_track_keys(moov):
+  # Maps `(track_id, occurrence)` to the `trak` atoms of the *moov*, so that
+  # the tracks of files with duplicate track IDs can be matched by order.
+  result = collections.OrderedDict()
+  for trak in moov.find_atoms(b'trak'):
+    track_id = get_track_id(trak)
+    occurrence = sum(1 for key in result if key[0] == track_id)
+    result[(track_id, occurrence)] = trak
+  return result
+
+
+def join_files(reference, chapters, output):
+  """
+  Joins the *chapters* (a list of filenames) into the file *output*. The
+  *reference* file is only read if a chapter needs to be repaired. The atoms
+  before the `mdat` atom are taken from the first chapter, the `moov` atom
+  is written after the `mdat`.
+  """
+
+  files = []
+  templates = []
+  def get_template():
+    if not templates:
+      with open(reference, 'rb') as fp:
+        templates.append(movrepair.ReferenceTemplate.load(fp))
+    return templates[0]
+
+  try:
+    loaded = []
+    for index, filename in enumerate(chapters):
+      files.append(open(filename, 'rb'))
+      chapter = Chapter.load(files[-1], get_template)
+      if chapter is None:
+        print('error: can not repair chapter {} ({})'.format(index + 1, filename))
+        return 1
+      print('Chapter {}: {} ({} of mdat data{})'.format(index + 1, filename,
+        movrepair.sizeof_fmt(chapter.data_size), ', repaired' if chapter.repaired else ''))
+      loaded.append(chapter)
+
+    # The data of the chapters follows each other in the output file's mdat.
+    leading = [atom for atom in loaded[0].atoms if atom.tag not in (b'mdat', b'moov')]
+    data_size = sum(x.data_size for x in loaded)
+    header_size = get_header_size(data_size)
+    data_begin = sum(atom.calculate_size() for atom in leading) + header_size
+    data_offsets = movtables.cumsum((x.data_size for x in loaded), data_begin)
+    shifts = [offset - x.base for offset, x in zip(data_offsets, loaded)]
+    moov = loaded[0].moov
+    try:
+      removed = join_movies([x.moov for x in loaded], shifts)
+    except ValueError as exc:
+      print('error: can not join the chapters:', exc)
+      return 1
+    for track_id in removed:
+      print('Removing track {}, it is not present in all chapters'.format(track_id))
+
+    with open(output, 'wb') as fp:
+      preallocate(fp, data_begin + data_size + moov.calculate_size())
+      for atom in leading:
+        atom.write(fp)
+      writer = MovAtomW(fp, header_size + data_size, b'mdat')
+      for chapter in loaded:
+        writer.bytes_written += movcopy.copy_range(chapter.fp, fp,
+          chapter.data_offset, chapter.data_size)
+      writer.finalize()
+      moov.write(fp)
+  except MovFileError as exc:
+    print('error:', exc)
+    return 1
+  finally:
+    for fp in files:
+      fp.close()
+
+  time_scale, duration = struct.unpack('>II', moov.find_atoms(b'mvhd')[0].data[12:20])
+  print('Joined {} chapters, mdat size: {}, duration: {}s'.format(len(chapters),
+    movrepair.sizeof_fmt(data_size), duration / float(time_scale)))
+  return 0
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='movrepair.py join',
+    description='Join the chapter files of a split recording into one file.')
+  parser.add_argument('reference', help='A working video file, used to '
+    'repair chapters that have no moov atom.')
+  parser.add_argument('chapters', nargs='+', help='The chapter files, in order.')
+  parser.add_argument('-o', '--output', required=True, help='The output filename.')
+  parser.add_argument('--verify', action='store_true',
+    help='Check the sample tables of the OUTPUT file afterwards.')
+  args = parser.parse_args(argv)
+
+  result = join_files(args.reference, args.chapters, args.output)
+  if result == 0 and args.verify:
+    result = movrepair.verify_file(args.output)
+  return result
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,247 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Querying single values of a file by their path, eg.
+`moov/trak/mdia/mdhd.duration`. The atoms are walked with #MovAtomR, atoms
+that are not on the path are skipped over by their size, and only the
+fields of the target atom's struct up to the requested field are read and
+decoded. Querying a value of the `moov` atom thus reads the headers of the
+atoms on the way to it and a few bytes of data, independent of the size of
+the sample tables.
+
+A path consists of atom tags separated by slashes. Every tag can be `*` to
+match any atom and can be followed by a (0-based) index in brackets to only
+match the n-th of the matching atoms (eg. `moov/trak[1]/tkhd`). The last
+tag can be followed by a dot and the name of a field of the atom's struct
+(see #movatoms), and more dot-separated attribute names that are looked up
+in the field's value (and in every item, if it is a list), eg.
+`moov/trak/mdia/minf/stbl/stsd.descriptions.data_format`.
+"""
+
+from movio import MovAtomR
+import argparse
+import json
+import re
+import sys
+
+import movatoms
+from movutils import Struct, TableView
+
+
+class QueryError(Exception):
+  pass
+
+
+class PathComponent(object):
+
+  def __init__(self, tag, index=None):
+    self.tag = tag
+    self.index = index
+
+  def __repr__(self):
+    return 'PathComponent({!r}, {!r})'.format(self.tag, self.index)
+
+  def matches(self, atom):
+    return self.tag is None or atom.tag == self.tag
+
+
+class AtomReader(object):
+  """
+  A read-only file-like object for the data of the #MovAtomR *atom*, so that
+  fields can be unpacked from it without reading the rest of the atom.
+  """
+
+  def __init__(self, atom):
+    self.atom = atom
+
+  def read(self, size=-1):
+    return self.atom.read_data(None if size is None or size < 0 else size)
+
+
+def parse_path(path):
+  """
+  Parses a query *path* into a list of #PathComponent#s and a list of the
+  attribute names after the last tag.
+  """
+
+  path, _, attrs = path.strip('/').partition('.')
+  components = []
+  for part in path.split('/'):
+    match = re.match(r'^([^\[\]]{1,4}|\*)(?:\[(\d+)\])?$', part)
+    if not match:
+      raise QueryError('invalid path component: {!r}'.format(part))
+    tag, index = match.groups()
+    tag = None if tag == '*' else tag.ljust(4).encode('latin1')
+    components.append(PathComponent(tag, int(index) if index is not None else None))
+  return components, [x for x in attrs.split('.') if x] if attrs else []
+
+
+def walk(atoms, components, prefix=''):
+  """
+  Yields `(path, atom)` tuples for the #MovAtomR#s that match the
+  *components* of a path, starting with the iterable of *atoms*. Every atom
+  must be processed before the next one is requested, as the atoms are
+  read from the same file.
+  """
+
+  component = components[0]
+  count = 0
+  for atom in atoms:
+    if not component.matches(atom):
+      continue
+    index, count = count, count + 1
+    if component.index is not None and index != component.index:
+      continue
+    path = '{}{}[{}]'.format(prefix, atom.tag.decode('latin1'), index)
+    if len(components) == 1:
+      yield path, atom
+    else:
+      for result in walk(atom.iter_atoms(), components[1:], path + '/'):
+        yield result
+    if component.index is not None:
+      break
+
+
+def get_struct_type(tag):
+  struct_type = getattr(movatoms, tag.decode('latin1'), None)
+  if isinstance(struct_type, type) and issubclass(struct_type, Struct):
+    return struct_type
+  return None
+
+
+def read_field(atom, struct_type, name):
+  """
+  Unpacks the fields of the #Struct subclass *struct_type* from the data of
+  the #MovAtomR *atom* up to the field *name* and returns its value. The
+  data after the field is not read. For hidden fields (like the number of
+  items in a table), the value stored in the file is returned.
+  """
+
+  ctx = movatoms.SubAtomsUnpackContext(atom, struct_type)
+  fp = AtomReader(atom)
+  for field in struct_type._fields_:
+    value = field.unpack_from_stream(ctx, fp)
+    ctx.field_values[field.name] = value
+    if field.name == name:
+      return value
+  raise QueryError('{} has no field {!r}'.format(struct_type.__name__, name))
+
+
+def get_attr(value, name):
+  # Looks up the attribute *name* in *value*, or in every item of a list.
+  if isinstance(value, (list, TableView)):
+    return [get_attr(x, name) for x in value]
+  try:
+    return getattr(value, name)
+  except AttributeError:
+    raise QueryError('{} has no attribute {!r}'.format(type(value).__name__, name))
+
+
+def query(fp, path):
+  """
+  Yields `(path, value)` tuples for all values in the file *fp* that match
+  the query *path*, where *path* is the concrete path of the atom. Without
+  field names, the value is the unpacked struct of the atom (or its size,
+  if there is no struct for the atom type).
+  """
+
+  components, attrs = parse_path(path)
+  for atom_path, atom in walk(MovAtomR.make_root(fp).iter_atoms(), components):
+    struct_type = get_struct_type(atom.tag)
+    if not attrs:
+      if struct_type is None:
+        yield atom_path, atom.size
+      else:
+        ctx = movatoms.SubAtomsUnpackContext(atom, struct_type)
+        yield atom_path, struct_type.unpack(atom.read_data(), ctx)
+      continue
+    if struct_type is None:
+      raise QueryError('unsupported atom type: {!r}'.format(atom.tag))
+    value = read_field(atom, struct_type, attrs[0])
+    for name in attrs[1:]:
+      value = get_attr(value, name)
+    yield atom_path + '.' + '.'.join(attrs), value
+
+
+def to_plain(value):
+  """
+  Converts a queried *value* into a JSON-serializable object.
+  """
+
+  if isinstance(value, Struct):
+    return {field.name: to_plain(getattr(value, field.name)) for field in value._visible_fields_}
+  if isinstance(value, (list, tuple, TableView)):
+    return [to_plain(x) for x in value]
+  if isinstance(value, (bytes, bytearray)):
+    return bytes(value).decode('latin1')
+  return value
+
+
+def main(argv=None):
+  import movrepair
+
+  parser = argparse.ArgumentParser(prog='movrepair.py query',
+    description='Print the values at the specified paths of a file (eg. '
+      'moov/trak/mdia/mdhd.duration), reading only what is needed.')
+  parser.add_argument('file', help='The file to query. Pass `-` to read from stdin.')
+  parser.add_argument('paths', nargs='+', help='The paths of the values.')
+  parser.add_argument('-p', '--with-path', action='store_true',
+    help='Prefix every value with the path of the atom it was read from.')
+  parser.add_argument('--json', action='store_true',
+    help='Print a JSON object that maps every path to a list of its values.')
+  args = parser.parse_args(argv)
+  if args.file == '-' and len(args.paths) > 1:
+    parser.error('only one path can be queried from stdin')
+
+  result = {}
+  status = 0
+  for path in args.paths:
+    with movrepair.open_file(args.file, 'rb') as fp:
+      try:
+        result[path] = list(query(fp, path))
+      except QueryError as exc:
+        print('error: {}: {}'.format(path, exc), file=sys.stderr)
+        result[path] = []
+        status = 1
+        continue
+    if not result[path]:
+      print('error: {}: no matching atom'.format(path), file=sys.stderr)
+      status = 1
+
+  if args.json:
+    json.dump({path: [to_plain(value) for _, value in values] for path, values in result.items()},
+      sys.stdout, indent=2, sort_keys=True)
+    print()
+    return status
+  for path in args.paths:
+    for atom_path, value in result[path]:
+      if args.with_path:
+        print(atom_path + ': ', end='')
+      if isinstance(value, Struct):
+        value.pretty_print()
+      else:
+        print(json.dumps(to_plain(value)) if not isinstance(value, (int, float)) else value)
+  return status
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -21,31 +21,19 @@
 # SOFTWARE.
 
 
-from __future__ import division, print_function
-from movio import MovFileError, MovAtomR, MovAtomD, MovAtomW, get_file_size_via_seek
-import movatoms
-import argparse
+from movio import MovFileError, MovAtomR, MovAtomD, MovAtomW, get_file_size_via_seek, get_header_size, is_seekable, preallocate, skip_bytes
 import collections
+import io
+import itertools
+import operator
 import os
+import re
 import struct
 import sys
 
-
-def guess_sequence_repitition_length(seq):
-  # Thanks to https://stackoverflow.com/a/11385797/791713
-  guess = 1
-  max_len = len(seq) // 2
-  for x in range(2, max_len):
-    if seq[0:x] == seq[x:2*x] :
-      return x
-  return guess
-
-
-def calc_item_delta(sequence):
-  result = []
-  for i in range(1, len(sequence)):
-    result.append(sequence[i] - sequence[i-1])
-  return result
+# NOTE: Modules that are not needed to list the atoms of a file (like
+#       movatoms and argparse) are imported where they are used, to keep
+#       the startup time of the script low. See benchmarks/startup.py.
 
 
 def sizeof_fmt(num, suffix='B'):
@@ -57,7 +45,170 @@ def sizeof_fmt(num, suffix='B'):
   return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
-def fix_metadata(scale_factor, moov):
+def parse_size(text):
+  """
+  Parses a number of bytes with an optional unit (eg. `512M` or `2GiB`,
+  units are powers of 1024).
+  """
+
+  match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$', text, re.I)
+  if not match:
+    raise ValueError('invalid size: {!r}'.format(text))
+  exponent = ' KMGT'.index(match.group(2).upper() or ' ')
+  return int(float(match.group(1)) * 1024 ** exponent)
+
+
+def parse_time(text):
+  """
+  Parses a time in seconds, optionally with minutes and hours (eg. `90`,
+  `1:30` or `0:01:30.5`).
+  """
+
+  match = re.match(r'^\s*(?:(?:(\d+):)?(\d+):)?(\d+(?:\.\d+)?)\s*$', text)
+  if not match:
+    raise ValueError('invalid time: {!r}'.format(text))
+  hours, minutes, seconds = match.groups()
+  return int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds)
+
+
+def parse_time_range(text):
+  """
+  Parses a time range `START-END` (see #parse_time()) into a tuple of the
+  start and end time in seconds. The end can be omitted (`START-`), it is
+  #None in that case.
+  """
+
+  start, sep, end = text.partition('-')
+  if not sep:
+    raise ValueError('invalid time range: {!r}'.format(text))
+  start = parse_time(start)
+  end = parse_time(end) if end.strip() else None
+  if end is not None and end <= start:
+    raise ValueError('invalid time range: {!r}'.format(text))
+  return start, end
+
+
+def get_peak_rss():
+  """
+  Returns the peak resident set size of this process or any of its
+  terminated child processes in bytes, or #None if it can not be determined
+  on this platform.
+  """
+
+  try:
+    import resource
+  except ImportError:
+    return None
+  peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  # ru_maxrss is in kilobytes, except on macOS.
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+
+#: The tags of the atoms in the sample table that are passed to
+#: #fix_sample_tables(). All but the first four atoms are optional, a `co64`
+#: atom can take the place of the `stco` atom.
+SAMPLE_TABLE_TAGS = (b'stts', b'stsc', b'stco', b'stsz',
+  b'ctts', b'stss', b'stps', b'sdtp', b'sbgp', b'co64')
+
+
+def fix_sample_tables(scale_factor, data_format, tables, memory_limit=None, layout=None,
+    offset_shift=0):
+  """
+  Extends the sample tables of a single track for the *scale_factor*. The
+  chunks described by the `stsc`, `stco` and `stsz` tables are extended as a
+  unit (see #movtables.ChunkModel), the `stts` table is scaled to the new
+  number of samples and the optional per-sample tables (`ctts`, `stss`,
+  `stps`, `sdtp` and `sbgp`) are extended to it.
+
+  *tables* maps the tags of the atoms to their data. The data is passed and
+  returned as bytes, so that this function can be run in another process.
+  Returns a list of log messages, a dictionary with the new data of the
+  atoms that need to be updated and the new duration of the track in its
+  media time scale (#None if it did not change).
+
+  If a *memory_limit* (in bytes) is specified, the arrays of the chunk model
+  that exceed it are kept in memory-mapped files (see
+  #movtables.MemoryBudget).
+
+  If a *layout* of the chunks of the track in the repaired file is
+  specified as a tuple of chunk offsets, sample counts, sample sizes and a
+  constant sample size (see #movdetect.DetectedTrack.to_layout()), the
+  chunks are replaced by it instead of being extended. Otherwise, the
+  *offset_shift* is added to the offsets of the chunks.
+
+  The chunk offsets are returned as the data of a `co64` atom (instead of
+  an `stco` atom) if they do not fit into 32 bits.
+  """
+
+  import movatoms
+  import movtables
+
+  if data_format == b'tmcd':
+    return [], {}, None
+
+  atoms = {tag: getattr(movatoms, tag.decode('ascii')).unpack(data)
+    for tag, data in tables.items()}
+  budget = movtables.MemoryBudget(memory_limit) if memory_limit else None
+  try:
+    return _extend_sample_tables(scale_factor, data_format, atoms, budget, layout, offset_shift)
+  finally:
+    if budget is not None:
+      budget.close()
+
+
+def _extend_sample_tables(scale_factor, data_format, atoms, budget, layout, offset_shift):
+  # The body of #fix_sample_tables(). The arrays of the chunk model are
+  # released when it returns, so that the maps of the *budget* can be
+  # closed.
+  import movtables
+
+  log = []
+  result = {}
+  stco_tag = b'co64' if b'co64' in atoms else b'stco'
+  model = movtables.ChunkModel.from_atoms(atoms[b'stsc'], atoms[stco_tag], atoms[b'stsz'], budget)
+  nchunks = len(model)
+  stts_count = sum(x[0] for x in atoms[b'stts'].table)
+  if layout is None:
+    updated = movtables.extend_tables(model, atoms, int(nchunks * scale_factor), scale_factor)
+    if offset_shift:
+      model.shift(offset_shift)
+  else:
+    offsets, counts, sample_sizes, sample_size = layout
+    sample_count = model.sample_count
+    model = movtables.ChunkModel(offsets, counts, [model.descriptions[0]] * len(offsets),
+      sample_sizes, sample_size, budget)
+    atoms[b'stsz'].size = 0 if sample_sizes is not None else sample_size
+    updated = movtables.extend_tables(model, atoms, len(model), scale_factor, sample_count)
+    log.append('Replacing {} chunks with the {} detected chunks ({} samples)'.format(
+      data_format, len(model), model.sample_count))
+
+  if b'stco' in updated and layout is None:
+    log.append('Extending {} chunks from {} to {} ({} samples)'.format(
+      data_format, nchunks, len(model), model.sample_count))
+  if b'stco' in updated or (offset_shift and layout is None):
+    result.update(model.pack(atoms[b'stsc'], atoms[stco_tag], atoms[b'stsz']))
+  if budget is not None and budget.spilled:
+    log.append('Moved {} of {} tables to temporary files'.format(
+      sizeof_fmt(budget.spilled), data_format))
+  extended = sorted(tag.decode('ascii') for tag in updated if tag not in SAMPLE_TABLE_TAGS[:4])
+  if extended:
+    log.append('Extending {} {} tables'.format(data_format, ', '.join(extended)))
+  for tag in updated:
+    if tag not in SAMPLE_TABLE_TAGS[1:4]:
+      result[tag] = atoms[tag].pack()
+  if b'stts' in updated:
+    log.append('Adjusting sample count from {} to {}'.format(stts_count, model.sample_count))
+    return log, result, sum(itertools.starmap(operator.mul, atoms[b'stts'].table))
+  return log, result, None
+
+
+def _fix_sample_tables_task(args):
+  return fix_sample_tables(*args)
+
+
+def fix_metadata(scale_factor, moov, jobs=1, memory_limit=None, layouts=None, offset_shift=0,
+    log=print):
   """
   Attempts to update the metadata in the `moov` atom, scaling the duration
   and sample counts by the specified *scale_factor*.
@@ -68,19 +219,36 @@ def fix_metadata(scale_factor, moov):
   * trak > tkhd
   * trak > edts > elst
   * trak > mdia > mdhd
-  * trak > mdia > minf > {stts, stco, stsz}
+  * trak > mdia > minf > stbl > {stts, stsc, stco, stsz, ctts, stss, stps,
+    sdtp, sbgp}
 
   Any time-code track (with data_format `tmcd`) will be removed.
+
+  If *jobs* is greater than one, the sample tables of the tracks are
+  extended in a pool of that many processes (see #fix_sample_tables()).
+  The result is the same as when processing them one after another. The
+  *memory_limit* is shared between the processes.
+
+  *layouts* may map the indices of `trak` atoms to the layouts of their
+  chunks in the repaired file, which replace the extended chunks of these
+  tracks (see #fix_sample_tables()). The chunk offsets of the other tracks
+  are moved by *offset_shift* bytes, if the `mdat` data begins at another
+  offset in the repaired file than in the reference file.
+
+  The messages about the updated atoms are passed to the *log* function.
   """
 
+  import movatoms
+
   updated_atoms = []
 
   # Find a new duration for the new file based on the size of the reference
   # file's duration and sample size in bytes.
-  def get_new_duration(atom):
+  def get_new_duration(atom, new_duration=None):
     time_scale, ref_duration = struct.unpack('>II', atom.data[12:20])
-    new_duration = int(scale_factor * ref_duration)
-    print('Adjusting "{}" duration from {}s to {}s.'.format(
+    if new_duration is None:
+      new_duration = int(scale_factor * ref_duration)
+    log('Adjusting "{}" duration from {}s to {}s.'.format(
         atom.tag.decode('ascii', 'ignore'),
         ref_duration/time_scale,
         new_duration/time_scale))
@@ -103,15 +271,15 @@ def fix_metadata(scale_factor, moov):
     rate = struct.unpack('>I', elst.data[16:20])[0]
     values = [flag, 1, new_duration, 0, rate]
     elst.edit()[:] = struct.pack('>IIIII', *values)
-  for mdhd in moov.find_atoms(b'trak', b'mdia', b'mdhd'):
-    updated_atoms.append(mdhd)
-    mdhd_dur = get_new_duration(mdhd)[1]
-    mdhd.edit()[16:20] = struct.pack('>I', mdhd_dur)
 
   # Adjust the sample information for the changed duration and sample count.
-  for minf in moov.find_atoms(b'trak', b'mdia', b'minf'):
-    vmhd = next(iter(minf.find_atoms(b'vmhd')), None)
-    for stbl in minf.find_atoms(b'stbl'):
+  # The tables of every track are processed independently (and possibly in
+  # parallel), the results are applied in the original order of the tracks.
+  tracks = []
+  for index, trak in enumerate(moov.find_atoms(b'trak')):
+    mdhd = trak.find_atoms(b'mdia', b'mdhd')[0]
+    for stbl in trak.find_atoms(b'mdia', b'minf', b'stbl'):
+      track_log = []
 
       # Sample description atom
       desc_atom = stbl.find_atoms(b'stsd')[0]
@@ -119,87 +287,316 @@ def fix_metadata(scale_factor, moov):
       data_format = desc.descriptions[0].data_format
 
       if data_format == b'tmcd':
-        print('Removing tmcd track')
-        assert minf.parent.parent.tag == b'trak'
-        moov.atoms.remove(minf.parent.parent)
-
-      # Time-to-sample atom
-      stts_atom = stbl.find_atoms(b'stts')[0]
-      stts = movatoms.stts.unpack(stts_atom.data)
-      if data_format != b'tmcd':
-        table = []
-        for nsamples, sample_duration in stts.table:
-          nsamples_new = int(nsamples * scale_factor)
-          print('Adjusting sample count from {} to {}'.format(nsamples, nsamples_new))
-          table.append((nsamples_new, sample_duration))
-        stts_atom.data = stts.pack()
-        updated_atoms.append(stts_atom)
-
-      # Chunk Offset atom
-      stco_atom = stbl.find_atoms(b'stco')[0]
-      stco = movatoms.stco.unpack(stco_atom.data)
-      if len(stco.table) > 1:
-        print('Extending {} chunk offset table'.format(data_format))
-        count = int(len(stco.table) * scale_factor)
-        deltas = calc_item_delta(stco.table)
-        repn = guess_sequence_repitition_length(deltas)
-        offset = len(deltas) % repn
-        for i in range(count-len(stco.table)):
-          delta = deltas[offset+(i%repn)]
-          stco.table.append(stco.table[-1]+delta)
-        stco_atom.data = stco.pack()
-        updated_atoms.append(stco_atom)
-
-      # Sample Size atom
-      stsz_atom = stbl.find_atoms(b'stsz')[0]
-      stsz = movatoms.stsz.unpack(stsz_atom.data)
-      if len(stsz.table) > 1:
-        count = int(len(stsz.table) * scale_factor)
-        deltas = calc_item_delta(stsz.table)
-        repn = guess_sequence_repitition_length(deltas)
-        print('Extending {} sample size table (table size: {}, guesssed repartition length: {})'
-              .format(data_format, len(stsz.table), repn))
-        offset = len(deltas) % repn
-        for i in range(count-len(stsz.table)):
-          delta = deltas[offset+(i%repn)]
-          stsz.table.append(stsz.table[-1]+delta)
-        stsz_atom.data = stsz.pack()
-        updated_atoms.append(stsz_atom)
-
-  print('Updated moov atoms:', ', '.join(x.tag.decode('ascii', 'ignore') for x in updated_atoms))
-
-
-def repair_file(reference, broken, output, do_fix_metadata=True):
+        track_log.append('Removing tmcd track')
+        moov.atoms.remove(trak)
+        moov.invalidate()
+
+      table_atoms = collections.OrderedDict((atom.tag, atom)
+        for atom in stbl.iter_atoms() if atom.tag in SAMPLE_TABLE_TAGS)
+      tracks.append((mdhd, track_log, table_atoms, (scale_factor, data_format,
+        {tag: bytes(atom.data) for tag, atom in table_atoms.items()}),
+        (layouts or {}).get(index)))
+
+  if jobs > 1 and len(tracks) > 1:
+    if memory_limit:
+      memory_limit //= min(jobs, len(tracks))
+    tracks = [x[:3] + (x[3] + (memory_limit, x[4], offset_shift), x[4]) for x in tracks]
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+      results = list(executor.map(_fix_sample_tables_task, [x[3] for x in tracks]))
+  else:
+    results = [fix_sample_tables(*x[3], memory_limit=memory_limit, layout=x[4],
+      offset_shift=offset_shift) for x in tracks]
+
+  # The duration of the media is that of its new samples, if we know it.
+  for (mdhd, track_log, table_atoms, args, layout), (table_log, table_data, duration) in zip(tracks, results):
+    updated_atoms.append(mdhd)
+    mdhd_dur = get_new_duration(mdhd, duration)[1]
+    mdhd.edit()[16:20] = struct.pack('>I', mdhd_dur)
+
+  for (mdhd, track_log, table_atoms, args, layout), (table_log, table_data, duration) in zip(tracks, results):
+    for line in track_log + table_log:
+      log(line)
+    for tag, atom in table_atoms.items():
+      if tag in (b'stco', b'co64') and tag not in table_data:
+        # The chunk offsets may have moved to a co64 atom.
+        tag = next((x for x in (b'stco', b'co64') if x in table_data), tag)
+        atom.tag = tag
+      if tag in table_data:
+        atom.data = table_data[tag]
+        updated_atoms.append(atom)
+
+  log('Updated moov atoms:', ', '.join(x.tag.decode('ascii', 'ignore') for x in updated_atoms))
+  return updated_atoms
+
+
+def open_file(filename, mode):
   """
-  Tries to repair the *broken* file using the *reference* file and writes it
-  to the *output* file. This function will transfer all sections from the
-  *reference* file to the *output* file, except for the `mdat` atom which is
-  taken from the *broken* file instead.
+  Opens *filename* in binary *mode*. If *filename* is `-`, the standard input
+  or output stream is returned instead (depending on the *mode*), without
+  closing it when the returned file object is closed.
+  """
+
+  if filename == '-':
+    stream = sys.__stdin__ if 'r' in mode else sys.__stdout__
+    return io.open(stream.fileno(), mode, closefd=False)
+  return open(filename, mode)
+
+
+def get_data_offset(atoms, data_size):
+  """
+  Returns the offset of the `mdat` data in a file that consists of the
+  *atoms* (#MovAtomD#s, where the `mdat` atom is a placeholder) if the
+  `mdat` atom has *data_size* bytes of data.
+  """
+
+  offset = get_header_size(data_size)
+  for atom in atoms:
+    if atom.tag == b'mdat':
+      return offset
+    offset += atom.calculate_size()
+  raise ValueError('no mdat atom')
+
+
+class RepairPlan(object):
+  """
+  Describes the layout of a repaired output file, as computed by
+  #plan_repair(). The plan contains the (already fixed) atoms taken from the
+  reference file in memory and the location of the `mdat` atom in the broken
+  file, which has a header of *mdat_header_size* bytes and extends to its
+  end. It can be serialized with #to_json() and executed later with
+  #execute_plan() without analyzing the input files again.
+
+  The `mdat` data is written with a 64-bit size if it needs one, so the
+  #output_mdat_size may differ from the *mdat_size* in the broken file.
+  """
+
+  def __init__(self, atoms, broken_size, mdat_offset, mdat_size,
+      scale_factor=None, updated_atoms=(), duration=None, mdat_header_size=8):
+    self.atoms = atoms
+    self.broken_size = broken_size
+    self.mdat_offset = mdat_offset
+    self.mdat_size = mdat_size
+    self.mdat_header_size = mdat_header_size
+    self.scale_factor = scale_factor
+    self.updated_atoms = list(updated_atoms)
+    self.duration = duration
+    self.mdat_reader = None
+
+  @property
+  def mdat_data_size(self):
+    return self.mdat_size - self.mdat_header_size
+
+  @property
+  def output_mdat_size(self):
+    return self.mdat_data_size + get_header_size(self.mdat_data_size)
+
+  @property
+  def output_data_offset(self):
+    """
+    The offset of the `mdat` data in the output file.
+    """
+
+    return get_data_offset(self.atoms, self.mdat_data_size)
+
+  @property
+  def layout(self):
+    """
+    A list of `(tag, size)` pairs for every atom in the output file.
+    """
+
+    return [(atom.tag, self.output_mdat_size if atom.tag == b'mdat' else atom.calculate_size())
+      for atom in self.atoms]
+
+  @property
+  def output_size(self):
+    return sum(size for tag, size in self.layout)
+
+  def open_mdat(self, broken):
+    """
+    Returns a #MovAtomR for the `mdat` atom in the *broken* file that is
+    positioned at the beginning of its data.
+    """
+
+    if self.mdat_reader is not None and self.mdat_reader.file is broken:
+      return self.mdat_reader
+    mdat = MovAtomR(broken)
+    mdat.tag = b'mdat'
+    mdat.atom_begin = self.mdat_offset
+    mdat.size = self.mdat_size
+    mdat.header_size = mdat.bytes_read = self.mdat_header_size
+    if is_seekable(broken):
+      broken.seek(self.mdat_offset + self.mdat_header_size)
+    else:
+      skip_bytes(broken, self.mdat_offset + self.mdat_header_size)
+    return mdat
+
+  def to_json(self):
+    import base64
+    atoms = []
+    for atom in self.atoms:
+      data = None
+      if atom.tag != b'mdat':
+        buffer = io.BytesIO()
+        atom.write(buffer)
+        data = base64.b64encode(buffer.getvalue()[8:]).decode('ascii')
+      atoms.append({'tag': atom.tag.decode('latin1'), 'data': data})
+    return {
+      'broken_size': self.broken_size,
+      'mdat_offset': self.mdat_offset,
+      'mdat_size': self.mdat_size,
+      'mdat_header_size': self.mdat_header_size,
+      'output_size': self.output_size,
+      'scale_factor': self.scale_factor,
+      'duration': self.duration,
+      'updated_atoms': self.updated_atoms,
+      'layout': [[tag.decode('latin1'), size] for tag, size in self.layout],
+      'atoms': atoms,
+    }
+
+  @classmethod
+  def from_json(cls, data):
+    import base64
+    atoms = []
+    for item in data['atoms']:
+      tag = item['tag'].encode('latin1')
+      if item['data'] is None:
+        atoms.append(MovAtomD(tag, b''))
+      else:
+        atoms.append(MovAtomD(tag, base64.b64decode(item['data'])))
+    return cls(atoms, data['broken_size'], data['mdat_offset'],
+      data['mdat_size'], data['scale_factor'], data['updated_atoms'],
+      data['duration'], data.get('mdat_header_size', 8))
 
-  We assume the order of atoms in the reference file is the same as the
-  order of atoms in the broken input file.
+
+class ReferenceTemplate(object):
+  """
+  The atoms of a reference file other than its `mdat`, held in memory, and
+  the size and #data_offset of the `mdat` in the reference file. A template
+  can be loaded once and used to plan any number of repairs, see
+  #instantiate().
   """
 
-  # Extract the meta information atoms from the reference file.
-  reference_atoms = collections.OrderedDict()
-  end_file_offset = 0
-  for atom in MovAtomR.make_root(reference).iter_atoms():
-    if atom.tag != b'mdat':
-      # We keep track of the number of bytes used in the reference file for
-      # atoms after the mdat atom.
-      if b'mdat' in reference_atoms:
-        end_file_offset += atom.size
+  def __init__(self, atoms, mdat_size, data_offset):
+    self.atoms = atoms
+    self.mdat_size = mdat_size
+    self.data_offset = data_offset
+
+  @classmethod
+  def load(cls, reference):
+    """
+    Reads the atoms of the *reference* file. The `moov` atom is moved after
+    the `mdat` atom, as we need to update it after we write the broken
+    file's mdat.
+    """
+
+    atoms = collections.OrderedDict()
+    mdat_size = None
+    for atom in MovAtomR.make_root(reference).iter_atoms():
+      if atom.tag == b'mdat':
+        mdat_size = atom.size
+        data_offset = atom.atom_begin + atom.header_size
+        atoms[atom.tag] = None
+        continue
+
+      # Ensure that we have the moov atom after the mdat atom.
+      if b'moov' in atoms:
+        atoms[b'moov'] = atoms.pop(b'moov')
 
       # Read in the full contents of this atom into memory.
-      atom = atom.to_atomd()
+      atoms[atom.tag] = atom.read_data()
+
+    if mdat_size is None:
+      raise MovFileError('reference file has no mdat atom')
+    return cls(atoms, mdat_size, data_offset)
+
+  def instantiate(self):
+    """
+    Returns an ordered dictionary of new #MovAtomD objects for the atoms of
+    the template, which can be modified without affecting the template. The
+    `mdat` atom is represented by an empty leaf atom.
+    """
+
+    return collections.OrderedDict((tag, MovAtomD(tag, data or b''))
+      for tag, data in self.atoms.items())
+
+
+def detect_layouts(reference_atoms, mdat, broken_size, log=print):
+  """
+  Detects the chunks of the audio and video track of the reference file in
+  the data of the broken file's `mdat` atom (see #movdetect.detect_layout())
+  and returns a dictionary that maps the indices of their `trak` atoms to
+  their layouts in the output file, as accepted by #fix_metadata(). Returns
+  #None if the layout can not be detected.
+  """
+
+  import movdetect
+
+  mdat_begin = 0
+  for tag, atom in reference_atoms.items():
+    if tag == b'mdat':
+      break
+    if tag == b'moov':
+      log('warning: can not detect the chunk layout when the moov atom precedes the mdat atom')
+      return None
+    mdat_begin += atom.calculate_size()
+  if not is_seekable(mdat.file):
+    log('warning: can not detect the chunk layout of a broken file that is not seekable')
+    return None
+
+  position = mdat.file.tell()
+  try:
+    tracks, runs = movdetect.detect_layout(mdat.file, mdat.atom_begin + mdat.header_size,
+      broken_size, reference_atoms[b'moov'])
+  except movdetect.DetectError as exc:
+    log('warning: could not detect the chunk layout ({}), extending the '
+      'layout of the reference file instead'.format(exc))
+    return None
+  finally:
+    mdat.file.seek(position)
+  log('Detected {} runs of audio and video data in the mdat'.format(len(runs)))
+
+  # The data of the mdat is copied from after its header in the broken file
+  # (see #RepairPlan.open_mdat()).
+  data_size = mdat.size - mdat.header_size
+  shift = mdat_begin + get_header_size(data_size) - (mdat.atom_begin + mdat.header_size)
+  return {track.index: track.to_layout(shift) for track in tracks}
+
 
-      # Ensure that we have the moov atom after the mdat atom. We need
-      # this for later as we need to update it after we write the broken
-      # file's mdat.
-      if b'moov' in reference_atoms:
-        reference_atoms[b'moov'] = reference_atoms.pop(b'moov')
+def plan_repair(reference, broken, do_fix_metadata=True, broken_size=None, jobs=1,
+    trim=False, memory_limit=None, detect_layout=False, log=print):
+  """
+  Analyzes the *reference* and *broken* files and returns a #RepairPlan for
+  the repaired output file, or #None if the broken file can not be repaired.
+  Only the atoms of the reference file other than its `mdat` are read, so
+  planning a repair is cheap compared to executing it.
+
+  The output contains all sections from the *reference* file, except for the
+  `mdat` atom which is taken from the *broken* file instead. We assume the
+  order of atoms in the reference file is the same as the order of atoms in
+  the broken input file.
+
+  None of the files need to be seekable. If the *broken* file is not
+  seekable, its total size must be specified with *broken_size*. The
+  *reference* can also be a #ReferenceTemplate that was loaded before. The
+  number of *jobs* and the *memory_limit* are passed to #fix_metadata().
 
-    reference_atoms[atom.tag] = atom
+  If *trim* is #True, the sample tables are trimmed to the samples that are
+  completely contained in the output file's `mdat` (see
+  #movtables.trim_movie()).
+
+  If *detect_layout* is #True, the chunks of the audio and video track are
+  detected in the broken file (which must be seekable) instead of
+  extrapolating them from the reference file (see #detect_layouts()).
+
+  The progress and error messages are passed to the *log* function instead
+  of being printed, eg. to collect them per file when repairing several
+  files concurrently.
+  """
+
+  if not isinstance(reference, ReferenceTemplate):
+    reference = ReferenceTemplate.load(reference)
+  reference_atoms = reference.instantiate()
 
   # Find the `mdat` atom in the broken input file. Do NOT read it so we
   # can stream its contents to the output file later.
@@ -208,69 +605,471 @@ def repair_file(reference, broken, output, do_fix_metadata=True):
       mdat = atom
       break
   else:
-    print('error: could not find mdat atom in broken input file')
-    return 1
+    log('error: could not find mdat atom in broken input file')
+    return None
 
   # We assume that the header of the mdat is broken and we need to adjust
-  # for the atoms after the mdat section (#end_file_offset).
-  mdat_size = get_file_size_via_seek(mdat.file) - mdat.atom_begin# - end_file_offset
-  print('Broken file\'s mdat size adjusted from {} to {}'.format(
+  # for the size of the file.
+  if broken_size is None:
+    if not is_seekable(mdat.file):
+      log('error: the size of the broken input file must be specified '
+        'when it is not seekable')
+      return None
+    broken_size = get_file_size_via_seek(mdat.file)
+  mdat_size = broken_size - mdat.atom_begin
+  log('Broken file\'s mdat size adjusted from {} to {}'.format(
       sizeof_fmt(mdat.size), sizeof_fmt(mdat_size)))
   mdat.size = mdat_size
 
+  # The chunk offsets of the reference file are moved with the mdat data,
+  # eg. if its header grows to 64 bits.
+  data_offset = get_data_offset(reference_atoms.values(), mdat_size - mdat.header_size)
+
   # Update the duration and sample counts in the metadata.
+  scale_factor = None
+  updated_atoms = []
   if do_fix_metadata:
-    scale_factor = mdat.size / float(reference_atoms[b'mdat'].size)
-    print('Scale factor to fix metadata:', scale_factor)
-    fix_metadata(scale_factor, reference_atoms[b'moov'])
+    scale_factor = mdat.size / float(reference.mdat_size)
+    log('Scale factor to fix metadata:', scale_factor)
+    layouts = None
+    if detect_layout:
+      layouts = detect_layouts(reference_atoms, mdat, broken_size, log)
+    updated_atoms = fix_metadata(scale_factor, reference_atoms[b'moov'], jobs,
+      memory_limit, layouts, data_offset - reference.data_offset, log)
+  if trim:
+    import movtables
+    trimmed, trimmed_atoms = movtables.trim_movie(reference_atoms[b'moov'],
+      data_offset + mdat_size - mdat.header_size)
+    for track, removed in trimmed:
+      log('Trimming track {} to the end of the mdat ({} samples removed)'.format(track, removed))
+    updated_atoms += [x for x in trimmed_atoms if x not in updated_atoms]
+  time_scale, duration = struct.unpack('>II',
+    reference_atoms[b'moov'].find_atoms(b'mvhd')[0].data[12:20])
 
-  # Write the reference file's atoms and the mdat from the broken file.
-  for atom in reference_atoms.values():
-    if atom.tag == b'mdat':
-      with MovAtomW(output, mdat_size, atom.tag) as writer:
-        for chunk in mdat.iter_data(1024):
-          writer.write(chunk)
-    else:
-      atom.write(output)
+  plan = RepairPlan(list(reference_atoms.values()), broken_size, mdat.atom_begin, mdat_size,
+    scale_factor, [x.tag.decode('ascii', 'ignore') for x in updated_atoms],
+    duration / float(time_scale), mdat.header_size)
+  plan.mdat_reader = mdat
+  return plan
+
+
+def execute_plan(plan, broken, output, checkpoint=None, resume=False,
+    hash_algorithms=None, stats=None, sparse=False, buffer_size=None, buffer_depth=None,
+    log=print):
+  """
+  Writes the repaired file described by the #RepairPlan *plan* to the
+  *output* file, streaming the `mdat` data from the *broken* file.
+
+  If a #Checkpoint is specified, the progress of the `mdat` copy is recorded
+  in its sidecar file. With *resume* set to #True, the copy continues after
+  the data committed in the sidecar file instead (this requires the *broken*
+  and *output* files to be seekable).
+
+  If *hash_algorithms* is specified, digests of the `mdat` data and of the
+  full output file are computed on a background thread while copying. The
+  digests and other information about the repair are stored in the *stats*
+  dictionary, if specified.
+
+  If *sparse* is #True, runs of zeros in the `mdat` data are not written but
+  left as holes in the *output* file, which must be seekable.
+
+  The `mdat` data is read ahead on a background thread in *buffer_depth*
+  buffers of *buffer_size* bytes while it is written (see
+  #movcopy.ReadAhead). The defaults are #movcopy.BUFFER_DEPTH buffers of
+  #movcopy.COPY_CHUNKSIZE bytes, a *buffer_depth* of 0 disables the thread.
+
+  Messages are passed to the *log* function (see #plan_repair()).
+  """
+
+  import movcopy
+
+  if stats is None:
+    stats = {}
+  if plan.scale_factor is not None:
+    stats['scale_factor'] = plan.scale_factor
+    stats['updated_atoms'] = plan.updated_atoms
+  stats['mdat_size'] = plan.output_mdat_size
+  stats['output_size'] = plan.output_size
+
+  if is_seekable(broken) and get_file_size_via_seek(broken) != plan.broken_size:
+    log('error: the size of the broken input file does not match the plan')
+    return 1
+  mdat = plan.open_mdat(broken)
+
+  # Continue after the last committed mdat data of an interrupted repair.
+  mdat_committed = 0
+  output_offset = 0
+  if checkpoint:
+    checkpoint.file = output
+    checkpoint.layout = plan.layout
+    if resume:
+      try:
+        checkpoint.load()
+      except movcopy.CheckpointError as exc:
+        log('error: can not resume from checkpoint:', exc)
+        return 1
+      mdat_committed = checkpoint.committed
+      output_offset = checkpoint.mdat_offset + mdat_committed
+      mdat.seek_data(mdat_committed)
+      log('Resuming after {} of mdat data'.format(sizeof_fmt(mdat_committed)))
+
+  # Reserve the disk space for the output file in advance to reduce
+  # fragmentation of the (possibly very large) output file. This would
+  # defeat the purpose of writing a sparse file.
+  if not sparse:
+    preallocate(output, plan.output_size - output_offset)
+
+  # Hash the data on a background thread while it is written. The data
+  # that was written before resuming is read back from the output file.
+  hasher = mdat_digests = None
+  if hash_algorithms:
+    hasher = movcopy.HashingThread()
+    mdat_digests = movcopy.Digests(hash_algorithms)
+    output_digests = movcopy.Digests(hash_algorithms)
+    if resume:
+      movcopy.hash_file_range(output, 0, checkpoint.mdat_offset, hasher, output_digests)
+      movcopy.hash_file_range(output, checkpoint.mdat_offset, output_offset, hasher,
+        output_digests, mdat_digests)
+    output = movcopy.HashingWriter(output, hasher, output_digests)
+
+  # Write the reference file's atoms and the mdat from the broken file. When
+  # resuming, the atoms before the mdat have already been written.
+  mdat_written = False
+  try:
+    for atom in plan.atoms:
+      if atom.tag == b'mdat':
+        if resume:
+          writer = MovAtomW.resume(output, plan.output_mdat_size, atom.tag, mdat_committed)
+        else:
+          writer = MovAtomW(output, plan.output_mdat_size, atom.tag)
+        with writer:
+          skipped = movcopy.copy_mdat(mdat, writer, buffer_size or movcopy.COPY_CHUNKSIZE,
+            checkpoint=checkpoint, hasher=hasher, digests=mdat_digests, sparse=sparse,
+            depth=movcopy.BUFFER_DEPTH if buffer_depth is None else buffer_depth)
+        mdat_written = True
+      elif mdat_written or not resume:
+        atom.write(output)
+  finally:
+    if hasher:
+      hasher.close()
+  if checkpoint:
+    checkpoint.remove()
+
+  if sparse:
+    stats['sparse_bytes'] = skipped
+    log('Skipped {} of zeros in mdat'.format(sizeof_fmt(skipped)))
+  if hasher:
+    stats['digests'] = {'mdat': mdat_digests.hexdigests(),
+      'output': output_digests.hexdigests()}
+    for name, value in sorted(stats['digests']['output'].items()):
+      log('Output {}: {}'.format(name, value))
   return 0
 
 
-def main():
-  parser = argparse.ArgumentParser()
-  parser.add_argument('file', help='A working video file. If no additional '
-    'options are specified, the to-level atoms of this file will be displayed.')
-  parser.add_argument('-o', '--output', help='The repaired output filename.')
+def repair_file(reference, broken, output, do_fix_metadata=True, broken_size=None,
+    jobs=1, trim=False, memory_limit=None, detect_layout=False, log=print, **kwargs):
+  """
+  Tries to repair the *broken* file using the *reference* file and writes it
+  to the *output* file. This is a combination of #plan_repair() and
+  #execute_plan(), additional keyword arguments are passed to the latter.
+  """
+
+  plan = plan_repair(reference, broken, do_fix_metadata, broken_size, jobs, trim,
+    memory_limit, detect_layout, log)
+  if plan is None:
+    return 1
+  return execute_plan(plan, broken, output, log=log, **kwargs)
+
+
+#: Commands that are implemented in separate modules. They are dispatched to
+#: by #main() if the first argument matches the command name.
+COMMANDS = {
+  'daemon': 'movdaemon',
+  'detect': 'movdetect',
+  'diff': 'movdiff',
+  'inventory': 'movinventory',
+  'join': 'movjoin',
+  'query': 'movquery',
+}
+
+
+def list_atoms(filename):
+  """
+  Prints the size of the file *filename* and its top-level atoms.
+  """
+
+  with open_file(filename, 'rb') as fp:
+    if is_seekable(fp):
+      print('file size:', sizeof_fmt(get_file_size_via_seek(fp)))
+    for atom in MovAtomR.make_root(fp).iter_atoms():
+      print('* {} ({})'.format(atom.tag.decode('ascii', 'ignore'), sizeof_fmt(atom.size)))
+  return 0
+
+
+def verify_file(filename):
+  """
+  Verifies the sample tables of the file *filename* and prints the results
+  (see #movverify). Returns 0 if no errors were found.
+  """
+
+  import movverify
+  with open_file(filename, 'rb') as fp:
+    if not is_seekable(fp):
+      print('error: can not verify "{}", it is not seekable'.format(filename))
+      return 1
+    reports, errors = movverify.verify_file(fp)
+  return 1 if movverify.print_report(reports, errors) else 0
+
+
+def main(argv=None):
+  if argv is None:
+    argv = sys.argv[1:]
+  if argv and argv[0] in COMMANDS:
+    import importlib
+    module = importlib.import_module(COMMANDS[argv[0]])
+    return module.main(argv[1:])
+
+  # Fast path for listing the atoms of a file, which is the most common
+  # invocation in scripts.
+  if len(argv) == 1 and (argv[0] == '-' or not argv[0].startswith('-')):
+    return list_atoms(argv[0])
+
+  import argparse
+  import json
+  import movcopy
+
+  parser = argparse.ArgumentParser(
+    epilog='Additional commands: ' + ', '.join(sorted(COMMANDS)) +
+      ' (use `movrepair.py COMMAND --help` for details).')
+  parser.add_argument('file', nargs='?', help='A working video file. If no '
+    'additional options are specified, the to-level atoms of this file will '
+    'be displayed. Pass `-` to read from stdin.')
+  parser.add_argument('-o', '--output', help='The repaired output filename. '
+    'Pass `-` to write to stdout.')
   parser.add_argument('-R', '--repair',
-    help='A file to repair using the working input file.')
+    help='A file to repair using the working input file. Pass `-` to read '
+      'from stdin.')
+  parser.add_argument('--input-size', type=int, metavar='BYTES',
+    help='The total size of the REPAIR file in bytes. Required if it is read '
+      'from a pipe.')
   parser.add_argument('--no-fix-metadata', action='store_true',
     help='Don\'t try to fix the `moov` atom metadata duration and sample '
       'counts. This will require the input FILE to be the same length or '
       'longer than the REPAIR file.')
+  parser.add_argument('--trim', action='store_true',
+    help='Remove the samples from the sample tables that would lie past the '
+      'end of the repaired file\'s mdat, and shorten the durations '
+      'accordingly.')
+  parser.add_argument('--detect-layout', action='store_true',
+    help='Detect the chunks of the PCM audio and the video track in the '
+      'REPAIR file\'s mdat instead of extrapolating them from FILE. Requires '
+      'a seekable REPAIR file.')
+  parser.add_argument('--memory-limit', type=parse_size, metavar='SIZE',
+    help='Move large sample tables to temporary memory-mapped files instead '
+      'of holding more than SIZE (eg. 512M or 2G) of them in memory, and '
+      'report the peak memory usage.')
+  parser.add_argument('--extract', type=parse_time_range, metavar='START-END',
+    help='Write the time range START-END (in seconds or [HH:]MM:SS, END may '
+      'be omitted) of FILE to OUTPUT, starting at the keyframe at or before '
+      'START. Only the data of the range is copied.')
   parser.add_argument('--dump-moov', action='store_true',
     help='Dump the input FILE\'s `moov` atom to stdout.')
-  args = parser.parse_args()
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+    help='The number of processes to extend the sample tables of the tracks '
+      'in. Default: 1')
+  parser.add_argument('--checkpoint', action='store_true',
+    help='Record the progress of the repair in a OUTPUT.checkpoint sidecar '
+      'file, allowing to --resume it if it is interrupted.')
+  parser.add_argument('--checkpoint-interval', type=int, default=256, metavar='MIB',
+    help='Sync the output file and update the checkpoint every MIB MiB of '
+      'mdat data. Default: 256')
+  parser.add_argument('--checkpoint-crc', action='store_true',
+    help='Record a CRC32 of the committed mdat data in the checkpoint and '
+      'verify it when resuming.')
+  parser.add_argument('--resume', action='store_true',
+    help='Resume an interrupted repair from its checkpoint sidecar file. '
+      'Implies --checkpoint.')
+  parser.add_argument('--hash', metavar='ALGORITHMS',
+    help='A comma-separated list of hash algorithms (eg. sha256, md5, crc32 or '
+      'adler32) to compute over the mdat data and the output file while '
+      'repairing.')
+  parser.add_argument('--sparse', action='store_true',
+    help='Leave runs of zeros in the mdat data as holes in the OUTPUT file '
+      'instead of writing them.')
+  parser.add_argument('--buffer-size', type=parse_size, metavar='SIZE',
+    default=movcopy.COPY_CHUNKSIZE,
+    help='The size of the buffers that the mdat data is read into while the '
+      'previous ones are written. Default: {}'.format(sizeof_fmt(movcopy.COPY_CHUNKSIZE)))
+  parser.add_argument('--buffer-depth', type=int, metavar='N',
+    default=movcopy.BUFFER_DEPTH,
+    help='The number of buffers that the mdat data is read ahead. 0 reads and '
+      'writes alternately in one thread. Default: {}'.format(movcopy.BUFFER_DEPTH))
+  parser.add_argument('--stats-json', metavar='FILENAME',
+    help='Write information about the repair, including the digests computed '
+      'with --hash, to a JSON file.')
+  parser.add_argument('--plan', nargs='?', const='-', metavar='FILENAME',
+    help='Only compute the layout and metadata of the repaired file and write '
+      'the plan as JSON to FILENAME (or stdout), without writing the output '
+      'file.')
+  parser.add_argument('--apply-plan', metavar='FILENAME',
+    help='Execute a plan created with --plan. The REPAIR and OUTPUT files '
+      'default to the ones the plan was created for. FILE is not needed.')
+  parser.add_argument('--follow', action='store_true',
+    help='Keep appending the data that is written to the REPAIR file to the '
+      'OUTPUT file and update its moov atom, until the REPAIR file did not '
+      'grow for --idle-timeout seconds.')
+  parser.add_argument('--follow-interval', type=float, default=2.0, metavar='SECONDS',
+    help='How often to check the REPAIR file for new data with --follow. '
+      'Default: 2')
+  parser.add_argument('--idle-timeout', type=float, default=60.0, metavar='SECONDS',
+    help='Stop following the REPAIR file after it did not grow for SECONDS. '
+      'Default: 60')
+  parser.add_argument('--verify', action='store_true',
+    help='Check the sample tables of the OUTPUT file (or FILE, if nothing is '
+      'repaired) against the mdat bounds, each other and the track '
+      'durations, and spot-check the headers of some samples.')
+  args = parser.parse_args(argv)
+
+  if not args.file and not args.apply_plan:
+    parser.error('the following arguments are required: file')
+  if args.file == '-' and args.repair == '-':
+    parser.error('FILE and REPAIR can not both be read from stdin')
+  if args.detect_layout and (args.repair == '-' or args.no_fix_metadata):
+    parser.error('--detect-layout requires a seekable REPAIR file and can not '
+      'be combined with --no-fix-metadata')
 
   if args.dump_moov:
-    with open(args.file, 'rb') as fp:
+    import movatoms
+    with open_file(args.file, 'rb') as fp:
       for atom in MovAtomR.make_root(fp).iter_atoms():
         if atom.tag == b'moov':
           moov = movatoms.moov.unpack(atom.read_data())
     moov.pretty_print()
-  elif args.repair:
+  elif args.extract:
+    if args.repair or args.apply_plan:
+      parser.error('--extract can not be combined with --repair or --apply-plan')
+    if args.file == '-' or args.output == '-':
+      parser.error('--extract requires seekable files')
+    if not args.output:
+      name, ext = os.path.splitext(args.file)
+      args.output = name + '-extract' + ext
+    import movextract
+    print('Output file:', args.output)
+    # Write to a temporary file, so that an existing output file is only
+    # replaced once the segment was extracted.
+    temp_filename = args.output + '.part'
+    try:
+      with open(args.file, 'rb') as fp, open(temp_filename, 'wb') as output:
+        start, duration = movextract.extract_segment(fp, output, *args.extract)
+      os.replace(temp_filename, args.output)
+    except ValueError as exc:
+      print('error:', exc)
+      return 1
+    finally:
+      if os.path.exists(temp_filename):
+        os.remove(temp_filename)
+    print('Extracted {}s starting at {}s'.format(duration, start))
+    if args.verify:
+      return verify_file(args.output)
+    return 0
+  elif args.plan and args.repair:
+    if args.plan == '-':
+      # Keep stdout clean for the plan.
+      sys.stdout = sys.stderr
+    with open_file(args.file, 'rb') as reference, open_file(args.repair, 'rb') as broken:
+      plan = plan_repair(reference, broken, do_fix_metadata=not args.no_fix_metadata,
+        broken_size=args.input_size, jobs=args.jobs, trim=args.trim,
+        memory_limit=args.memory_limit, detect_layout=args.detect_layout)
+    if plan is None:
+      return 1
+    data = plan.to_json()
+    data['broken'] = args.repair
+    data['output'] = args.output
+    print('Planned output size: {}, duration: {}s'.format(
+      sizeof_fmt(plan.output_size), plan.duration))
+    with open_file(args.plan, 'w') as fp:
+      json.dump(data, fp, indent=2)
+      fp.write('\n')
+    return 0
+  elif args.repair or args.apply_plan:
+    plan = None
+    if args.apply_plan:
+      with open(args.apply_plan) as fp:
+        data = json.load(fp)
+      plan = RepairPlan.from_json(data)
+      args.repair = args.repair or data['broken']
+      args.output = args.output or data['output']
     if not args.output:
+      if args.repair == '-':
+        parser.error('--output is required when REPAIR is read from stdin')
       name, ext = os.path.splitext(args.repair)
       args.output = name + '-fixed' + ext
+    if args.output == '-':
+      # Keep stdout clean for the repaired file's data.
+      sys.stdout = sys.stderr
+    checkpoint = None
+    resume = False
+    if args.checkpoint or args.resume:
+      if args.output == '-' or args.repair == '-':
+        parser.error('--checkpoint and --resume require seekable files')
+      checkpoint = movcopy.Checkpoint(args.output + '.checkpoint',
+        args.checkpoint_interval * 1024 * 1024, args.checkpoint_crc)
+      resume = args.resume and os.path.exists(checkpoint.filename)
+    if args.sparse and args.output == '-':
+      parser.error('--sparse requires a seekable OUTPUT file')
+    if args.buffer_size < 1 or args.buffer_depth < 0:
+      parser.error('--buffer-size must be positive and --buffer-depth must not be negative')
+    if args.verify and args.output == '-':
+      parser.error('--verify requires the OUTPUT to be a file')
+    if args.follow:
+      if args.output == '-' or args.repair == '-':
+        parser.error('--follow requires seekable files')
+      if (args.apply_plan or checkpoint or args.hash or args.no_fix_metadata or args.trim
+          or args.detect_layout):
+        parser.error('--follow can not be combined with --apply-plan, '
+          '--checkpoint, --resume, --hash, --no-fix-metadata, --trim or --detect-layout')
+    hash_algorithms = args.hash.split(',') if args.hash else None
+    for name in hash_algorithms or ():
+      try:
+        movcopy.new_hash(name)
+      except ValueError:
+        parser.error('unsupported hash algorithm: {}'.format(name))
     print('Output file:', args.output)
-    with open(args.file, 'rb') as reference, \
-        open(args.repair, 'rb') as broken, \
-        open(args.output, 'wb') as output:
-      return repair_file(reference, broken, output, do_fix_metadata=not args.no_fix_metadata)
+    stats = {'reference': args.file, 'broken': args.repair, 'output': args.output}
+    if args.follow:
+      import movfollow
+      return movfollow.follow_file(args.file, args.repair, args.output,
+        args.follow_interval, args.idle_timeout, jobs=args.jobs, sparse=args.sparse)
+    with open_file(args.repair, 'rb') as broken:
+      if plan is None:
+        with open_file(args.file, 'rb') as reference:
+          plan = plan_repair(reference, broken, do_fix_metadata=not args.no_fix_metadata,
+            broken_size=args.input_size, jobs=args.jobs, trim=args.trim,
+            memory_limit=args.memory_limit, detect_layout=args.detect_layout)
+        if plan is None:
+          return 1
+      with open_file(args.output, 'r+b' if resume else 'wb') as output:
+        result = execute_plan(plan, broken, output, checkpoint=checkpoint,
+          resume=resume, hash_algorithms=hash_algorithms, stats=stats,
+          sparse=args.sparse, buffer_size=args.buffer_size,
+          buffer_depth=args.buffer_depth)
+    stats['peak_rss'] = get_peak_rss()
+    if args.memory_limit and stats['peak_rss'] is not None:
+      stats['memory_limit_exceeded'] = stats['peak_rss'] > args.memory_limit
+      print('Peak memory usage: {} (limit: {})'.format(
+        sizeof_fmt(stats['peak_rss']), sizeof_fmt(args.memory_limit)))
+      if stats['memory_limit_exceeded']:
+        print('warning: the peak memory usage exceeded the limit')
+    if result == 0 and args.stats_json:
+      with open(args.stats_json, 'w') as fp:
+        json.dump(stats, fp, indent=2, sort_keys=True)
+    if result == 0 and args.verify:
+      result = verify_file(args.output)
+    return result
+  elif args.verify:
+    return verify_file(args.file)
   else:
-    with open(args.file, 'rb') as fp:
-      print('file size:', sizeof_fmt(get_file_size_via_seek(fp)))
-      for atom in MovAtomR.make_root(fp).iter_atoms():
-        print('* {} ({})'.format(atom.tag.decode('ascii', 'ignore'), sizeof_fmt(atom.size)))
-    return 0
+    return list_atoms(args.file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,941 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Operations on the sample tables of a track as a whole. The tables are decoded
+into #TableView#s and processed with #array.array#s and C-level iteration
+(#map(), #itertools.accumulate()), avoiding Python loops over every sample.
+"""
+
+from movio import MAX_ATOM_SIZE_32
+from movutils import TableView, get_array_format
+import array
+import bisect
+import io
+import itertools
+import mmap
+import operator
+import struct
+import tempfile
+
+import movatoms
+
+
+def expand_runs(first_chunks, values, total, start=0):
+  """
+  Expands a run-length encoded table (like the `stsc` table, where every run
+  starts at a 1-based chunk number in *first_chunks*) into an array of
+  *total* values, one for every chunk. If *start* is specified, the array
+  begins with the value of the chunk at that (0-based) index instead.
+  """
+
+  result = array.array('I')
+  for index, (first, value) in enumerate(zip(first_chunks, values)):
+    if index + 1 < len(first_chunks):
+      end = min(first_chunks[index + 1], total + 1)
+    else:
+      end = total + 1
+    first = max(first, start + 1)
+    if end > first:
+      result.extend(array.array('I', [value]) * (end - first))
+  return result
+
+
+def cumsum(values, initial=0):
+  """
+  Returns an array of the running totals of *values*, starting with
+  *initial* (thus with one more element than *values*).
+  """
+
+  return array.array('q', itertools.accumulate(itertools.chain((initial,), values)))
+
+
+#: The number of items at the end of a sequence in which #find_period()
+#: searches for a repeating pattern.
+PERIOD_WINDOW = 4096
+
+#: The number of items that #iter_extension() yields at once.
+EXTEND_BLOCKSIZE = 64 * 1024
+
+
+def find_period(seq, window=PERIOD_WINDOW):
+  """
+  Returns the length of the pattern that the end of *seq* repeats, or #None
+  if it does not repeat. Only the last *window* items are considered, of
+  which the repetitions must cover at least half and which must contain at
+  least two of them. The items only need to support `==`.
+
+  The periods of all suffixes are computed at once with the prefix function
+  of the reversed window (as in the Knuth-Morris-Pratt algorithm), so this
+  takes linear time.
+  """
+
+  items = list(seq[-window:])[::-1]
+  prefix = [0] * len(items)
+  for index in range(1, len(items)):
+    length = prefix[index - 1]
+    while length and items[index] != items[length]:
+      length = prefix[length - 1]
+    if items[index] == items[length]:
+      length += 1
+    prefix[index] = length
+  for length in range(len(items), max(1, (len(items) - 1) // 2), -1):
+    period = length - prefix[length - 1]
+    if 2 * period <= length:
+      return period
+  return None
+
+
+def guess_sequence_repitition_length(seq):
+  """
+  Returns the length of the pattern that the end of *seq* repeats (see
+  #find_period()), or 1 if it does not repeat.
+  """
+
+  return find_period(seq) or 1
+
+
+def calc_item_delta(sequence):
+  return array.array('q', map(operator.sub, sequence[1:], sequence[:-1]))
+
+
+def sequence_pattern(values, deltas=True):
+  """
+  Returns the pattern that continues the sequence *values* as an array:
+  the last repetition of its repeating pattern (see #find_period()), or
+  the last #PERIOD_WINDOW items if there is none. If *deltas* is #True, the
+  pattern consists of the differences between the items.
+  """
+
+  values = values[-(PERIOD_WINDOW + 1):]
+  pattern = calc_item_delta(values) if deltas else array.array('q', values)
+  if not pattern:
+    return array.array('q', [0] if deltas else values)
+  period = find_period(pattern) or min(len(pattern), PERIOD_WINDOW)
+  return pattern[len(pattern) - period:]
+
+
+def iter_extension(values, count, deltas=True, pattern=None, blocksize=EXTEND_BLOCKSIZE):
+  """
+  Yields arrays of the items that continue the sequence *values* to *count*
+  items (see #extend_sequence()), about *blocksize* items at a time, so that
+  the extension does not need to be in memory as a whole.
+  """
+
+  nitems = count - len(values)
+  if nitems <= 0 or not len(values):
+    return
+  if pattern is None:
+    pattern = sequence_pattern(values, deltas)
+  period = 0
+  if deltas:
+    period = sum(pattern)
+    pattern = array.array('q', itertools.islice(itertools.accumulate(
+      itertools.chain((values[-1],), pattern)), 1, None))
+
+  # Every item of the pattern grows by *period* in every repetition.
+  size = len(pattern)
+  total = -(-nitems // size)
+  step = max(1, blocksize // size)
+  for first in range(0, total, step):
+    repetitions = min(step, total - first)
+    if period == 0:
+      block = pattern * repetitions
+    elif repetitions == 1:
+      block = array.array('q', map(operator.add, pattern, itertools.repeat(first * period)))
+    else:
+      block = array.array('q', bytes(8 * repetitions * size))
+      for index, value in enumerate(pattern):
+        start = value + first * period
+        block[index::size] = array.array('q', range(start, start + repetitions * period, period))
+    del block[nitems - first * size:]
+    yield block
+
+
+def extend_sequence(values, count, deltas=True, pattern=None):
+  """
+  Returns an array of *count* items that continues the sequence *values*
+  with its repeating pattern (see #sequence_pattern(), which is used if no
+  *pattern* is specified). If *deltas* is #True, the differences between
+  the items repeat, otherwise the items themselves. The sequence is never
+  shortened.
+  """
+
+  result = array.array('q', values)
+  for block in iter_extension(result, count, deltas, pattern):
+    result.extend(block)
+  return result
+
+
+def extend_runs(runs, total, count):
+  """
+  Extends the run-length encoded *runs* (a list of `(count, value)` tuples
+  that describe *total* items) to *count* items, continuing the repeating
+  pattern of the runs (see #find_period()) without expanding them. Runs of
+  the same value that meet are merged. Returns a new list of runs.
+  """
+
+  runs = list(runs)
+  if count <= total or not runs:
+    return runs
+  period = find_period(runs) or min(len(runs), PERIOD_WINDOW)
+  pattern = runs[len(runs) - period:]
+  nitems = count - total
+
+  # Where the pattern meets its next repetition, its last and first run
+  # are merged if they have the same value.
+  if all(value == pattern[0][1] for _, value in pattern):
+    extension = [(nitems, pattern[0][1])]
+  else:
+    if pattern[-1][1] == pattern[0][1]:
+      head = pattern[:1]
+      unit = pattern[1:-1] + [(pattern[-1][0] + pattern[0][0], pattern[0][1])]
+    else:
+      head, unit = [], pattern
+    ends = cumsum((x[0] for x in unit), sum(x[0] for x in head))
+    repetitions, remainder = divmod(nitems - ends[0], ends[-1] - ends[0])
+    if repetitions < 0:
+      extension = [(nitems, head[0][1])]
+    else:
+      # The first runs of the unit until *remainder* more items.
+      index = bisect.bisect_left(ends, ends[0] + remainder, 1)
+      extension = head + unit * repetitions + unit[:index - 1]
+      if remainder:
+        extension.append((ends[0] + remainder - ends[index - 1], unit[index - 1][1]))
+  if extension[0][1] == runs[-1][1]:
+    runs[-1] = (runs[-1][0] + extension.pop(0)[0], runs[-1][1])
+  return runs + extension
+
+
+def extend_sample_runs(table, sample_count, nsamples):
+  """
+  Extends a run-length encoded per-sample *table* (the #TableView of a
+  `ctts` or `sbgp` atom) from *sample_count* to *nsamples* samples,
+  continuing the repeating pattern of its runs (see #extend_runs()).
+  Returns a list of the new entries, or #None if the table does not
+  describe every sample and can not be extended.
+  """
+
+  runs = list(table)
+  if sum(x[0] for x in runs) != sample_count or nsamples <= sample_count:
+    return None
+  return extend_runs(runs, sample_count, nsamples)
+
+
+def extend_sample_numbers(table, sample_count, nsamples):
+  """
+  Extends a table of increasing (1-based) sample numbers (the #TableView of
+  an `stss` or `stps` atom) from *sample_count* to *nsamples* samples,
+  continuing the repeating pattern of the distances between the samples.
+  Returns an array of the new sample numbers, or #None if the table can not
+  be extended.
+  """
+
+  values = table.toarray()
+  if len(values) < 2 or nsamples <= sample_count or values[-1] > sample_count:
+    return None
+  pattern = sequence_pattern(values)
+  if min(pattern) <= 0:
+    return None
+  # Every repetition of the pattern advances by the sum of its distances.
+  count = len(values) + ((nsamples - values[-1]) // sum(pattern) + 1) * len(pattern)
+  result = extend_sequence(values, count, pattern=pattern)
+  return result[:bisect.bisect_right(result, nsamples)]
+
+
+def resize_stts(table, nsamples):
+  """
+  Returns a copy of the entries of the `stts` *table* (a list of `(count,
+  duration)` tuples) that describes exactly *nsamples* samples. Entries
+  past *nsamples* are removed, missing samples are added to the last entry.
+  """
+
+  entries = list(table)
+  totals = cumsum(x[0] for x in entries)
+  if totals[-1] > nsamples:
+    if nsamples == 0:
+      return []
+    index = bisect.bisect_left(totals, nsamples, 1)
+    entries = entries[:index]
+    entries[-1] = (nsamples - totals[index - 1], entries[-1][1])
+  elif totals[-1] < nsamples and entries:
+    entries[-1] = (entries[-1][0] + nsamples - totals[-1], entries[-1][1])
+  return entries
+
+
+def slice_runs(table, start, stop):
+  """
+  Returns the entries of the run-length encoded *table* (a sequence of
+  `(count, value)` tuples, like the `stts` table) that describe the samples
+  from *start* to *stop* (exclusive), as a list of `(count, value)` tuples.
+  """
+
+  result = []
+  total = 0
+  for count, value in table:
+    begin, end = max(start, total), min(stop, total + count)
+    if end > begin:
+      result.append((end - begin, value))
+    total += count
+    if total >= stop:
+      break
+  return result
+
+
+def sample_at_time(table, time):
+  """
+  Returns the index of the last sample of the `stts` *table* that starts at
+  or before the media *time* and its start time. If *time* is past the end
+  of the table, the number of samples and the total duration are returned.
+  """
+
+  sample = elapsed = 0
+  for count, duration in table:
+    if duration and time < elapsed + count * duration:
+      index = max(0, (time - elapsed) // duration)
+      return sample + index, elapsed + index * duration
+    sample += count
+    elapsed += count * duration
+  return sample, elapsed
+
+
+def sample_time(table, sample):
+  """
+  Returns the start time of the (0-based) *sample* according to the `stts`
+  *table*.
+  """
+
+  elapsed = 0
+  for count, duration in table:
+    if sample < count:
+      return elapsed + sample * duration
+    sample -= count
+    elapsed += count * duration
+  return elapsed
+
+
+def locate_sample(table, sample):
+  """
+  Returns the (0-based) index of the chunk that contains the (0-based)
+  *sample* according to the `stsc` *table* and the index of the first sample
+  in that chunk. The last run of the table extends indefinitely.
+  """
+
+  first_sample = 0
+  runs = list(table)
+  for index, (first_chunk, count, description) in enumerate(runs):
+    if index + 1 < len(runs):
+      run_samples = (runs[index + 1][0] - first_chunk) * count
+      if sample >= first_sample + run_samples:
+        first_sample += run_samples
+        continue
+    chunk = (sample - first_sample) // count
+    return first_chunk - 1 + chunk, first_sample + chunk * count
+  raise ValueError('empty stsc table')
+
+
+def pack_table(obj, fmt, items):
+  """
+  Packs the struct *obj* (an `stsz`, `stco` or `co64` struct, whose table
+  follows the number of its entries) with a table of the flat *items* in
+  the format *fmt* and returns the data. The items are packed in slices
+  straight into the data, so that they can be a #memoryview of a large
+  array (see #MemoryBudget) that is never copied as a whole. The table of
+  *obj* becomes a view of the data.
+  """
+
+  obj.table = TableView(fmt)
+  typecode, width, byteswap = get_array_format(obj.table.fmt)
+  header = obj.pack()
+  fp = io.BytesIO()
+  fp.write(header[:-4])
+  fp.write(struct.pack('>I', len(items) // width))
+  for start in range(0, len(items), EXTEND_BLOCKSIZE):
+    block = array.array(typecode, items[start:start + EXTEND_BLOCKSIZE])
+    if byteswap:
+      block.byteswap()
+    fp.write(block)
+  data = fp.getvalue()
+  obj.table = TableView(fmt, memoryview(data)[len(header):])
+  return data
+
+
+def pack_stsz(stsz, sample_count, sample_sizes=None):
+  """
+  Packs the `stsz` struct *stsz*. If it has a constant sample size,
+  *sample_count* is written as the number of samples (which the struct does
+  not keep track of). Otherwise, the table is replaced by the
+  *sample_sizes*, if they are specified (see #pack_table()).
+  """
+
+  if sample_sizes is not None and stsz.size == 0:
+    return pack_table(stsz, stsz.table.fmt, sample_sizes)
+  data = stsz.pack()
+  if stsz.size != 0:
+    data = data[:8] + struct.pack('>I', sample_count) + data[12:]
+  return data
+
+
+def pack_chunk_offsets(stco, offsets):
+  """
+  Replaces the table of the `stco` or `co64` struct *stco* with the chunk
+  *offsets* and returns the tag and the packed data of the atom (see
+  #pack_table()). If an offset does not fit into the 32 bits of an `stco`
+  atom, a `co64` atom with the same version and flags is packed instead.
+  """
+
+  if isinstance(stco, movatoms.stco) and len(offsets) and max(offsets) > MAX_ATOM_SIZE_32:
+    stco = movatoms.co64(v=stco.v, flags=stco.flags, table=None)
+  fmt = '>Q' if isinstance(stco, movatoms.co64) else '>I'
+  return type(stco).__name__.encode('ascii'), pack_table(stco, fmt, offsets)
+
+
+def extend_tables(model, atoms, nchunks, scale_factor=1.0, sample_count=None):
+  """
+  Extends the #ChunkModel *model* of a track to *nchunks* chunks and the
+  other sample tables of the track to its new number of samples. *atoms*
+  maps the tags of the atoms in the `stbl` to their unpacked structs (the
+  `stts` is required, `ctts`, `sbgp`, `stss`, `stps` and `sdtp` are
+  extended if they are present). The entries of the `stts` are scaled by
+  *scale_factor* before it is resized to the number of samples.
+
+  If the *model* replaces the one of the atoms (eg. with chunks that were
+  detected in the `mdat`), it is not extended and *sample_count* must be
+  the number of samples that the other tables describe.
+
+  Returns a list of the tags of the updated structs. The `stsc`, `stco` and
+  `stsz` tables are included if the model could be extended, but they are
+  only updated by #ChunkModel.pack().
+  """
+
+  updated = []
+  if sample_count is not None:
+    updated += [b'stsc', b'stco', b'stsz']
+  else:
+    sample_count = model.sample_count
+    if len(model) > 1:
+      model.extend(nchunks)
+      updated += [b'stsc', b'stco', b'stsz']
+  nsamples = model.sample_count
+
+  # Tables with an entry for every sample (or runs of samples).
+  for tag in (b'ctts', b'sbgp'):
+    if tag in atoms:
+      table = extend_sample_runs(atoms[tag].table, sample_count, nsamples)
+      if table is not None:
+        atoms[tag].table = table
+        updated.append(tag)
+  for tag in (b'stss', b'stps'):
+    if tag in atoms:
+      table = extend_sample_numbers(atoms[tag].table, sample_count, nsamples)
+      if table is not None:
+        atoms[tag].table = TableView.fromarray(atoms[tag].table.fmt, table)
+        updated.append(tag)
+  sdtp = atoms.get(b'sdtp')
+  if sdtp is not None and len(sdtp.table) == sample_count and nsamples > sample_count:
+    sdtp.table = TableView.fromarray(sdtp.table.fmt,
+      extend_sequence(sdtp.table.toarray(), nsamples, deltas=False))
+    updated.append(b'sdtp')
+
+  stts = atoms[b'stts']
+  table = resize_stts([(int(count * scale_factor), duration)
+    for count, duration in stts.table], nsamples)
+  if stts.table != table:
+    stts.table = table
+    updated.append(b'stts')
+  return updated
+
+
+class MemoryBudget(object):
+  """
+  Keeps the large arrays of sample tables within a memory *limit* (in
+  bytes). Arrays of at least *threshold* bytes that are passed to #keep()
+  once the limit is reached are moved into temporary memory-mapped files,
+  which the operating system can page out. They are replaced by
+  #memoryview#s that support the same read-only operations (indexing,
+  slicing, iteration and #len()). Arrays that are generated in parts are
+  passed to #keep_blocks() instead, which writes the parts to the file
+  right away.
+  """
+
+  def __init__(self, limit, threshold=1024 * 1024):
+    self.limit = limit
+    self.threshold = threshold
+    self.used = 0
+    self.spilled = 0
+    self._maps = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def keep(self, items):
+    """
+    Accounts for the array *items* and returns it, or a #memoryview of a
+    copy of it in a memory-mapped file if it would exceed the limit.
+    """
+
+    nbytes = len(items) * items.itemsize
+    if nbytes < self.threshold:
+      return items
+    if isinstance(items, array.array) and self.used + nbytes > self.limit:
+      return self.spill(items)
+    self.used += nbytes
+    return items
+
+  def keep_blocks(self, blocks, count, typecode='q'):
+    """
+    Like #keep() for an array of *count* items with the *typecode*, of
+    which *blocks* yields the parts (as arrays or other buffers). If the
+    array would exceed the limit, the parts are written to a temporary
+    memory-mapped file as they are generated, so that the array is never
+    in memory as a whole.
+    """
+
+    nbytes = count * array.array(typecode).itemsize
+    if nbytes < self.threshold or self.used + nbytes <= self.limit:
+      items = array.array(typecode)
+      for block in blocks:
+        items.frombytes(memoryview(block).cast('B'))
+      return self.keep(items)
+    return self._map(blocks, typecode)
+
+  def release(self, items):
+    """
+    Stops accounting for the array *items* that was passed to #keep().
+    """
+
+    nbytes = len(items) * items.itemsize
+    if isinstance(items, array.array) and nbytes >= self.threshold:
+      self.used = max(0, self.used - nbytes)
+
+  def spill(self, items):
+    """
+    Moves the array *items* into a temporary memory-mapped file and returns
+    a #memoryview of it.
+    """
+
+    return self._map((items,), items.typecode)
+
+  def _map(self, blocks, typecode):
+    with tempfile.TemporaryFile() as fp:
+      for block in blocks:
+        fp.write(block)
+      nbytes = fp.tell()
+      fp.flush()
+      data = mmap.mmap(fp.fileno(), 0)
+    self._maps.append(data)
+    self.spilled += nbytes
+    return memoryview(data).cast(typecode)
+
+  def close(self):
+    """
+    Unmaps the spilled arrays. Arrays that are still referenced stay
+    mapped until they are garbage collected.
+    """
+
+    for data in self._maps:
+      try:
+        data.close()
+      except BufferError:
+        pass
+    self._maps = []
+
+
+class ChunkModel(object):
+  """
+  The chunks of a track as described by its `stsc`, `stco` and `stsz`
+  tables together. Every chunk has an offset, the index of its first sample
+  and a sample count, which are stored in compact arrays. The sizes of the
+  samples are stored in *sample_sizes*, unless all samples have the same
+  *sample_size*.
+
+  The model is extended as a unit with #extend() and packed back into all
+  three tables with #pack(), so that they always agree with each other.
+  """
+
+  def __init__(self, offsets, counts, descriptions, sample_sizes=None, sample_size=0,
+               budget=None):
+    self.offsets = array.array('q', offsets)
+    self.counts = array.array('q', counts)
+    self.descriptions = array.array('q', descriptions)
+    self.sample_sizes = None if sample_sizes is None else array.array('q', sample_sizes)
+    self.sample_size = sample_size
+    self.budget = budget
+    self._first_samples = None
+    self._keep()
+
+  @classmethod
+  def from_atoms(cls, stsc, stco, stsz, budget=None):
+    """
+    Creates a #ChunkModel from the unpacked `stsc`, `stco` and `stsz`
+    structs. The arrays of the model are kept within the #MemoryBudget
+    *budget*, if one is specified.
+    """
+
+    offsets = stco.table.toarray()
+    table = stsc.table.toarray()
+    counts = expand_runs(table[0::3], table[1::3], len(offsets))
+    descriptions = expand_runs(table[0::3], table[2::3], len(offsets))
+    if len(counts) < len(offsets):
+      raise ValueError('stsc describes only {} of {} chunks'.format(len(counts), len(offsets)))
+    if stsz.size != 0:
+      return cls(offsets, counts, descriptions, sample_size=stsz.size, budget=budget)
+    sample_sizes = stsz.table.toarray()
+    if sum(counts) > len(sample_sizes):
+      raise ValueError('chunks reference more samples than there are')
+    return cls(offsets, counts, descriptions, sample_sizes, budget=budget)
+
+  @classmethod
+  def from_tables(cls, tables):
+    """
+    Creates a #ChunkModel from a #TrackTables object.
+    """
+
+    return cls.from_atoms(tables.stsc, tables.stco, tables.stsz)
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def __getitem__(self, index):
+    return (self.offsets[index], self.first_samples[index], self.counts[index])
+
+  def __iter__(self):
+    return zip(self.offsets, self.first_samples, self.counts)
+
+  @property
+  def first_samples(self):
+    if self._first_samples is None:
+      self._first_samples = cumsum(self.counts)[:-1]
+    return self._first_samples
+
+  @property
+  def sample_count(self):
+    return sum(self.counts)
+
+  def extend(self, nchunks):
+    """
+    Extends the model to *nchunks* chunks. The offsets of the new chunks
+    continue the repeating pattern of the differences between the existing
+    ones, the sample counts and sample descriptions of the chunks and the
+    sizes of their samples continue their repeating pattern (or repeat the
+    last ones, see #sequence_pattern()). Does nothing if the model has at
+    least *nchunks* chunks.
+    """
+
+    if nchunks <= len(self.offsets):
+      return
+    self._release()
+    self.offsets = self._extend(self.offsets, nchunks, True)
+    self.counts = self._extend(self.counts, nchunks, False)
+    self.descriptions = self._extend(self.descriptions, nchunks, False)
+    self._first_samples = None
+    if self.sample_sizes is not None:
+      self.sample_sizes = self._extend(self.sample_sizes, self.sample_count, False)
+
+  def _extend(self, items, count, deltas):
+    # Extends the array *items*. With a budget, the new items are written
+    # to its file as they are generated if the array exceeds the limit.
+    if self.budget is None:
+      return extend_sequence(items, count, deltas)
+    blocks = itertools.chain((items,), iter_extension(items, count, deltas))
+    return self.budget.keep_blocks(blocks, max(count, len(items)))
+
+  def _keep(self):
+    if self.budget is not None:
+      for name in ('offsets', 'counts', 'descriptions', 'sample_sizes'):
+        items = getattr(self, name)
+        if items is not None:
+          setattr(self, name, self.budget.keep(items))
+
+  def _release(self):
+    if self.budget is not None:
+      for items in (self.offsets, self.counts, self.descriptions, self.sample_sizes):
+        if items is not None:
+          self.budget.release(items)
+
+  def pack(self, stsc, stco, stsz):
+    """
+    Updates the tables of the `stsc`, `stco` (or `co64`) and `stsz` structs
+    from the model and returns a list of the tags and the packed data of the
+    three atoms. The chunk offsets are packed as a `co64` atom if they do not
+    fit into the `stco` atom (see #pack_chunk_offsets()).
+    """
+
+    # Start a new run of chunks wherever the sample count or the sample
+    # description changes.
+    changes = itertools.compress(itertools.count(1), map(operator.or_,
+      map(operator.ne, self.counts[1:], self.counts[:-1]),
+      map(operator.ne, self.descriptions[1:], self.descriptions[:-1])))
+    stsc.table = [(index + 1, self.counts[index], self.descriptions[index])
+      for index in itertools.chain((0,) if self.offsets else (), changes)]
+    sample_sizes = None
+    if self.sample_sizes is not None:
+      sample_sizes = memoryview(self.sample_sizes)[:self.sample_count]
+    return [(b'stsc', stsc.pack()), pack_chunk_offsets(stco, self.offsets),
+      (b'stsz', pack_stsz(stsz, self.sample_count, sample_sizes))]
+
+  def shift(self, delta):
+    """
+    Moves all chunks by *delta* bytes, eg. because the data of the `mdat`
+    starts at a different offset in the file.
+    """
+
+    if self.budget is not None:
+      self.budget.release(self.offsets)
+    self.offsets = array.array('q', map(operator.add, self.offsets, itertools.repeat(delta)))
+    if self.budget is not None:
+      self.offsets = self.budget.keep(self.offsets)
+
+
+class TrackTables(object):
+  """
+  The sample tables of a single track, decoded from a `trak` #MovAtomD.
+  """
+
+  def __init__(self, trak):
+    self.trak = trak
+    mdhd = trak.find_atoms(b'mdia', b'mdhd')[0]
+    self.time_scale, self.duration = struct.unpack('>II', mdhd.data[12:20])
+    stbl = trak.find_atoms(b'mdia', b'minf', b'stbl')[0]
+    self.stbl = stbl
+    stsd = movatoms.stsd.unpack(stbl.find_atoms(b'stsd')[0].data)
+    self.data_format = stsd.descriptions[0].data_format
+    self.stts = movatoms.stts.unpack(stbl.find_atoms(b'stts')[0].data)
+    self.stsc = movatoms.stsc.unpack(stbl.find_atoms(b'stsc')[0].data)
+    stsz_atom = stbl.find_atoms(b'stsz')[0]
+    self.stsz = movatoms.stsz.unpack(stsz_atom.data)
+    # The sample count of an stsz atom with a constant sample size is not
+    # exposed by the struct (it has no table).
+    self.stsz_count = struct.unpack_from('>I', stsz_atom.data, 8)[0]
+    # The chunk offsets are stored in an `stco` or (for files larger than
+    # 4 GiB) a `co64` atom with the same layout.
+    self.stco_atom = (stbl.find_atoms(b'stco') or stbl.find_atoms(b'co64'))[0]
+    self.stco = getattr(movatoms, self.stco_atom.tag.decode('ascii')).unpack(self.stco_atom.data)
+    stss_atoms = stbl.find_atoms(b'stss')
+    self.stss = movatoms.stss.unpack(stss_atoms[0].data) if stss_atoms else None
+
+  @property
+  def sample_count(self):
+    """
+    The number of samples according to the `stsz` table, or #None if it has
+    a constant sample size and does not record the number of samples.
+    """
+
+    if self.stsz.size == 0:
+      return len(self.stsz.table)
+    return self.stsz_count or None
+
+  def chunk_offsets(self):
+    """
+    Returns an array with the offsets of all chunks.
+    """
+
+    return self.stco.table.toarray()
+
+  def chunk_sample_counts(self):
+    """
+    Returns an array with the number of samples in every chunk.
+    """
+
+    table = self.stsc.table.toarray()
+    return expand_runs(table[0::3], table[1::3], len(self.stco.table))
+
+  def sample_offsets(self, count=None):
+    """
+    Returns an array with the cumulative sizes of the samples (with one more
+    element than there are samples). *count* is the number of samples to
+    assume if the `stsz` table has a constant sample size.
+    """
+
+    if self.stsz.size != 0:
+      if count is None:
+        count = self.sample_count
+      size = self.stsz.size
+      return array.array('q', range(0, (count + 1) * size, size))
+    return cumsum(self.stsz.table.toarray())
+
+  def chunk_sizes(self, counts=None, offsets=None):
+    """
+    Returns an array with the number of bytes of every chunk.
+    """
+
+    if counts is None:
+      counts = self.chunk_sample_counts()
+    if offsets is None:
+      offsets = self.sample_offsets()
+    first_samples = cumsum(counts)
+    if first_samples[-1] >= len(offsets):
+      raise ValueError('chunks reference more samples than there are')
+    bounds = array.array('q', map(offsets.__getitem__, first_samples))
+    return array.array('q', map(operator.sub, bounds[1:], bounds[:-1]))
+
+  def stts_totals(self):
+    """
+    Returns the total number of samples and the total duration described by
+    the `stts` table.
+    """
+
+    table = self.stts.table.toarray()
+    counts, durations = table[0::2], table[1::2]
+    return sum(counts), sum(map(operator.mul, counts, durations))
+
+
+def trim_track(trak, end):
+  """
+  Trims the sample tables of the `trak` #MovAtomD *trak* to the samples that
+  lie completely before the file offset *end* (usually the end of the
+  `mdat` atom). The first chunk that exceeds *end* is cut after its last
+  complete sample, all chunks after it are removed. The `stco`, `stsz`,
+  `stsc` and `stts` atoms and the `mdhd` duration are updated.
+
+  Returns the number of removed samples and a list of the updated atoms.
+  """
+
+  tables = TrackTables(trak)
+  counts = tables.chunk_sample_counts()
+  first_samples = cumsum(counts)
+  total = first_samples[-1]
+  sample_count = tables.sample_count
+  if sample_count is None:
+    sample_count = total
+  if total > sample_count:
+    raise ValueError('chunks reference more samples than there are')
+  offsets = tables.sample_offsets(sample_count)
+  chunk_offsets = tables.chunk_offsets()[:len(counts)]
+  ends = map(operator.add, chunk_offsets, tables.chunk_sizes(counts, offsets))
+  chunk = next(itertools.compress(itertools.count(),
+    map(operator.gt, ends, itertools.repeat(end))), None)
+
+  if chunk is None:
+    nchunks, nsamples, fit = len(counts), total, None
+  else:
+    first = first_samples[chunk]
+    limit = offsets[first] + (end - chunk_offsets[chunk])
+    fit = bisect.bisect_right(offsets, limit, first + 1, first + counts[chunk] + 1) - first - 1
+    nchunks = chunk + (1 if fit > 0 else 0)
+    nsamples = first + fit
+
+  stbl = tables.stbl
+  updated = []
+  if nchunks < len(tables.stco.table):
+    tables.stco.table = tables.stco.table[:nchunks]
+    atom = tables.stco_atom
+    atom.data = tables.stco.pack()
+    updated.append(atom)
+
+  if nsamples < sample_count:
+    if tables.stsz.size == 0:
+      tables.stsz.table = tables.stsz.table[:nsamples]
+    atom = stbl.find_atoms(b'stsz')[0]
+    atom.data = pack_stsz(tables.stsz, nsamples)
+    updated.append(atom)
+
+  if fit is not None:
+    # Drop the runs of chunks that were removed and start a new run for the
+    # last chunk if it was cut.
+    table = tables.stsc.table.toarray()
+    runs = [tuple(table[i:i+3]) for i in range(0, len(table), 3) if table[i] <= nchunks]
+    if 0 < fit < counts[chunk]:
+      if runs[-1][0] == chunk + 1:
+        runs[-1] = (chunk + 1, fit, runs[-1][2])
+      else:
+        runs.append((chunk + 1, fit, runs[-1][2]))
+    if runs != list(tables.stsc.table):
+      tables.stsc.table = runs
+      atom = stbl.find_atoms(b'stsc')[0]
+      atom.data = tables.stsc.pack()
+      updated.append(atom)
+
+  if sum(x[0] for x in tables.stts.table) > nsamples:
+    tables.stts.table = resize_stts(tables.stts.table, nsamples)
+    atom = stbl.find_atoms(b'stts')[0]
+    atom.data = tables.stts.pack()
+    updated.append(atom)
+
+  if updated:
+    duration = sum(itertools.starmap(operator.mul, tables.stts.table))
+    if duration < tables.duration:
+      mdhd = trak.find_atoms(b'mdia', b'mdhd')[0]
+      mdhd.edit()[16:20] = struct.pack('>I', duration)
+      updated.append(mdhd)
+
+  return sample_count - nsamples, updated
+
+
+def trim_movie(moov, end):
+  """
+  Trims all tracks in the `moov` #MovAtomD with #trim_track(). The `tkhd`,
+  `elst` and `mvhd` durations of the trimmed tracks are reduced to match the
+  new `mdhd` durations.
+
+  Returns a list of `(track_number, removed_samples)` for every trimmed
+  track and a list of the updated atoms.
+  """
+
+  mvhd = moov.find_atoms(b'mvhd')[0]
+  movie_scale, movie_duration = struct.unpack('>II', mvhd.data[12:20])
+  trimmed = []
+  updated = []
+  track_durations = []
+  for index, trak in enumerate(moov.find_atoms(b'trak')):
+    tkhd = trak.find_atoms(b'tkhd')[0]
+    duration = struct.unpack('>I', tkhd.data[20:24])[0]
+    removed, track_updated = trim_track(trak, end)
+    if track_updated:
+      trimmed.append((index + 1, removed))
+      updated.extend(track_updated)
+      mdhd = trak.find_atoms(b'mdia', b'mdhd')[0]
+      time_scale, media_duration = struct.unpack('>II', mdhd.data[12:20])
+      new_duration = (media_duration * movie_scale + time_scale - 1) // time_scale
+      if new_duration < duration:
+        duration = new_duration
+        tkhd.edit()[20:24] = struct.pack('>I', duration)
+        updated.append(tkhd)
+        for elst in trak.find_atoms(b'edts', b'elst'):
+          if _clamp_edit_list(elst, duration):
+            updated.append(elst)
+    track_durations.append(duration)
+
+  if trimmed and track_durations and max(track_durations) < movie_duration:
+    mvhd.edit()[16:20] = struct.pack('>I', max(track_durations))
+    updated.append(mvhd)
+  return trimmed, updated
+
+
+def _clamp_edit_list(elst, duration):
+  # Shortens the segments of the edit list to a total of *duration* (in the
+  # movie's time scale). Returns True if the edit list was changed.
+  count = struct.unpack('>I', elst.data[4:8])[0]
+  data = elst.edit()
+  changed = False
+  total = 0
+  for index in range(count):
+    offset = 8 + index * 12
+    segment = struct.unpack('>I', data[offset:offset+4])[0]
+    new_segment = max(0, min(segment, duration - total))
+    if new_segment != segment:
+      data[offset:offset+4] = struct.pack('>I', new_segment)
+      changed = True
+    total += new_segment
+  return changed
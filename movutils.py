@@ -20,31 +20,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import array
 import io
+import re
 import struct
 import sys
 
-
-def with_metaclass(meta, *bases):
-  """Create a base class with a metaclass."""
-  return meta("NewBase", bases, {})
-
-
-class InitSubclassMeta(type):
-  """
-  Adds support for `__init_subclass__()` to classes before Python version 3.6.
-  """
-
-  # PEP 487 introduces __init_subclass__() in Python 3.6
-  if sys.version < '3.6':
-    def __new__(cls, name, bases, data):
-      if '__init_subclass__' in data:
-        data['__init_subclass__'] = classmethod(data['__init_subclass__'])
-      sub_class = super(InitSubclassMeta, cls).__new__(cls, name, bases, data)
-      sub_super = super(sub_class, sub_class)
-      if hasattr(sub_super, '__init_subclass__'):
-        sub_super.__init_subclass__()
-      return sub_class
+from collections.abc import MutableSequence
 
 
 class UnpackError(Exception):
@@ -86,14 +68,23 @@ class Field(object):
     elif not (hidden and name) and getter:
       raise ValueError('getter can only be used for named hidden fields')
     self.name = name
-    self.fmt = fmt
+    self._fmt = fmt
     self.getter = getter
     self.hidden = hidden
-    if not self.wraps_struct() and self.fmt is not None:
+
+  @property
+  def fmt(self):
+    """
+    The #Struct subclass wrapped by this field, or the #struct.Struct for
+    the field's format string. The latter is compiled on first access.
+    """
+
+    if isinstance(self._fmt, str):
       try:
-        self.fmt = struct.Struct(self.fmt)
+        self._fmt = struct.Struct(self._fmt)
       except struct.error as e:
-        raise struct.error('{} ({!r})'.format(e, self.fmt))
+        raise struct.error('{} ({!r})'.format(e, self._fmt))
+    return self._fmt
 
   def __eq__(self, other):
     if isinstance(other, Field):
@@ -111,10 +102,11 @@ class Field(object):
     return False
 
   def wraps_struct(self):
-    return isinstance(self.fmt, type) and issubclass(self.fmt, Struct)
+    return isinstance(self._fmt, type) and issubclass(self._fmt, Struct)
 
   def size(self):
     if self.wraps_struct():
+      self.fmt._prepare_()
       return self.fmt._struct_size_
     else:
       return self.fmt.size
@@ -152,33 +144,281 @@ class Field(object):
 class ListField(Field):
   """
   Represents a list of items that is repeated either a fixed number of times
-  or based on the value of another field.
+  or based on the value of another field. If *times* is #None, the items
+  fill the rest of the data (for plain struct formats only).
+
+  If *lazy* is #True (only for plain struct formats), the items are unpacked
+  into a #TableView instead of a #list, which decodes the items only when
+  they are accessed.
   """
 
-  def __init__(self, name, fmt, times):
+  def __init__(self, name, fmt, times, lazy=False):
     super(ListField, self).__init__(name, fmt)
     self.times = times
+    self.lazy = lazy
+    if lazy and self.wraps_struct():
+      raise ValueError('lazy ListField can not wrap a Struct')
+    if times is None and self.wraps_struct():
+      raise ValueError('ListField without times can not wrap a Struct')
 
   def size(self):
     return None
 
   def unpack_from_stream(self, ctx, fp):
-    if isinstance(self.times, str):
+    if self.times is None:
+      data = fp.read()
+      if len(data) % self.fmt.size != 0:
+        raise UnpackError('{}.{} expected a multiple of {} bytes (got {})'.format(
+            ctx.struct_type.__name__, self.name, self.fmt.size, len(data)))
+      times = len(data) // self.fmt.size
+      fp = io.BytesIO(data)
+    elif isinstance(self.times, str):
       times = ctx.field_values[self.times]
     elif callable(self.times):
       times = self.times(ctx)
     else:
       times = self.times
+    if self.lazy:
+      data = fp.read(times * self.fmt.size)
+      if len(data) != times * self.fmt.size:
+        raise UnpackError('{}.{} expected {} bytes (got {})'.format(
+            ctx.struct_type.__name__, self.name, times * self.fmt.size, len(data)))
+      return TableView(self.fmt, data)
     values = []
     for i in range(times):
       values.append(super(ListField, self).unpack_from_stream(ctx, fp))
     return values
 
   def pack_into_stream(self, struct_type, fp, items):
+    if isinstance(items, TableView) and items.fmt.format == self.fmt.format:
+      fp.write(items.tobuffer())
+      return
     for value in items:
       super(ListField, self).pack_into_stream(struct_type, fp, value)
 
 
+class TableView(MutableSequence):
+  """
+  A lazy sequence over the items of a packed table (eg. the chunk offsets of
+  an `stco` atom), where every item is described by the #struct.Struct
+  *fmt*. Items are decoded when they are accessed, slicing the view returns
+  another view over the same buffer.
+
+  The first modification of the table materializes all items into a compact
+  #array.array (or a #list, if the format consists of different types of
+  values). As long as the table is not modified, #tobuffer() returns the
+  original buffer without copying it.
+  """
+
+  def __init__(self, fmt, buffer=b''):
+    if not isinstance(fmt, struct.Struct):
+      fmt = struct.Struct(fmt)
+    if len(buffer) % fmt.size != 0:
+      raise ValueError('buffer size is not a multiple of the item size')
+    self.fmt = fmt
+    self._buffer = memoryview(buffer).cast('B')
+    self._items = None
+    self._typecode, self._width, self._byteswap = get_array_format(fmt)
+
+  def __repr__(self):
+    return 'TableView({!r})'.format(list(self))
+
+  def __len__(self):
+    if self._items is None:
+      return len(self._buffer) // self.fmt.size
+    if self._typecode is None:
+      return len(self._items)
+    return len(self._items) // self._width
+
+  def __iter__(self):
+    if self._items is None:
+      if self._width == 1:
+        return (x[0] for x in self.fmt.iter_unpack(self._buffer))
+      return self.fmt.iter_unpack(self._buffer)
+    if self._typecode is None or self._width == 1:
+      return iter(self._items)
+    return zip(*[iter(self._items)] * self._width)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      start, stop, step = index.indices(len(self))
+      if self._items is None and step == 1:
+        size = self.fmt.size
+        return TableView(self.fmt, self._buffer[start*size:max(start, stop)*size])
+      return [self[i] for i in range(start, stop, step)]
+    if index < 0:
+      index += len(self)
+    if index < 0 or index >= len(self):
+      raise IndexError('TableView index out of range')
+    if self._items is None:
+      value = self.fmt.unpack_from(self._buffer, index * self.fmt.size)
+      return value[0] if len(value) == 1 else value
+    if self._typecode is None or self._width == 1:
+      return self._items[index]
+    return tuple(self._items[index*self._width:(index+1)*self._width])
+
+  def __setitem__(self, index, value):
+    if isinstance(index, slice):
+      raise TypeError('TableView does not support slice assignment')
+    if index < 0:
+      index += len(self)
+    if index < 0 or index >= len(self):
+      raise IndexError('TableView index out of range')
+    items = self.materialize()
+    if self._typecode is None or self._width == 1:
+      items[index] = value
+    else:
+      items[index*self._width:(index+1)*self._width] = array.array(self._typecode, value)
+
+  def __delitem__(self, index):
+    if isinstance(index, slice):
+      raise TypeError('TableView does not support slice deletion')
+    if index < 0:
+      index += len(self)
+    items = self.materialize()
+    if self._typecode is None or self._width == 1:
+      del items[index]
+    else:
+      del items[index*self._width:(index+1)*self._width]
+
+  def __eq__(self, other):
+    if isinstance(other, TableView) and self._items is None and other._items is None:
+      return self.fmt.format == other.fmt.format and self._buffer == other._buffer
+    try:
+      if len(self) != len(other):
+        return False
+    except TypeError:
+      return False
+    return all(a == b for a, b in zip(self, other))
+
+  def __ne__(self, other):
+    return not (self == other)
+
+  __hash__ = None
+
+  def insert(self, index, value):
+    items = self.materialize()
+    if self._typecode is None or self._width == 1:
+      items.insert(index, value)
+    else:
+      if index < 0:
+        index += len(self)
+      index = max(0, min(index, len(self)))
+      items[index*self._width:index*self._width] = array.array(self._typecode, value)
+
+  def append(self, value):
+    items = self.materialize()
+    if self._typecode is None or self._width == 1:
+      items.append(value)
+    else:
+      items.extend(value)
+
+  def extend(self, values):
+    items = self.materialize()
+    if self._typecode is None or self._width == 1:
+      items.extend(values)
+    else:
+      for value in values:
+        items.extend(value)
+
+  def materialize(self):
+    """
+    Decodes all items into the compact representation that is used for
+    modifying the table and returns it.
+    """
+
+    if self._items is None:
+      if self._typecode is None:
+        items = list(self)
+      else:
+        items = self.toarray()
+      self._items = items
+      self._buffer = None
+    return self._items
+
+  def tolist(self):
+    return list(self)
+
+  @classmethod
+  def fromarray(cls, fmt, items):
+    """
+    Creates a #TableView from a flat sequence of values, the counterpart of
+    #toarray(). The view is materialized right away.
+    """
+
+    view = cls(fmt)
+    if view._typecode is None:
+      raise TypeError('format {!r} can not be represented as an array'.format(view.fmt.format))
+    view._items = array.array(view._typecode, items)
+    view._buffer = None
+    return view
+
+  def toarray(self):
+    """
+    Returns a flat #array.array with the values of all items (eg. `[count,
+    duration, count, duration, ...]` for the `stts` table). Raises a
+    #TypeError if the format can not be represented by an #array.array.
+    """
+
+    if self._typecode is None:
+      raise TypeError('format {!r} can not be represented as an array'.format(self.fmt.format))
+    if self._items is not None:
+      return array.array(self._typecode, self._items)
+    items = array.array(self._typecode)
+    items.frombytes(self._buffer)
+    if self._byteswap:
+      items.byteswap()
+    return items
+
+  def tobuffer(self):
+    """
+    Returns the packed items as a bytes-like object.
+    """
+
+    if self._items is None:
+      return self._buffer
+    if self._typecode is None:
+      return b''.join(self.fmt.pack(*(x if isinstance(x, tuple) else (x,)))
+        for x in self._items)
+    if not self._byteswap:
+      return self._items.tobytes()
+    items = array.array(self._typecode, self._items)
+    items.byteswap()
+    return items.tobytes()
+
+
+def get_array_format(fmt):
+  """
+  Given a #struct.Struct *fmt* that consists of only one type of integers,
+  returns the #array.array typecode for the integer type, the number of
+  integers in the format and whether the byte order of the format differs
+  from the native byte order. For any other format, `(None, 1, False)` is
+  returned.
+  """
+
+  format = fmt.format
+  if isinstance(format, bytes):
+    format = format.decode('ascii')
+  byteorder = format[:1] if format[:1] in '@=<>!' else '@'
+  codes = re.findall(r'(\d*)([a-zA-Z?])', format.lstrip('@=<>!'))
+  chars = set(c for n, c in codes)
+  if len(chars) != 1 or not chars <= set('bBhHiIlLqQ'):
+    return None, 1, False
+  char = chars.pop()
+  size = struct.calcsize('=' + char)
+  for typecode in ('bhilq' if char.islower() else 'BHILQ'):
+    if array.array(typecode).itemsize == size:
+      break
+  else:
+    return None, 1, False
+  width = sum(int(n or 1) for n, c in codes)
+  if byteorder in '@=':
+    byteswap = False
+  else:
+    byteswap = (byteorder == '<') != (sys.byteorder == 'little')
+  return typecode, width, byteswap
+
+
 class StringField(Field):
 
   def __init__(self, name, length):
@@ -189,6 +429,8 @@ class StringField(Field):
     return None
 
   def unpack_from_stream(self, ctx, fp):
+    if self.length is None:
+      return fp.read()
     if isinstance(self.length, str):
       length = ctx.field_values[self.length]
     elif callable(self.length):
@@ -205,34 +447,58 @@ class StringField(Field):
     fp.write(data)
 
 
-class Struct(with_metaclass(InitSubclassMeta)):
+class Struct(object):
   """
   Represents a C-structure that constist of #_Field#s.
+
+  The information derived from the #_fields_ of a subclass is computed when
+  the subclass is used for the first time (see #_prepare_()), so that
+  defining many structs is cheap. This includes the functions that unpack
+  and pack the subclass, which are generated for its fields (see
+  #StructCompiler). Structs with #Field subclasses that have their own
+  implementation (like the sub-atoms of the container atoms) use the
+  generic implementations #_unpack_fields_() and #_pack_fields_() instead,
+  as there is nothing to specialize for them.
   """
 
   # _fields_
   # _fields_map_
   # _visible_fields_
   # _struct_size_
+  # _unpack_
+  # _pack_
 
-  def __init_subclass__(cls, **kwargs):
-    cls._fields_map_ = {}
-    cls._visible_fields_ = []
+  @classmethod
+  def _prepare_(cls):
+    if '_fields_map_' in vars(cls):
+      return
+    fields_map = {}
+    visible_fields = []
     struct_size = 0
     for field in cls._fields_:
       if not field.hidden and field.name:
-        cls._visible_fields_.append(field)
+        visible_fields.append(field)
       if field.name:
-        cls._fields_map_[field.name] = field
+        fields_map[field.name] = field
       if struct_size is not None:
         field_size = field.size()
         if field_size is None:
           struct_size = None
         else:
           struct_size += field_size
+    cls._visible_fields_ = visible_fields
     cls._struct_size_ = struct_size
+    if StructCompiler.supports(cls):
+      compiler = StructCompiler(cls)
+      cls._unpack_ = staticmethod(compiler.compile_unpack())
+      cls._pack_ = staticmethod(compiler.compile_pack())
+    else:
+      cls._unpack_ = staticmethod(cls._unpack_fields_)
+      cls._pack_ = staticmethod(_pack_generic)
+    cls._fields_map_ = fields_map
 
   def __init__(self, *args, **kwargs):
+    self._prepare_()
     if len(args) > len(self._visible_fields_):
       raise TypeError('{}() expects at most {} positional arguments'.format(
           type(self).__name__, len(self._visible_fields_)))
@@ -297,7 +563,7 @@ class Struct(with_metaclass(InitSubclassMeta)):
       value = getattr(self, field.name)
       if isinstance(value, Struct):
         value.pretty_print(fp, indent, depth+1)
-      elif isinstance(value, list):
+      elif isinstance(value, (list, TableView)):
         fp.write('[\n')
         for i, item in enumerate(value):
           fp.write(indent * (depth+2))
@@ -320,6 +586,17 @@ class Struct(with_metaclass(InitSubclassMeta)):
 
   @classmethod
   def unpack_from_stream(cls, fp, ctx=None):
+    cls._prepare_()
+    return cls._unpack_(fp, ctx)
+
+  @classmethod
+  def unpack(cls, data, ctx=None):
+    return cls.unpack_from_stream(io.BytesIO(data), ctx)
+
+  @classmethod
+  def _unpack_fields_(cls, fp, ctx=None):
+    # The generic counterpart of the generated #_unpack_() function.
+    cls._prepare_()
     if ctx is None:
       ctx = UnpackContext(cls)
     for field in cls._fields_:
@@ -329,11 +606,8 @@ class Struct(with_metaclass(InitSubclassMeta)):
         ctx.init_values[field.name] = value
     return cls(**ctx.init_values)
 
-  @classmethod
-  def unpack(cls, data, ctx=None):
-    return cls.unpack_from_stream(io.BytesIO(data), ctx)
-
-  def pack_into_stream(self, fp):
+  def _pack_fields_(self, fp):
+    # The generic counterpart of the generated #_pack_() function.
     for field in self._fields_:
       if field.name:
         value = getattr(self, field.name)
@@ -341,7 +615,280 @@ class Struct(with_metaclass(InitSubclassMeta)):
         value = None
       field.pack_into_stream(type(self), fp, value)
 
+  def _pack_parts_(self):
+    # Returns a list of the packed fields' data.
+    self._prepare_()
+    return self._pack_(self)
+
+  def pack_into_stream(self, fp):
+    for data in self._pack_parts_():
+      fp.write(data)
+
   def pack(self):
-    fp = io.BytesIO()
-    self.pack_into_stream(fp)
-    return fp.getvalue()
+    return b''.join(self._pack_parts_())
+
+
+def _pack_generic(obj):
+  # The #Struct._pack_() function of structs that are not compiled.
+  fp = io.BytesIO()
+  obj._pack_fields_(fp)
+  return [fp.getvalue()]
+
+
+class StructCompiler(object):
+  """
+  Generates the functions that unpack and pack a #Struct subclass *cls*.
+  The code is specialized for the fields of the class: consecutive fields
+  of fixed size are read and packed with a single #struct.Struct, the
+  counts and lengths that refer to other fields are looked up in local
+  variables and the getters of hidden fields are called directly.
+
+  The values of the fields are only recorded in the #UnpackContext if a
+  field needs it (a callable *times* or *length* or a wrapped #Struct).
+  Only structs for which #supports() returns #True are compiled.
+  """
+
+  def __init__(self, cls):
+    self.cls = cls
+    self.env = {'cls': cls, 'struct': struct, 'TableView': TableView,
+      'UnpackContext': UnpackContext, 'UnpackError': UnpackError, 'PackError': PackError}
+    self.needs_ctx = any(self._needs_ctx(index, field) for index, field in enumerate(cls._fields_))
+
+  @staticmethod
+  def supports(cls):
+    """
+    Returns #True if all fields of the #Struct subclass *cls* are plain
+    #Field#s, #ListField#s or #StringField#s. The generated code of other
+    fields would only call the same methods as the generic implementation.
+    """
+
+    return all(type(field) in (Field, ListField, StringField) for field in cls._fields_)
+
+  def _needs_ctx(self, index, field):
+    if field.wraps_struct():
+      return True
+    size = getattr(field, 'times', getattr(field, 'length', None))
+    if isinstance(size, str):
+      return not any(x.name == size for x in self.cls._fields_[:index])
+    return callable(size)
+
+  def _name(self, value, prefix):
+    # Makes *value* available to the generated code and returns its name.
+    name = '{}{}'.format(prefix, len(self.env))
+    self.env[name] = value
+    return name
+
+  def _groups(self):
+    # Yields lists of `(index, field)` tuples, where the fields of a list
+    # can be unpacked with a single format.
+    group = []
+    order = ''
+    for index, field in enumerate(self.cls._fields_):
+      field_order = _get_byte_order(field)
+      if field_order is None:
+        if group:
+          yield group
+          group, order = [], ''
+        yield [(index, field)]
+        continue
+      if group and field_order != '' and order not in ('', field_order):
+        yield group
+        group, order = [], ''
+      group.append((index, field))
+      if field_order != '':
+        order = field_order
+    if group:
+      yield group
+
+  def _compile(self, name, lines):
+    code = '\n'.join(lines) + '\n'
+    namespace = {}
+    exec(compile(code, '<{} {}>'.format(self.cls.__name__, name), 'exec'), self.env, namespace)
+    return namespace[name]
+
+  def _group_format(self, group):
+    # The format to unpack the plain #Field#s of a group with.
+    if len(group) == 1:
+      return group[0][1].fmt
+    order = next((_get_byte_order(f) for i, f in group if _get_byte_order(f)), '>')
+    return struct.Struct(order + ''.join(_strip_byte_order(f.fmt.format) for i, f in group))
+
+  def _size_expr(self, size, index, struct_name):
+    # Returns an expression for the *times* or *length* of a field.
+    if isinstance(size, str):
+      for other_index, other in reversed(list(enumerate(self.cls._fields_[:index]))):
+        if other.name == size:
+          return '_{}'.format(other_index)
+      return 'ctx.field_values[{!r}]'.format(size)
+    if callable(size):
+      return '{}(ctx)'.format(self._name(size, '_size'))
+    return repr(size)
+
+  def compile_unpack(self):
+    """
+    Returns a function `unpack(fp, ctx)` equivalent to
+    #Struct._unpack_fields_().
+    """
+
+    cls = self.cls
+    lines = ['def unpack(fp, ctx):', '  read = fp.read']
+    if self.needs_ctx:
+      lines += ['  if ctx is None:', '    ctx = UnpackContext(cls)', '  values = ctx.field_values']
+    error = '  if len(data) != {size}: raise UnpackError({msg!r}.format(len(data)))'
+
+    for group in self._groups():
+      index, field = group[0]
+      var = '_{}'.format(index)
+      if type(field) is Field and not field.wraps_struct():
+        fmt = self._group_format(group)
+        lines.append('  data = read({})'.format(fmt.size))
+        lines.append(error.format(size=fmt.size, msg='field {}.{} (got {{}} bytes): expected {} bytes'.format(
+          cls.__name__, field.name, fmt.size)))
+        if fmt.size:
+          lines.append('  items = {}.unpack(data)'.format(self._name(fmt, '_fmt')))
+        offset = 0
+        for i, f in group:
+          count = len(f.fmt.unpack(bytes(f.fmt.size)))
+          if count == 1:
+            lines.append('  _{} = items[{}]'.format(i, offset))
+          else:
+            lines.append('  _{} = items[{}:{}]'.format(i, offset, offset + count) if count else '  _{} = ()'.format(i))
+          offset += count
+      elif type(field) is ListField and not field.wraps_struct():
+        fmt = self._name(field.fmt, '_fmt')
+        size = field.fmt.size
+        if field.times is None:
+          lines.append('  data = read()')
+          lines.append('  if len(data) % {}: raise UnpackError({!r}.format(len(data)))'.format(size,
+            '{}.{} expected a multiple of {} bytes (got {{}})'.format(cls.__name__, field.name, size)))
+        else:
+          lines.append('  nbytes = {} * {}'.format(self._size_expr(field.times, index, fmt), size))
+          lines.append('  data = read(nbytes)')
+          lines.append('  if len(data) != nbytes: raise UnpackError({!r}.format(nbytes, len(data)))'.format(
+            '{}.{} expected {{}} bytes (got {{}})'.format(cls.__name__, field.name)))
+        if field.lazy:
+          lines.append('  {} = TableView({}, data)'.format(var, fmt))
+        elif len(field.fmt.unpack(bytes(size))) == 1:
+          lines.append('  {} = [x[0] for x in {}.iter_unpack(data)]'.format(var, fmt))
+        else:
+          lines.append('  {} = list({}.iter_unpack(data))'.format(var, fmt))
+      elif type(field) is ListField:
+        sub = self._name(field.fmt, '_struct')
+        lines.append('  {} = [{}.unpack_from_stream(fp, UnpackContext({}, ctx)) for _ in range({})]'.format(
+          var, sub, sub, self._size_expr(field.times, index, sub)))
+      elif type(field) is StringField:
+        if field.length is None:
+          lines.append('  {} = read()'.format(var))
+        else:
+          lines.append('  length = {}'.format(self._size_expr(field.length, index, None)))
+          lines.append('  {} = read(length)'.format(var))
+          lines.append('  if len({}) != length: raise UnpackError({!r}.format(length, len({})))'.format(
+            var, '{}.{} expected {{}} bytes (got {{}})'.format(cls.__name__, field.name), var))
+      else:
+        sub = self._name(field.fmt, '_struct')
+        lines.append('  {} = {}.unpack_from_stream(fp, UnpackContext({}, ctx))'.format(var, sub, sub))
+      if self.needs_ctx:
+        for i, f in group:
+          lines.append('  values[{!r}] = _{}'.format(f.name, i))
+
+    kwargs = '{{{}}}'.format(', '.join('{!r}: _{}'.format(f.name, i)
+      for i, f in enumerate(cls._fields_) if not f.hidden))
+    lines.append('  kwargs = {}'.format(kwargs))
+    if self.needs_ctx:
+      lines.append('  ctx.init_values.update(kwargs)')
+    if cls.__init__ is Struct.__init__:
+      lines.append('  obj = object.__new__(cls)')
+      lines.append('  obj.__dict__.update(kwargs)')
+      lines.append('  return obj')
+    else:
+      lines.append('  return cls(**kwargs)')
+    return self._compile('unpack', lines)
+
+  def compile_pack(self):
+    """
+    Returns a function `pack(obj)` that returns a list of the packed data of
+    the fields of the struct *obj*, like #Struct._pack_fields_(). It raises
+    a #PackError if a value can not be packed.
+    """
+
+    lines = ['def pack(self):', '  parts = []', '  append = parts.append']
+
+    def value(index, field):
+      if not field.name:
+        return 'None'
+      if field.hidden:
+        return '{}(self)'.format(self._name(field.getter, '_getter'))
+      if re.match(r'^[A-Za-z_]\w*$', field.name):
+        return 'self.' + field.name
+      return 'getattr(self, {!r})'.format(field.name)
+
+    for group in self._groups():
+      index, field = group[0]
+      if type(field) is Field and not field.wraps_struct():
+        fmt = self._group_format(group)
+        args = []
+        for i, f in group:
+          count = len(f.fmt.unpack(bytes(f.fmt.size)))
+          if count == 1:
+            args.append(value(i, f))
+          elif count:
+            args.append('*' + value(i, f))
+        named = [(i, f) for i, f in group if f.name]
+        msg = 'field {} (value: {{!r}}): {{}}'.format(
+          ', '.join('{}.{}'.format(self.cls.__name__, f.name) for i, f in named))
+        values = [value(i, f) for i, f in named]
+        lines.append('  try:')
+        lines.append('    append({}.pack({}))'.format(self._name(fmt, '_fmt'), ', '.join(args)))
+        lines.append('  except (struct.error, TypeError) as e:')
+        lines.append('    raise PackError({!r}.format({}, e))'.format(msg,
+          values[0] if len(values) == 1 else '({})'.format(', '.join(values) or 'None')))
+      elif type(field) is ListField and not field.wraps_struct():
+        fmt = self._name(field.fmt, '_fmt')
+        lines.append('  items = {}'.format(value(index, field)))
+        lines.append('  if isinstance(items, TableView) and items.fmt.format == {}.format:'.format(fmt))
+        lines.append('    append(items.tobuffer())')
+        lines.append('  else:')
+        lines.append('    try:')
+        if len(field.fmt.unpack(bytes(field.fmt.size))) == 1:
+          lines.append('      append(b"".join(map({}.pack, items)))'.format(fmt))
+        else:
+          lines.append('      append(b"".join({}.pack(*x) for x in items))'.format(fmt))
+        lines.append('    except (struct.error, TypeError) as e:')
+        lines.append('      raise PackError({!r}.format(e))'.format(
+          'field {}.{}: {{}}'.format(self.cls.__name__, field.name)))
+      elif type(field) is ListField:
+        sub = self._name(field.fmt, '_struct')
+        lines.append('  for x in {}:'.format(value(index, field)))
+        lines.append('    assert isinstance(x, {}), (type(x), {})'.format(sub, sub))
+        lines.append('    parts.extend(x._pack_parts_())')
+      elif type(field) is StringField:
+        lines.append('  append({})'.format(value(index, field)))
+      else:
+        sub = self._name(field.fmt, '_struct')
+        lines.append('  x = {}'.format(value(index, field)))
+        lines.append('  assert isinstance(x, {}), (type(x), {})'.format(sub, sub))
+        lines.append('  parts.extend(x._pack_parts_())')
+    lines.append('  return parts')
+    return self._compile('pack', lines)
+
+
+def _get_byte_order(field):
+  # Returns the byte order character of a plain #Field with a standard size
+  # format, an empty string for a format of only pad bytes (which can be
+  # combined with any byte order) and #None for any other field.
+  if type(field) is not Field or field.wraps_struct():
+    return None
+  format = field.fmt.format
+  if isinstance(format, bytes):
+    format = format.decode('ascii')
+  if not _strip_byte_order(format).replace('x', '').strip('0123456789'):
+    return ''
+  if format[:1] in '<>!=':
+    return '>' if format[:1] == '!' else format[:1]
+  return None
+
+
+def _strip_byte_order(format):
+  if isinstance(format, bytes):
+    format = format.decode('ascii')
+  return format.lstrip('@=<>!')
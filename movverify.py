@@ -0,0 +1,269 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Consistency checks for the sample tables of a (repaired) file. The tables of
+every track are checked as a whole (see #movtables) against the bounds of the
+`mdat` atom, against each other and against the track durations. Optionally,
+the headers of a few samples are checked for the signature expected of the
+track's codec.
+"""
+
+from movio import MovAtomR, get_fileno, get_file_size_via_seek
+import itertools
+import mmap
+import operator
+import struct
+
+import movtables
+
+#: The default number of chunks per track whose first sample is checked by
+#: #verify_file().
+DEFAULT_SPOT_CHECKS = 16
+
+
+def _check_length_prefix(header, size):
+  # AVC and HEVC samples are a sequence of NAL units, each prefixed by its
+  # length. We assume the common 4-byte length prefix.
+  if len(header) < 4:
+    return False
+  length = struct.unpack('>I', header[:4])[0]
+  return 0 < length <= size - 4
+
+
+def _check_prores(header, size):
+  return header[4:8] == b'icpf'
+
+
+def _check_dnxhd(header, size):
+  return header[:4] == b'\x00\x00\x02\x80'
+
+
+#: Functions that check the first bytes of a sample for the signature of its
+#: codec, by the data format of the sample description.
+SAMPLE_SIGNATURES = {
+  b'avc1': _check_length_prefix,
+  b'avc3': _check_length_prefix,
+  b'hvc1': _check_length_prefix,
+  b'hev1': _check_length_prefix,
+  b'apch': _check_prores,
+  b'apcn': _check_prores,
+  b'apcs': _check_prores,
+  b'apco': _check_prores,
+  b'ap4h': _check_prores,
+  b'ap4x': _check_prores,
+  b'AVdn': _check_dnxhd,
+  b'AVdh': _check_dnxhd,
+}
+
+
+class TrackReport(object):
+  """
+  The result of verifying a single track.
+  """
+
+  def __init__(self, index, data_format):
+    self.index = index
+    self.data_format = data_format
+    self.chunks = 0
+    self.samples = 0
+    self.spot_checks = 0
+    self.errors = []
+
+  def __str__(self):
+    return 'Track {} ({}): {} chunks, {} samples, {}'.format(self.index,
+      self.data_format.decode('ascii', 'ignore'), self.chunks, self.samples,
+      '{} error(s)'.format(len(self.errors)) if self.errors else 'ok')
+
+
+class FileView(object):
+  """
+  Random access to the data of the file *fp* through mmap, or seek() and
+  read() if the file can not be mapped.
+  """
+
+  def __init__(self, fp):
+    self.fp = fp
+    self.map = None
+    fileno = get_fileno(fp)
+    if fileno is not None:
+      try:
+        self.map = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+      except (ValueError, mmap.error):
+        pass
+
+  def read(self, offset, length):
+    if self.map is not None:
+      return self.map[offset:offset + length]
+    self.fp.seek(offset)
+    return self.fp.read(length)
+
+  def find(self, sub, start, end, blocksize=1024 * 1024):
+    """
+    Returns the offset of the first occurrence of *sub* between *start* and
+    *end*, or -1.
+    """
+
+    if self.map is not None:
+      return self.map.find(sub, start, end)
+    while start < end:
+      data = self.read(start, min(blocksize, end - start))
+      found = data.find(sub)
+      if found >= 0:
+        return start + found
+      if len(data) < blocksize:
+        break
+      start += len(data) - len(sub) + 1
+    return -1
+
+  def close(self):
+    if self.map is not None:
+      self.map.close()
+
+
+def verify_track(index, tables, mdat_begin, mdat_end, view=None,
+                 spot_checks=DEFAULT_SPOT_CHECKS):
+  """
+  Verifies the #movtables.TrackTables *tables* of a track. Returns a
+  #TrackReport and a list of `(begin, end)` byte ranges of its chunks (for
+  the overlap check in #verify_file()).
+  """
+
+  report = TrackReport(index, tables.data_format)
+  errors = report.errors
+  counts = tables.chunk_sample_counts()
+  total = sum(counts)
+  sample_count = tables.sample_count
+  if sample_count is None:
+    sample_count = total
+  offsets = tables.sample_offsets(sample_count)
+  report.chunks = len(counts)
+  report.samples = sample_count
+
+  if len(counts) < len(tables.stco.table):
+    errors.append('stsc describes only {} of {} chunks'.format(len(counts), len(tables.stco.table)))
+  if total != sample_count:
+    errors.append('chunks contain {} samples, stsz has {}'.format(total, sample_count))
+  stts_samples, stts_duration = tables.stts_totals()
+  if stts_samples != sample_count:
+    errors.append('stts describes {} samples, stsz has {}'.format(stts_samples, sample_count))
+  if stts_duration != tables.duration:
+    errors.append('stts duration is {}, mdhd duration is {}'.format(stts_duration, tables.duration))
+
+  if total > sample_count:
+    # Can not compute the chunk sizes with the missing samples.
+    return report, []
+
+  begins = tables.chunk_offsets()[:len(counts)]
+  sizes = tables.chunk_sizes(counts, offsets)
+  ends = list(map(operator.add, begins, sizes))
+  outside = sum(map(operator.lt, begins, itertools.repeat(mdat_begin))) + \
+    sum(map(operator.gt, ends, itertools.repeat(mdat_end)))
+  if outside:
+    errors.append('{} chunk(s) exceed the mdat bounds ({}-{})'.format(outside, mdat_begin, mdat_end))
+
+  if view is not None and spot_checks and tables.data_format in SAMPLE_SIGNATURES:
+    check = SAMPLE_SIGNATURES[tables.data_format]
+    first_samples = movtables.cumsum(counts)
+    step = max(1, len(counts) // spot_checks)
+    failed = 0
+    for chunk in range(0, len(counts), step):
+      if not counts[chunk] or ends[chunk] > mdat_end:
+        continue
+      sample = first_samples[chunk]
+      size = offsets[sample + 1] - offsets[sample]
+      report.spot_checks += 1
+      if not check(view.read(begins[chunk], min(size, 16)), size):
+        failed += 1
+    if failed:
+      errors.append('{} of {} spot-checked samples do not look like {}'.format(
+        failed, report.spot_checks, tables.data_format.decode('ascii', 'ignore')))
+
+  return report, zip(begins, ends, itertools.repeat(index))
+
+
+def verify_file(fp, spot_checks=DEFAULT_SPOT_CHECKS):
+  """
+  Verifies the sample tables of the file *fp* (which must be seekable).
+  Returns a list of #TrackReport#s and a list of errors that concern the
+  whole file.
+  """
+
+  file_size = get_file_size_via_seek(fp)
+  fp.seek(0)
+  moov = None
+  mdat_begin = mdat_end = None
+  for atom in MovAtomR.make_root(fp).iter_atoms():
+    if atom.tag == b'mdat':
+      mdat_begin = atom.atom_begin + atom.header_size
+      mdat_end = min(atom.atom_begin + atom.size, file_size)
+    elif atom.tag == b'moov':
+      moov = atom.to_atomd()
+
+  errors = []
+  if moov is None:
+    errors.append('no moov atom')
+  if mdat_begin is None:
+    errors.append('no mdat atom')
+  if errors:
+    return [], errors
+
+  view = FileView(fp) if spot_checks else None
+  reports = []
+  ranges = []
+  try:
+    for index, trak in enumerate(moov.find_atoms(b'trak')):
+      tables = movtables.TrackTables(trak)
+      report, track_ranges = verify_track(index + 1, tables, mdat_begin,
+        mdat_end, view, spot_checks)
+      reports.append(report)
+      ranges.extend(track_ranges)
+  finally:
+    if view is not None:
+      view.close()
+
+  ranges.sort()
+  begins = map(operator.itemgetter(0), itertools.islice(ranges, 1, None))
+  overlaps = list(itertools.compress(itertools.count(),
+    map(operator.gt, map(operator.itemgetter(1), ranges), begins)))
+  if overlaps:
+    first, second = ranges[overlaps[0]], ranges[overlaps[0] + 1]
+    errors.append('{} overlapping chunk(s), first at offset {} (tracks {} and {})'
+      .format(len(overlaps), second[0], first[2], second[2]))
+
+  return reports, errors
+
+
+def print_report(reports, errors):
+  """
+  Prints the result of #verify_file(). Returns the total number of errors.
+  """
+
+  count = len(errors)
+  for report in reports:
+    print(report)
+    for error in report.errors:
+      print('  error:', error)
+    count += len(report.errors)
+  for error in errors:
+    print('error:', error)
+  print('Verification {}'.format('failed with {} error(s)'.format(count) if count else 'passed'))
+  return count
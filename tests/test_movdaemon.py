@@ -0,0 +1,31 @@
+import sys
+
+import pytest
+
+import movdaemon
+import movrepair
+
+
+def test_execute_job_log_and_cleanup(tmp_path, monkeypatch):
+  broken = tmp_path / 'a.MOV'
+  broken.write_bytes(b'')
+  output = str(tmp_path / 'out.MOV')
+  stdout = sys.stdout
+
+  def execute_plan(plan, broken, output, log=print):
+    output.write(b'data')
+    log('Output', 'sha1:', '0' * 40)
+    return 0
+  monkeypatch.setattr(movrepair.RepairPlan, 'from_json', classmethod(lambda cls, data: None))
+  monkeypatch.setattr(movrepair, 'execute_plan', execute_plan)
+  assert movdaemon._execute_job({}, str(broken), output) == (0, 'Output sha1: {}\n'.format('0' * 40))
+  assert sys.stdout is stdout
+  assert sorted(x.name for x in tmp_path.iterdir()) == ['a.MOV', 'out.MOV']
+
+  def execute_plan(plan, broken, output, log=print):
+    output.write(b'data')
+    raise IOError('disk full')
+  monkeypatch.setattr(movrepair, 'execute_plan', execute_plan)
+  with pytest.raises(IOError):
+    movdaemon._execute_job({}, str(broken), str(tmp_path / 'b.MOV'))
+  assert sorted(x.name for x in tmp_path.iterdir()) == ['a.MOV', 'out.MOV']
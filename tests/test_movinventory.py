@@ -0,0 +1,31 @@
+import struct
+
+from movio import MovAtomD
+import movinventory
+
+
+def write_file(path, stsd):
+  def atom(tag, *atoms, data=b''):
+    return MovAtomD(tag, data, list(atoms) if atoms else None)
+  moov = atom(b'moov',
+    atom(b'mvhd', data=bytes(12) + struct.pack('>II', 600, 1200) + bytes(80)),
+    atom(b'trak', atom(b'mdia', atom(b'minf', atom(b'stbl', atom(b'stsd', data=stsd))))))
+  with open(path, 'wb') as fp:
+    atom(b'ftyp', data=b'qt  \0\0\0\0qt  ').write(fp)
+    moov.write(fp)
+
+
+def test_scan_files_with_corrupt_files(tmp_path):
+  write_file(str(tmp_path / 'a.mov'), bytes(8))
+  # An stsd atom with a description that is missing.
+  write_file(str(tmp_path / 'b.mov'), bytes(4) + struct.pack('>I', 1))
+  # An atom whose size is smaller than its header.
+  (tmp_path / 'c.mov').write_bytes(struct.pack('>I4s', 4, b'ftyp') + bytes(16))
+  write_file(str(tmp_path / 'd.mov'), bytes(8))
+
+  records = list(movinventory.scan_files(movinventory.find_files([str(tmp_path)]), threads=2))
+  assert [r['path'].rsplit('/', 1)[1] for r in records] == ['a.mov', 'b.mov', 'c.mov', 'd.mov']
+  assert records[0]['error'] is None and records[0]['duration'] == 2.0
+  assert records[1]['error']
+  assert 'invalid atom size' in records[2]['error']
+  assert records[3]['error'] is None
@@ -0,0 +1,37 @@
+import struct
+
+from movio import MovAtomD
+import movatoms
+import movjoin
+
+
+def sbgp(grouping_type, runs):
+  return MovAtomD(b'sbgp', bytes(4) + grouping_type + struct.pack('>I', len(runs)) +
+    b''.join(struct.pack('>II', *x) for x in runs))
+
+
+def sgpd(grouping_type, data):
+  return MovAtomD(b'sgpd', b'\x01\0\0\0' + grouping_type + data)
+
+
+def stbl(*atoms):
+  return MovAtomD(b'stbl', atoms=list(atoms))
+
+
+
+def test_join_sample_groups():
+  first = stbl(sgpd(b'roll', b'\xff\xff'), sbgp(b'roll', [(3, 1)]),
+    sgpd(b'rap ', b'\1'), sbgp(b'rap ', [(5, 1)]))
+  # The roll groups cover only 3 of the 5 samples of the first chapter.
+  second = stbl(sgpd(b'roll', b'\xff\xff'), sbgp(b'roll', [(2, 1)]),
+    sgpd(b'rap ', b'\2'), sbgp(b'rap ', [(4, 1)]))
+  movjoin.join_sample_groups([first, second], [5, 4])
+  assert [x.tag for x in first.atoms] == [b'sgpd', b'sbgp']
+  assert list(movatoms.sbgp.unpack(first.atoms[1].data).table) == [(3, 1), (2, 0), (2, 1), (2, 0)]
+
+
+def test_join_sample_groups_missing():
+  first = stbl(sgpd(b'roll', b'\xff\xff'), sbgp(b'roll', [(3, 1)]))
+  second = stbl(sgpd(b'roll', b'\xff\xff'))
+  movjoin.join_sample_groups([first, second], [3, 4])
+  assert [x.tag for x in first.atoms] == [b'sgpd']
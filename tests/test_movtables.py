@@ -0,0 +1,64 @@
+import array
+import random
+
+import movtables
+
+
+def test_find_period():
+  assert movtables.find_period([1, 2, 1, 2, 1, 2]) == 2
+  assert movtables.find_period([9, 1, 2, 1, 2, 1, 2, 1, 2]) == 2
+  assert movtables.find_period([1, 1, 1, 1, 5]) is None
+  assert movtables.find_period([3, 1, 4, 1, 5]) is None
+
+
+def test_extend_sequence():
+  assert list(movtables.extend_sequence([0, 10, 20, 35, 45, 55, 70], 10)) == \
+    [0, 10, 20, 35, 45, 55, 70, 80, 90, 105]
+  assert list(movtables.extend_sequence([5, 1, 2, 1, 2, 1, 2], 10, deltas=False)) == \
+    [5, 1, 2, 1, 2, 1, 2, 1, 2, 1]
+
+
+def test_extend_non_periodic_sample_sizes():
+  rng = random.Random(0)
+  sizes = array.array('q', (rng.randrange(1, 100000) for _ in range(400000)))
+  model = movtables.ChunkModel(movtables.cumsum(sizes)[:-1], [1] * len(sizes),
+    [1] * len(sizes), sizes)
+  model.extend(4000000)
+  assert len(model) == 4000000
+  assert len(model.sample_sizes) == 4000000
+  assert min(model.sample_sizes) >= min(sizes)
+  assert max(model.sample_sizes) <= max(sizes)
+  offsets = model.offsets
+  assert all(a < b for a, b in zip(offsets[len(sizes) - 1:], offsets[len(sizes):]))
+
+
+def test_extend_runs():
+  runs = [(1, 0), (1, 2), (1, 0), (2, 1)] * 2
+  assert movtables.extend_runs(runs, 10, 13) == runs[:-1] + [(2, 1), (1, 0), (1, 2), (1, 0)]
+  assert movtables.extend_runs([(10, 5)], 10, 1000) == [(1000, 5)]
+  # The last and first run of the pattern meet in every repetition.
+  runs = [(2, 1), (1, 2), (1, 1)] * 2
+  assert movtables.extend_runs(runs, 8, 16) == runs[:-1] + [(3, 1), (1, 2), (3, 1), (1, 2), (1, 1)]
+
+
+def test_extend_sample_numbers():
+  table = movtables.TableView.fromarray('>I', array.array('q', range(1, 3000000, 30)))
+  numbers = movtables.extend_sample_numbers(table, 3000000, 30000000)
+  assert len(numbers) == 1000000
+  assert numbers[-1] == 29999971
+
+
+def test_extend_within_memory_budget():
+  sizes = array.array('q', range(1, 1001))
+  stsc, stco, stsz = (movtables.movatoms.stsc.unpack(b'\0' * 8),
+    movtables.movatoms.stco.unpack(b'\0' * 8), movtables.movatoms.stsz.unpack(b'\0' * 12))
+  packed = []
+  for budget in (None, movtables.MemoryBudget(1, threshold=0)):
+    model = movtables.ChunkModel(movtables.cumsum(sizes)[:-1], [1] * 1000, [1] * 1000,
+      sizes, budget=budget)
+    model.extend(100000)
+    packed.append(model.pack(stsc, stco, stsz))
+  assert isinstance(model.sample_sizes, memoryview)
+  assert budget.spilled >= 4 * 8 * 100000
+  assert packed[0] == packed[1]
+  budget.close()